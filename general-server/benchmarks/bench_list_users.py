@@ -0,0 +1,69 @@
+"""Benchmark GET /users/?limit=1000 with and without the orjson fast path.
+
+Run from the general-server directory:
+
+    python -m benchmarks.bench_list_users [--rows 1000] [--requests 200]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Point the app at a throwaway database before main.py reads DATABASE_URL
+_db_dir = tempfile.mkdtemp(prefix="bench-users-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_db_dir}/bench.db"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+from storage import SQLITE_SCHEMA, sqlite_datetime  # noqa: E402
+
+
+def seed(rows: int):
+    now = sqlite_datetime(datetime.utcnow())
+    with sqlite3.connect(f"{_db_dir}/bench.db") as conn:
+        conn.executescript(SQLITE_SCHEMA)
+        conn.execute("DELETE FROM users")
+        conn.executemany(
+            "INSERT INTO users (email, username, full_name, created_at) VALUES (?, ?, ?, ?)",
+            [(f"bench{i}@example.com", f"bench{i}", f"Bench User {i}", now) for i in range(rows)],
+        )
+
+
+def run(client: TestClient, fast: bool, rows: int, requests: int) -> float:
+    main.FAST_JSON_RESPONSES = fast
+    # Warm up
+    for _ in range(5):
+        client.get("/users/", params={"limit": rows})
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get("/users/", params={"limit": rows})
+        assert response.status_code == 200, response.text
+    elapsed = time.perf_counter() - start
+    return requests / elapsed
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    seed(args.rows)
+    with TestClient(main.app) as client:
+        validated = run(client, fast=False, rows=args.rows, requests=args.requests)
+        fast = run(client, fast=True, rows=args.rows, requests=args.requests)
+
+    print(f"GET /users/?limit={args.rows} ({args.requests} requests)")
+    print(f"  validated (response_model): {validated:8.1f} req/s")
+    print(f"  fast path (orjson):         {fast:8.1f} req/s")
+    print(f"  speedup:                    {fast / validated:8.2f}x")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,133 @@
+"""Benchmark mixed read/write throughput of the user store against the old `databases` setup.
+
+Run from the general-server directory:
+
+    python -m benchmarks.bench_mixed_rps [--rows 10000] [--clients 32] [--seconds 5] [--write-ratio 0.1]
+
+Each of --clients concurrent clients loops for --seconds, issuing a GET by
+ID, or with probability --write-ratio an UPDATE of one user's full_name,
+against a seeded SQLite file. "databases" is the previous storage path:
+SQLAlchemy Core statements built per call and run on one aiosqlite
+connection. "store" is SQLiteUserStore with --readers read connections.
+The `databases` run needs the dev requirements.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import SQLITE_SCHEMA, SQLiteUserStore, sqlite_datetime  # noqa: E402
+
+
+def seed(path: str, rows: int):
+    now = sqlite_datetime(datetime.utcnow())
+    with sqlite3.connect(path) as conn:
+        conn.executescript(SQLITE_SCHEMA)
+        conn.executemany(
+            "INSERT INTO users (email, username, full_name, created_at) VALUES (?, ?, ?, ?)",
+            [(f"bench{i}@example.com", f"bench{i}", f"Bench User {i}", now) for i in range(rows)],
+        )
+
+
+class DatabasesStore:
+    """The queries main.py used to run through `databases`"""
+
+    def __init__(self, path: str):
+        import databases
+        import sqlalchemy
+
+        self.sqlalchemy = sqlalchemy
+        self.database = databases.Database(f"sqlite:///{path}")
+        self.users = sqlalchemy.Table(
+            "users",
+            sqlalchemy.MetaData(),
+            sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column("email", sqlalchemy.String, unique=True),
+            sqlalchemy.Column("username", sqlalchemy.String, unique=True),
+            sqlalchemy.Column("full_name", sqlalchemy.String),
+            sqlalchemy.Column("created_at", sqlalchemy.DateTime),
+        )
+
+    async def connect(self):
+        await self.database.connect()
+
+    async def disconnect(self):
+        await self.database.disconnect()
+
+    async def get_user(self, user_id: int):
+        return await self.database.fetch_one(self.users.select().where(self.users.c.id == user_id))
+
+    async def update_user(self, user_id: int, values: dict):
+        # The old handler checked the user exists, updated, then read the row back
+        await self.get_user(user_id)
+        await self.database.execute(self.users.update().where(self.users.c.id == user_id).values(**values))
+        return await self.get_user(user_id)
+
+
+async def drive(store, rows: int, clients: int, seconds: float, write_ratio: float, seed_value: int):
+    latencies = {"read": [], "write": []}
+    deadline = time.perf_counter() + seconds
+
+    async def client(rng: random.Random):
+        while time.perf_counter() < deadline:
+            user_id = rng.randint(1, rows)
+            start = time.perf_counter()
+            if rng.random() < write_ratio:
+                await store.update_user(user_id, {"full_name": f"Renamed {rng.random():.6f}"})
+                latencies["write"].append(time.perf_counter() - start)
+            else:
+                await store.get_user(user_id)
+                latencies["read"].append(time.perf_counter() - start)
+
+    await store.connect()
+    try:
+        await asyncio.gather(*(client(random.Random(seed_value + i)) for i in range(clients)))
+    finally:
+        await store.disconnect()
+    return latencies
+
+
+def percentile(samples, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))] * 1000 if ordered else 0.0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{args.rows} users, {args.clients} clients, {args.write_ratio:.0%} writes, {args.seconds:g}s per run")
+    print(f"{'storage':<22}{'ops/s':>9}{'read p50':>10}{'read p99':>10}{'write p50':>11}{'write p99':>11}")
+    runs = [("store", lambda path: SQLiteUserStore(path, read_connections=args.readers))]
+    try:
+        import databases  # noqa: F401
+        runs.insert(0, ("databases", DatabasesStore))
+    except ImportError:
+        print("databases is not installed; skipping the baseline (pip install -r requirements-dev.txt)")
+
+    for label, make_store in runs:
+        path = os.path.join(tempfile.mkdtemp(prefix="bench-mixed-"), "users.db")
+        seed(path, args.rows)
+        latencies = asyncio.run(drive(make_store(path), args.rows, args.clients, args.seconds,
+                                      args.write_ratio, args.seed))
+        ops = len(latencies["read"]) + len(latencies["write"])
+        print(f"{label:<22}{ops / args.seconds:>9.0f}"
+              f"{percentile(latencies['read'], 50):>8.2f}ms{percentile(latencies['read'], 99):>8.2f}ms"
+              f"{percentile(latencies['write'], 50):>9.2f}ms{percentile(latencies['write'], 99):>9.2f}ms")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,37 +1,35 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response
 from pydantic import BaseModel, EmailStr, ValidationError
 from typing import List, Optional
-import databases
-import sqlalchemy
+from contextlib import asynccontextmanager
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 import logging
-from sqlalchemy.exc import IntegrityError, SQLAlchemyError
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+import orjson
+from health import ReadinessCheck, add_health_routes
+from log import SAMPLED, setup_logging
+from storage import create_store
+from tracing import instrument_app
 
 # Load environment variables
 load_dotenv()
 
-# Database configuration
+# Configure logging
+setup_logging("general-server")
+logger = logging.getLogger(__name__)
+
+# Database configuration: sqlite:///path/to/file.db, or postgresql://... with
+# DATABASE_REPLICA_URLS for read replicas (see storage.py)
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./users.db")
-database = databases.Database(DATABASE_URL)
-metadata = sqlalchemy.MetaData()
-
-# User table definition
-users = sqlalchemy.Table(
-    "users",
-    metadata,
-    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
-    sqlalchemy.Column("email", sqlalchemy.String, unique=True),
-    sqlalchemy.Column("username", sqlalchemy.String, unique=True),
-    sqlalchemy.Column("full_name", sqlalchemy.String),
-    sqlalchemy.Column("created_at", sqlalchemy.DateTime, default=datetime.utcnow),
-)
+database = create_store(DATABASE_URL)
+
+
+# Serialize DB rows straight to JSON bytes instead of building a pydantic
+# model per row. Set FAST_JSON_RESPONSES=false to fall back to full
+# response_model validation.
+FAST_JSON_RESPONSES = os.getenv("FAST_JSON_RESPONSES", "true").lower() == "true"
 
 
 # Pydantic models for request/response
@@ -65,9 +63,49 @@ class ErrorResponse(BaseModel):
     error_code: str
 
 
+class ORJSONRowResponse(Response):
+    """JSON response rendered with orjson, skipping FastAPI's encoder."""
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+def user_response(content):
+    """Return a fast orjson response, or the raw content for validation.
+
+    The route's response_model still drives the OpenAPI schema either way;
+    returning a Response instance simply bypasses per-row model creation.
+    """
+    if not FAST_JSON_RESPONSES:
+        return content
+    return ORJSONRowResponse(content)
+
+
+# Database connection
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        # Also creates the users table if it does not exist yet
+        await database.connect()
+        logger.info("Database connection established")
+    except Exception as e:
+        logger.error("Failed to connect to database: %s", e)
+        raise
+    yield
+    # Runs once uvicorn has finished or timed out the in-flight requests
+    try:
+        await database.disconnect()
+        logger.info("Database connection closed")
+    except Exception as e:
+        logger.error("Error during database shutdown: %s", e)
+
+
 # Create FastAPI app
 app = FastAPI(
     title="User Management API",
+    lifespan=lifespan,
     responses={
         400: {"model": ErrorResponse, "description": "Bad Request"},
         404: {"model": ErrorResponse, "description": "Not Found"},
@@ -75,28 +113,25 @@ app = FastAPI(
         500: {"model": ErrorResponse, "description": "Internal Server Error"},
     },
 )
+instrument_app(app, "general-server")
 
 
-# Database connection
-@app.on_event("startup")
-async def startup():
-    try:
-        await database.connect()
-        engine = sqlalchemy.create_engine(DATABASE_URL)
-        metadata.create_all(engine)
-        logger.info("Database connection established")
-    except Exception as e:
-        logger.error(f"Failed to connect to database: {e}")
-        raise
+async def ping_database():
+    await database.fetch_val("SELECT 1")
 
 
-@app.on_event("shutdown")
-async def shutdown():
-    try:
-        await database.disconnect()
-        logger.info("Database connection closed")
-    except Exception as e:
-        logger.error(f"Error during database shutdown: {e}")
+readiness = ReadinessCheck()
+readiness.add("database", ping_database)
+add_health_routes(app, readiness)
+
+
+async def fetch_user(user_id: int):
+    """Fetch a single user row, raising 404 if it does not exist."""
+    user = await database.get_user(user_id)
+    if user is None:
+        logger.warning("User not found with ID: %s", user_id)
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
 
 
 # CRUD operations
@@ -110,14 +145,17 @@ async def shutdown():
 )
 async def create_user(user: UserCreate):
     try:
-        query = users.insert().values(
-            email=user.email, username=user.username, full_name=user.full_name
+        created_at = datetime.utcnow()
+        last_record_id = await database.create_user(
+            email=user.email,
+            username=user.username,
+            full_name=user.full_name,
+            created_at=created_at,
         )
-        last_record_id = await database.execute(query)
-        logger.info(f"User created successfully with ID: {last_record_id}")
-        return {**user.dict(), "id": last_record_id, "created_at": datetime.utcnow()}
+        logger.info("User created successfully with ID: %s", last_record_id, extra=SAMPLED)
+        return user_response({**user.dict(), "id": last_record_id, "created_at": created_at})
     except Exception as e:
-        logger.error(f"Error creating user: {e}")
+        logger.error("Error creating user: %s", e)
         raise
 
 
@@ -128,10 +166,9 @@ async def create_user(user: UserCreate):
 )
 async def read_users(skip: int = 0, limit: int = 100):
     try:
-        query = users.select().offset(skip).limit(limit)
-        return await database.fetch_all(query)
+        return user_response(await database.list_users(skip, limit))
     except Exception as e:
-        logger.error(f"Error fetching users: {e}")
+        logger.error("Error fetching users: %s", e)
         raise
 
 
@@ -145,16 +182,11 @@ async def read_users(skip: int = 0, limit: int = 100):
 )
 async def read_user(user_id: int):
     try:
-        query = users.select().where(users.c.id == user_id)
-        user = await database.fetch_one(query)
-        if user is None:
-            logger.warning(f"User not found with ID: {user_id}")
-            raise HTTPException(status_code=404, detail="User not found")
-        return user
+        return user_response(await fetch_user(user_id))
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error fetching user: {e}")
+        logger.error("Error fetching user: %s", e)
         raise
 
 
@@ -170,23 +202,24 @@ async def read_user(user_id: int):
 )
 async def update_user(user_id: int, user: UserUpdate):
     try:
-        # Check if user exists
-        existing_user = await read_user(user_id)
-
-        query = users.update().where(users.c.id == user_id)
         values = {k: v for k, v in user.dict().items() if v is not None}
         if not values:
+            # A missing user is still reported as 404 first
+            await fetch_user(user_id)
             logger.warning("No fields provided for update")
             raise HTTPException(status_code=400, detail="No fields to update")
 
-        query = query.values(**values)
-        await database.execute(query)
-        logger.info(f"User updated successfully with ID: {user_id}")
-        return await read_user(user_id)
+        # The updated row comes back from the write, so no second query is needed
+        updated = await database.update_user(user_id, values)
+        if updated is None:
+            logger.warning("User not found with ID: %s", user_id)
+            raise HTTPException(status_code=404, detail="User not found")
+        logger.info("User updated successfully with ID: %s", user_id, extra=SAMPLED)
+        return user_response(updated)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error updating user: {e}")
+        logger.error("Error updating user: %s", e)
         raise
 
 
@@ -199,27 +232,23 @@ async def update_user(user_id: int, user: UserUpdate):
 )
 async def delete_user(user_id: int):
     try:
-        # Check if user exists
-        await read_user(user_id)
-
-        query = users.delete().where(users.c.id == user_id)
-        result = await database.execute(query)
-        if not result:
-            logger.warning(f"User not found for deletion with ID: {user_id}")
+        deleted = await database.delete_user(user_id)
+        if not deleted:
+            logger.warning("User not found for deletion with ID: %s", user_id)
             raise HTTPException(status_code=404, detail="User not found")
 
-        logger.info(f"User deleted successfully with ID: {user_id}")
+        logger.info("User deleted successfully with ID: %s", user_id, extra=SAMPLED)
         return {"message": "User deleted successfully"}
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error deleting user: {e}")
+        logger.error("Error deleting user: %s", e)
         raise
 
 # Health check endpoint
 @app.get("/health", status_code=200)
 async def health_check():
-    """Basic health check endpoint."""
+    """Basic liveness check; /health/ready also checks the database."""
     return {"status": "ok"}
 
 if __name__ == "__main__":
@@ -0,0 +1,350 @@
+"""User storage for general-server.
+
+Two backends share one interface:
+
+- SQLiteUserStore: a single writer connection plus a pool of read-only
+  connections, each used from its own thread. In WAL mode readers never
+  block on the writer, so GETs run concurrently with each other and with
+  writes instead of queueing behind one connection.
+- PostgresUserStore (optional, needs asyncpg): writes go to the primary and
+  reads are spread across DATABASE_REPLICA_URLS.
+
+Statements are fixed SQL strings rather than query objects built per
+request. sqlite3 and asyncpg both cache prepared statements per connection
+by SQL text, so each statement is compiled once per connection.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+from tracing import registry
+
+logger = logging.getLogger(__name__)
+
+# Read-only SQLite connections; each gets its own thread
+DATABASE_READ_CONNECTIONS = int(os.getenv("DATABASE_READ_CONNECTIONS", "4"))
+# Comma-separated Postgres URLs that reads are routed to; writes always use DATABASE_URL
+DATABASE_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+# Postgres connections per pool (primary and each replica)
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "10"))
+
+query_duration = registry.histogram(
+    "db_query_duration_seconds", "User store query latency", ("operation", "role")
+)
+
+USER_COLUMNS = ("id", "email", "username", "full_name", "created_at")
+UPDATABLE_COLUMNS = ("email", "username", "full_name")
+_SELECT = "SELECT id, email, username, full_name, created_at FROM users"
+_RETURNING = " RETURNING id, email, username, full_name, created_at"
+
+# Same table SQLAlchemy created for the old `databases` setup, so existing files keep working
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER NOT NULL,
+    email VARCHAR,
+    username VARCHAR,
+    full_name VARCHAR,
+    created_at DATETIME,
+    PRIMARY KEY (id),
+    UNIQUE (email),
+    UNIQUE (username)
+)
+"""
+
+POSTGRES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    email VARCHAR UNIQUE,
+    username VARCHAR UNIQUE,
+    full_name VARCHAR,
+    created_at TIMESTAMP
+)
+"""
+
+
+class UserStore:
+    async def connect(self):
+        raise NotImplementedError
+
+    async def disconnect(self):
+        raise NotImplementedError
+
+    async def fetch_val(self, sql: str):
+        """First column of the first row of a read-only query"""
+        raise NotImplementedError
+
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        raise NotImplementedError
+
+    async def list_users(self, skip: int, limit: int) -> List[Dict]:
+        raise NotImplementedError
+
+    async def create_user(self, email: str, username: str, full_name: str, created_at: datetime) -> int:
+        """Insert a user and return its ID"""
+        raise NotImplementedError
+
+    async def update_user(self, user_id: int, values: Dict) -> Optional[Dict]:
+        """Update some of UPDATABLE_COLUMNS; the updated row, or None if there is no such user.
+
+        The row comes back from the write itself, so it never reads a replica
+        that has not caught up yet.
+        """
+        raise NotImplementedError
+
+    async def delete_user(self, user_id: int) -> bool:
+        raise NotImplementedError
+
+
+def update_columns(values: Dict) -> Tuple[str, ...]:
+    unknown = set(values) - set(UPDATABLE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Cannot update columns: {', '.join(sorted(unknown))}")
+    return tuple(c for c in UPDATABLE_COLUMNS if c in values)
+
+
+def sqlite_datetime(value: datetime) -> str:
+    """The text format SQLAlchemy stores DateTime columns in on SQLite"""
+    return value.isoformat(sep=" ", timespec="microseconds")
+
+
+def user_from_row(row) -> Dict:
+    user = dict(zip(USER_COLUMNS, row))
+    if isinstance(user["created_at"], str):
+        user["created_at"] = datetime.fromisoformat(user["created_at"])
+    return user
+
+
+def _fetch_user(conn: sqlite3.Connection, sql: str, params: tuple) -> Optional[Dict]:
+    row = conn.execute(sql, params).fetchone()
+    return None if row is None else user_from_row(row)
+
+
+def _fetch_users(conn: sqlite3.Connection, sql: str, params: tuple) -> List[Dict]:
+    return [user_from_row(row) for row in conn.execute(sql, params)]
+
+
+@lru_cache(maxsize=None)
+def sqlite_update_sql(columns: Tuple[str, ...]) -> str:
+    assignments = ", ".join(f"{c} = ?" for c in columns)
+    return f"UPDATE users SET {assignments} WHERE id = ?" + _RETURNING
+
+
+class SQLiteUserStore(UserStore):
+    """One writer connection and a pool of read-only connections on a WAL database"""
+
+    SELECT_USER = _SELECT + " WHERE id = ?"
+    LIST_USERS = _SELECT + " ORDER BY id LIMIT ? OFFSET ?"
+    INSERT_USER = "INSERT INTO users (email, username, full_name, created_at) VALUES (?, ?, ?, ?)"
+    DELETE_USER = "DELETE FROM users WHERE id = ?"
+
+    def __init__(self, path: str, read_connections: int = DATABASE_READ_CONNECTIONS):
+        self.path = path
+        # An in-memory database exists only on its own connection
+        self.read_connections = 0 if path == ":memory:" else read_connections
+        self._writer: Optional[sqlite3.Connection] = None
+        self._readers: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self._write_executor: Optional[ThreadPoolExecutor] = None
+        self._read_executor: Optional[ThreadPoolExecutor] = None
+        # Threads, not asyncio primitives: the store may be used from more than one event loop
+        self._connect_lock = threading.Lock()
+
+    def _open(self, read_only: bool) -> sqlite3.Connection:
+        if read_only:
+            target, uri = f"file:{quote(os.path.abspath(self.path))}?mode=ro", True
+        else:
+            target, uri = self.path, False
+        conn = sqlite3.connect(target, uri=uri, check_same_thread=False, isolation_level=None,
+                               cached_statements=64)
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _connect(self):
+        with self._connect_lock:
+            if self._writer is not None:
+                return
+            writer = self._open(read_only=False)
+            if self.path != ":memory:":
+                writer.execute("PRAGMA journal_mode=WAL")
+                # Durable across application crashes in WAL mode; only an OS crash can lose the last commits
+                writer.execute("PRAGMA synchronous=NORMAL")
+            writer.executescript(SQLITE_SCHEMA)
+            for _ in range(self.read_connections):
+                self._readers.put(self._open(read_only=True))
+            self._write_executor = ThreadPoolExecutor(1, thread_name_prefix="sqlite-writer")
+            if self.read_connections:
+                self._read_executor = ThreadPoolExecutor(self.read_connections, thread_name_prefix="sqlite-reader")
+            self._writer = writer
+            logger.info("Opened %s with %d read connections", self.path, self.read_connections)
+
+    async def connect(self):
+        self._connect()
+
+    async def disconnect(self):
+        with self._connect_lock:
+            if self._writer is None:
+                return
+            for executor in (self._read_executor, self._write_executor):
+                if executor is not None:
+                    executor.shutdown(wait=True)
+            while not self._readers.empty():
+                self._readers.get_nowait().close()
+            self._writer.close()
+            self._writer = None
+            self._read_executor = self._write_executor = None
+
+    def _on_reader(self, fn, *args):
+        # The read executor has as many threads as connections, so one is always free here
+        conn = self._readers.get()
+        try:
+            return fn(conn, *args)
+        finally:
+            self._readers.put(conn)
+
+    async def _read(self, operation: str, fn, *args):
+        if self._writer is None:
+            self._connect()
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        if self._read_executor is None:
+            result = await loop.run_in_executor(self._write_executor, fn, self._writer, *args)
+        else:
+            result = await loop.run_in_executor(self._read_executor, self._on_reader, fn, *args)
+        query_duration.observe(time.perf_counter() - start, operation, "reader")
+        return result
+
+    async def _write(self, operation: str, fn, *args):
+        if self._writer is None:
+            self._connect()
+        start = time.perf_counter()
+        result = await asyncio.get_running_loop().run_in_executor(self._write_executor, fn, self._writer, *args)
+        query_duration.observe(time.perf_counter() - start, operation, "writer")
+        return result
+
+    async def fetch_val(self, sql: str):
+        return await self._read("fetch_val", lambda conn: (conn.execute(sql).fetchone() or (None,))[0])
+
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        return await self._read("get_user", _fetch_user, self.SELECT_USER, (user_id,))
+
+    async def list_users(self, skip: int, limit: int) -> List[Dict]:
+        return await self._read("list_users", _fetch_users, self.LIST_USERS, (limit, skip))
+
+    async def create_user(self, email: str, username: str, full_name: str, created_at: datetime) -> int:
+        values = (email, username, full_name, sqlite_datetime(created_at))
+        return await self._write("create_user", lambda conn: conn.execute(self.INSERT_USER, values).lastrowid)
+
+    async def update_user(self, user_id: int, values: Dict) -> Optional[Dict]:
+        columns = update_columns(values)
+        params = tuple(values[c] for c in columns) + (user_id,)
+        return await self._write("update_user", _fetch_user, sqlite_update_sql(columns), params)
+
+    async def delete_user(self, user_id: int) -> bool:
+        return await self._write("delete_user",
+                                 lambda conn: conn.execute(self.DELETE_USER, (user_id,)).rowcount > 0)
+
+
+@lru_cache(maxsize=None)
+def postgres_update_sql(columns: Tuple[str, ...]) -> str:
+    assignments = ", ".join(f"{c} = ${i}" for i, c in enumerate(columns, start=1))
+    return f"UPDATE users SET {assignments} WHERE id = ${len(columns) + 1}" + _RETURNING
+
+
+class PostgresUserStore(UserStore):
+    """asyncpg pools for the primary and any read replicas.
+
+    Replicas lag the primary, so a read straight after a write may not see
+    it; writes that need the new row return it themselves.
+    """
+
+    SELECT_USER = _SELECT + " WHERE id = $1"
+    LIST_USERS = _SELECT + " ORDER BY id LIMIT $1 OFFSET $2"
+    INSERT_USER = "INSERT INTO users (email, username, full_name, created_at) VALUES ($1, $2, $3, $4) RETURNING id"
+    DELETE_USER = "DELETE FROM users WHERE id = $1"
+
+    def __init__(self, url: str, replica_urls: Optional[List[str]] = None, pool_size: int = DATABASE_POOL_SIZE):
+        self.url = url
+        self.replica_urls = replica_urls if replica_urls is not None else DATABASE_REPLICA_URLS
+        self.pool_size = pool_size
+        self._primary = None
+        self._replicas: List = []
+        self._next_replica = itertools.count()
+
+    async def connect(self):
+        if self._primary is not None:
+            return
+        try:
+            import asyncpg
+        except ImportError:
+            raise Exception("Postgres DATABASE_URL needs asyncpg; build the image with WITH_POSTGRES=true")
+        self._primary = await asyncpg.create_pool(self.url, min_size=1, max_size=self.pool_size)
+        async with self._primary.acquire() as conn:
+            await conn.execute(POSTGRES_SCHEMA)
+        self._replicas = [await asyncpg.create_pool(url, min_size=1, max_size=self.pool_size)
+                          for url in self.replica_urls]
+        logger.info("Connected to Postgres with %d read replicas", len(self._replicas))
+
+    async def disconnect(self):
+        for pool in [self._primary] + self._replicas:
+            if pool is not None:
+                await pool.close()
+        self._primary = None
+        self._replicas = []
+
+    async def _pool(self, read: bool):
+        if self._primary is None:
+            await self.connect()
+        if read and self._replicas:
+            return self._replicas[next(self._next_replica) % len(self._replicas)], "replica"
+        return self._primary, "primary"
+
+    async def _run(self, operation: str, read: bool, method: str, sql: str, *args):
+        pool, role = await self._pool(read)
+        start = time.perf_counter()
+        async with pool.acquire() as conn:
+            result = await getattr(conn, method)(sql, *args)
+        query_duration.observe(time.perf_counter() - start, operation, role)
+        return result
+
+    async def fetch_val(self, sql: str):
+        return await self._run("fetch_val", True, "fetchval", sql)
+
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        row = await self._run("get_user", True, "fetchrow", self.SELECT_USER, user_id)
+        return None if row is None else dict(row)
+
+    async def list_users(self, skip: int, limit: int) -> List[Dict]:
+        return [dict(row) for row in await self._run("list_users", True, "fetch", self.LIST_USERS, limit, skip)]
+
+    async def create_user(self, email: str, username: str, full_name: str, created_at: datetime) -> int:
+        return await self._run("create_user", False, "fetchval", self.INSERT_USER,
+                               email, username, full_name, created_at)
+
+    async def update_user(self, user_id: int, values: Dict) -> Optional[Dict]:
+        columns = update_columns(values)
+        row = await self._run("update_user", False, "fetchrow", postgres_update_sql(columns),
+                              *(values[c] for c in columns), user_id)
+        return None if row is None else dict(row)
+
+    async def delete_user(self, user_id: int) -> bool:
+        status = await self._run("delete_user", False, "execute", self.DELETE_USER, user_id)
+        # asyncpg returns the command tag, e.g. "DELETE 1"
+        return status != "DELETE 0"
+
+
+def create_store(url: str) -> UserStore:
+    """Store for a DATABASE_URL: sqlite:///path/to/file.db or postgresql://..."""
+    if url.startswith("sqlite:///"):
+        return SQLiteUserStore(url[len("sqlite:///"):])
+    if url.startswith(("postgresql://", "postgres://", "postgresql+asyncpg://")):
+        return PostgresUserStore(url.replace("postgresql+asyncpg://", "postgresql://", 1))
+    raise ValueError(f"Unsupported DATABASE_URL: {url}")
@@ -1,11 +1,17 @@
+import asyncio
+import os
+import tempfile
+
+# Never touch the committed users.db, even before the per-test database is set up
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'users.db')}")
+
 import pytest
 from fastapi.testclient import TestClient
-import databases
-import sqlalchemy
-from sqlalchemy.pool import StaticPool
 from datetime import datetime
 import uuid
-from main import app, database as main_db_instance
+import main
+from main import app
+from storage import create_store
 
 # Test client - create once and reuse
 client = TestClient(app)
@@ -19,46 +25,11 @@ USER_TEMPLATE = {
 
 # Function to set up a new database for every test
 @pytest.fixture(autouse=True)
-async def isolated_db():
-    """Create a completely new database for each test."""
-    # Create a unique in-memory database URL for this test
-    db_id = str(uuid.uuid4())
-    db_url = f"sqlite:///:memory:{db_id}"
-    
-    # Set up the tables
-    engine = sqlalchemy.create_engine(
-        db_url,
-        connect_args={"check_same_thread": False},
-    )
-    metadata = sqlalchemy.MetaData()
-    
-    # Define test table
-    users = sqlalchemy.Table(
-        "users",
-        metadata,
-        sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
-        sqlalchemy.Column("email", sqlalchemy.String),
-        sqlalchemy.Column("username", sqlalchemy.String),
-        sqlalchemy.Column("full_name", sqlalchemy.String),
-        sqlalchemy.Column("created_at", sqlalchemy.DateTime, default=datetime.utcnow),
-    )
-    
-    # Create the tables
-    metadata.create_all(engine)
-    
-    # Create a new Database instance
-    test_db = databases.Database(db_url)
-    await test_db.connect()
-    
-    # Override the app's database dependency
-    app.dependency_overrides[main_db_instance] = lambda: test_db
-    
-    # Yield to allow the test to run
-    yield
-    
-    # Clean up
-    await test_db.disconnect()
-    app.dependency_overrides.clear()
+def isolated_db(tmp_path, monkeypatch):
+    """Give each test its own database file, opened and closed by the app's lifespan."""
+    monkeypatch.setattr(main, "database", create_store(f"sqlite:///{tmp_path / 'users.db'}"))
+    with client:
+        yield
 
 # --- Test Cases ---
 
@@ -215,4 +186,127 @@ def test_validation_error():
 def test_health_check():
     response = client.get("/health")
     assert response.status_code == 200, response.text
-    assert response.json() == {"status": "ok"} 
\ No newline at end of file
+    assert response.json() == {"status": "ok"} 
+
+def test_readiness_probes_database_and_caches_result(monkeypatch):
+    import main
+
+    async def broken_fetch_val(query):
+        raise Exception("database is locked")
+
+    monkeypatch.setattr(main.database, "fetch_val", broken_fetch_val)
+    main.readiness._checked_at = None
+    response = client.get("/health/ready")
+    assert response.status_code == 503, response.text
+    check = response.json()["checks"]["database"]
+    assert check["status"] == "down" and check["error"] == "database is locked"
+
+    pings = []
+
+    async def fake_fetch_val(query):
+        pings.append(query)
+        return 1
+
+    monkeypatch.setattr(main.database, "fetch_val", fake_fetch_val)
+    main.readiness._checked_at = None
+    for _ in range(3):
+        response = client.get("/health/ready")
+        assert response.status_code == 200, response.text
+    check = response.json()["checks"]["database"]
+    assert check["status"] == "ok" and "latency_ms" in check
+    assert pings == ["SELECT 1"]
+    assert client.get("/health/live").json() == {"status": "alive"}
+
+def test_fast_json_matches_validated_response(monkeypatch):
+    import main
+
+    suffix = uuid.uuid4().hex[:8]
+    test_user = {
+        "email": USER_TEMPLATE["email"].format(suffix),
+        "username": USER_TEMPLATE["username"].format(suffix),
+        "full_name": USER_TEMPLATE["full_name"].format(suffix),
+    }
+    user_id = client.post("/users/", json=test_user).json()["id"]
+
+    try:
+        monkeypatch.setattr(main, "FAST_JSON_RESPONSES", True)
+        fast_one = client.get(f"/users/{user_id}")
+        fast_list = client.get("/users/", params={"limit": 1000})
+
+        monkeypatch.setattr(main, "FAST_JSON_RESPONSES", False)
+        validated_one = client.get(f"/users/{user_id}")
+
+        assert fast_one.status_code == validated_one.status_code == 200
+        assert fast_one.headers["content-type"] == "application/json"
+        assert fast_one.json() == validated_one.json()
+        assert validated_one.json() in fast_list.json()
+    finally:
+        client.delete(f"/users/{user_id}")
+
+
+def test_json_log_formatter_truncates_payloads():
+    import json
+    import logging
+    from log import JsonFormatter
+
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, "user %s", ("42",), None)
+    record.payload = "x" * 5000
+    entry = json.loads(JsonFormatter("general-server").format(record))
+
+    assert entry["msg"] == "user 42"
+    assert entry["service"] == "general-server"
+    assert entry["payload"].startswith("x" * 100)
+    assert entry["payload"].endswith("more chars]")
+
+
+def test_trace_id_and_metrics():
+    response = client.get("/health", headers={"X-Trace-Id": "abc123"})
+    assert response.headers["X-Trace-Id"] == "abc123"
+
+    metrics = client.get("/metrics")
+    assert metrics.status_code == 200
+    assert "# TYPE http_request_duration_seconds histogram" in metrics.text
+    assert 'path="/health"' in metrics.text
+
+    # Malformed or oversized IDs are replaced rather than echoed into logs and headers
+    for bad in ("a b", "x" * 65, 'id"with\\quotes'):
+        replaced = client.get("/health", headers={"X-Trace-Id": bad}).headers["X-Trace-Id"]
+        assert replaced != bad and len(replaced) == 32
+
+
+def test_metric_label_values_are_escaped():
+    from tracing import MetricsRegistry
+
+    registry = MetricsRegistry()
+    registry.counter("odd_total", "Odd labels", ("value",)).inc('a\\b "c"\nd')
+    assert 'odd_total{value="a\\\\b \\"c\\"\\nd"} 1' in registry.render()
+
+
+def test_sqlite_store_reads_from_pool_and_returns_rows_from_writes(tmp_path):
+    from storage import SQLiteUserStore
+
+    async def scenario():
+        store = SQLiteUserStore(str(tmp_path / "users.db"), read_connections=2)
+        await store.connect()
+        try:
+            created_at = datetime(2024, 5, 1, 12, 30)
+            user_id = await store.create_user("a@example.com", "alice", "Alice", created_at)
+
+            # More concurrent reads than read connections
+            rows = await asyncio.gather(*(store.get_user(user_id) for _ in range(8)))
+            assert all(row == {"id": user_id, "email": "a@example.com", "username": "alice",
+                               "full_name": "Alice", "created_at": created_at} for row in rows)
+            assert await store.fetch_val("SELECT 1") == 1
+
+            updated = await store.update_user(user_id, {"full_name": "Alice B"})
+            assert updated["full_name"] == "Alice B" and updated["created_at"] == created_at
+            assert await store.update_user(99999, {"full_name": "Nobody"}) is None
+            assert [u["username"] for u in await store.list_users(0, 10)] == ["alice"]
+
+            assert await store.delete_user(user_id)
+            assert not await store.delete_user(user_id)
+            assert await store.get_user(user_id) is None
+        finally:
+            await store.disconnect()
+
+    asyncio.run(scenario())
@@ -1,10 +1,15 @@
-from typing import Dict
+from typing import Dict, Optional
 from pydantic import BaseModel
 
 class PromptRequest(BaseModel):
     content: Dict
     pr_url: str
     pr_info: Dict
+    # False returns the review text instead of posting it to remote-repo-server
+    forward: bool = True
+    # Generation profile for this review: {"profile": "quick"}, optionally with
+    # GenerationProfile fields overriding it, e.g. {"profile": "quick", "max_comments": 3}
+    generation: Optional[Dict] = None
     
     class Config:
         max_length = None
@@ -15,12 +20,8 @@ class PromptRequest(BaseModel):
 class LLMReviewData(BaseModel):
     generated_text: str
     pr_url: str
-    
-    def __init__(self, **data):
-        super().__init__(**data)
-        
-class DeepSeekResponse(BaseModel):
-    generated_text: str
+    head_sha: Optional[str] = None
+    prompt_hash: Optional[str] = None
     
     def __init__(self, **data):
         super().__init__(**data)
\ No newline at end of file
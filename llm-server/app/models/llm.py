@@ -0,0 +1,45 @@
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+
+class LLMResponse(BaseModel):
+    generated_text: str
+    provider: str
+    latency: Optional[float] = None
+    # Token usage as reported by the provider, when it reports it
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    # "stop", or "length" when max_tokens cut the output short
+    finish_reason: Optional[str] = None
+
+class ProviderConfig(BaseModel):
+    """One OpenAI-compatible endpoint in the LLM_PROVIDERS registry"""
+    name: str
+    base_url: str
+    model: str
+    api_key_env: Optional[str] = None
+    timeout: float = 60.0
+
+class GenerationProfile(BaseModel):
+    """Named generation settings; see GENERATION_PROFILES"""
+    name: str = "default"
+    # Model to use per provider name, instead of the provider's own
+    models: Dict[str, str] = {}
+    temperature: float = 0.7
+    # max_tokens grows with the diff between these bounds
+    min_tokens: int = 400
+    max_tokens: int = 4000
+    tokens_per_line: float = 6.0
+    tokens_per_file: int = 120
+    # Ask for at most this many comments and stop generating after them
+    max_comments: Optional[int] = None
+    # Request a JSON object from the provider instead of the text format
+    json_mode: bool = False
+
+class GenerationParams(BaseModel):
+    """Sampling parameters for one provider call"""
+    models: Dict[str, str] = {}
+    temperature: float = 0.7
+    max_tokens: int = 2000
+    stop: List[str] = []
+    json_mode: bool = False
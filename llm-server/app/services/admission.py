@@ -0,0 +1,121 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+
+from app.utils.tracing import registry
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "32"))
+# Queue ordering penalty per changed line: small PRs go first, but a large PR
+# only yields to work that arrived less than penalty seconds after it
+LLM_PRIORITY_SECONDS_PER_LINE = float(os.getenv("LLM_PRIORITY_SECONDS_PER_LINE", "0.01"))
+LLM_PRIORITY_MAX_PENALTY = float(os.getenv("LLM_PRIORITY_MAX_PENALTY", "60"))
+
+queue_depth = registry.gauge("llm_admission_queue_depth", "Requests waiting for an LLM slot")
+in_flight = registry.gauge("llm_admission_in_flight", "Requests holding an LLM slot")
+queue_wait = registry.histogram("llm_admission_wait_seconds", "Time spent waiting for an LLM slot")
+shed_total = registry.counter("llm_admission_shed_total", "Requests rejected because the queue was full")
+
+
+class QueueFullError(Exception):
+    """Raised when the wait queue is full; the caller should retry later"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"LLM queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounded concurrency limiter with a size-prioritized wait queue and load shedding"""
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, max_queue: int = LLM_MAX_QUEUE):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._active = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        # Exponential moving average of slot hold time, used for Retry-After
+        self._avg_service_time = 10.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """Estimate seconds until a newly shed request would likely be admitted"""
+        batches = (self.depth + 1) / max(self.max_concurrency, 1)
+        return max(1, round(batches * self._avg_service_time))
+
+    def _priority(self, size: int) -> float:
+        penalty = min(size * LLM_PRIORITY_SECONDS_PER_LINE, LLM_PRIORITY_MAX_PENALTY)
+        return time.monotonic() + penalty
+
+    def _update_gauges(self):
+        queue_depth.set(self.depth)
+        in_flight.set(self._active)
+
+    async def _acquire(self, size: int):
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            return
+        if self.depth >= self.max_queue:
+            shed_total.inc()
+            raise QueueFullError(self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (self._priority(size), next(self._sequence), waiter))
+        self._update_gauges()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # A slot was handed to us just before cancellation; pass it on
+                self._release()
+            else:
+                self._waiters = [w for w in self._waiters if w[2] is not waiter]
+                heapq.heapify(self._waiters)
+                self._update_gauges()
+            raise
+
+    def _release(self):
+        self._active -= 1
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                self._active += 1
+                waiter.set_result(None)
+                break
+        self._update_gauges()
+
+    def try_acquire(self) -> bool:
+        """Take a slot only if one is free right now, without queueing; pair with release()"""
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            self._update_gauges()
+            return True
+        return False
+
+    def release(self):
+        self._release()
+
+    @asynccontextmanager
+    async def slot(self, size: int = 0):
+        """Hold one LLM slot for the duration of the block.
+
+        `size` is the number of changed lines; smaller requests are admitted
+        first when there is a queue. Raises QueueFullError when the queue is full.
+        """
+        start = time.perf_counter()
+        await self._acquire(size)
+        queue_wait.observe(time.perf_counter() - start)
+        self._update_gauges()
+        held_since = time.perf_counter()
+        try:
+            yield
+        finally:
+            held = time.perf_counter() - held_since
+            self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * held
+            self._release()
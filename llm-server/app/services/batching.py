@@ -0,0 +1,177 @@
+import asyncio
+import itertools
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from app.models.llm import GenerationParams, LLMResponse
+from app.services.providers import Prompt
+from app.utils.prompts import patch_bytes, split_batch_review, templates
+from app.utils.tracing import registry
+
+logger = logging.getLogger(__name__)
+
+LLM_BATCHING_ENABLED = os.getenv("LLM_BATCHING_ENABLED", "false").lower() == "true"
+LLM_BATCH_WINDOW_MS = float(os.getenv("LLM_BATCH_WINDOW_MS", "250"))
+LLM_BATCH_MAX_JOBS = int(os.getenv("LLM_BATCH_MAX_JOBS", "8"))
+# Budget for the per-PR sections of one batched prompt, in characters
+LLM_BATCH_MAX_CHARS = int(os.getenv("LLM_BATCH_MAX_CHARS", "24000"))
+# Output budget of one batched request: at most the smallest max_tokens the
+# providers accept (DeepSeek rejects more than 8K), or every job in it fails
+LLM_BATCH_MAX_TOKENS = int(os.getenv("LLM_BATCH_MAX_TOKENS", "8000"))
+# Only PRs at or below these sizes are batched
+LLM_BATCH_SMALL_PR_LINES = int(os.getenv("LLM_BATCH_SMALL_PR_LINES", "60"))
+LLM_BATCH_SMALL_PR_FILES = int(os.getenv("LLM_BATCH_SMALL_PR_FILES", "3"))
+
+batch_size = registry.histogram(
+    "llm_batch_size", "Review jobs sent in one batched LLM request", buckets=(1, 2, 3, 4, 6, 8, 12, 16)
+)
+batch_fallbacks = registry.counter(
+    "llm_batch_fallback_total", "Batched jobs re-run alone because their section was missing"
+)
+
+# (prompt, provider, size in changed lines, generation parameters) -> response
+RunPrompt = Callable[[Prompt, str, int, Optional[GenerationParams]], Awaitable[LLMResponse]]
+
+
+class _Job:
+    def __init__(self, key: str, pr_info: Dict, changes: Dict, repo: Optional[str],
+                 generation: Optional[GenerationParams]):
+        self.key = key
+        self.repo = repo
+        self.pr_info = pr_info
+        self.changes = changes
+        self.generation = generation or GenerationParams()
+        self.size = changes.get("additions", 0) + changes.get("deletions", 0)
+        self.chars = patch_bytes(changes)
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class ReviewBatcher:
+    """Collects small review jobs over a short window and sends them as one prompt.
+
+    Each caller awaits its own job, so the batched output is demultiplexed back
+    to the request (and therefore the pr_url) that submitted it.
+    """
+
+    def __init__(self, run_prompt: RunPrompt, window_ms: float = LLM_BATCH_WINDOW_MS,
+                 max_jobs: int = LLM_BATCH_MAX_JOBS, max_chars: int = LLM_BATCH_MAX_CHARS,
+                 max_tokens: int = LLM_BATCH_MAX_TOKENS):
+        self.run_prompt = run_prompt
+        self.window = window_ms / 1000
+        self.max_jobs = max_jobs
+        self.max_chars = max_chars
+        self.max_tokens = max_tokens
+        # Keyed by (provider, system prompt, sampling parameters): only PRs sharing
+        # a system prompt and sampling settings can share a request
+        self._pending: Dict[Tuple[str, str, str], List[_Job]] = {}
+        self._timers: Dict[Tuple[str, str, str], asyncio.TimerHandle] = {}
+        self._keys = itertools.count(1)
+        # Batches being run; the loop only keeps weak references to tasks
+        self._running: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def is_small(changes: Dict) -> bool:
+        lines = changes.get("additions", 0) + changes.get("deletions", 0)
+        files = len([f for f in changes.get("changed_files", []) if f.get("patch")])
+        return lines <= LLM_BATCH_SMALL_PR_LINES and files <= LLM_BATCH_SMALL_PR_FILES
+
+    @staticmethod
+    def accepts(generation: GenerationParams) -> bool:
+        """A stop sequence would end every PR's review, and one JSON reply cannot be split by marker"""
+        return not generation.stop and not generation.json_mode
+
+    async def submit(self, provider: str, pr_info: Dict, changes: Dict, repo: Optional[str] = None,
+                     generation: Optional[GenerationParams] = None) -> str:
+        """Queue a small PR for the next batch and return its share of the review"""
+        job = _Job(str(next(self._keys)), pr_info, changes, repo, generation)
+        sampling = f"{job.generation.temperature}:{sorted(job.generation.models.items())}"
+        key = (provider, templates.system_prompt(repo), sampling)
+        pending = self._pending.setdefault(key, [])
+        if pending and (sum(j.chars for j in pending) + job.chars > self.max_chars or
+                        sum(j.generation.max_tokens for j in pending) + job.generation.max_tokens > self.max_tokens):
+            self._flush(key)
+            pending = self._pending.setdefault(key, [])
+        pending.append(job)
+
+        if len(pending) >= self.max_jobs:
+            self._flush(key)
+        elif key not in self._timers:
+            loop = asyncio.get_running_loop()
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await job.future
+
+    def _flush(self, key: Tuple[str, str, str]):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        jobs = self._pending.pop(key, [])
+        if jobs:
+            task = asyncio.create_task(self._run_batch(key[0], jobs))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def close(self, timeout: float = 30.0):
+        """Send whatever is still waiting for its window, then wait for the running
+        batches for up to `timeout` seconds and cancel the rest"""
+        for key in list(self._pending):
+            self._flush(key)
+        if not self._running:
+            return
+        _, unfinished = await asyncio.wait(set(self._running), timeout=timeout)
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+
+    async def _run_single(self, provider: str, job: _Job) -> str:
+        messages = templates.review_messages(job.pr_info, job.changes, repo=job.repo)
+        response = await self.run_prompt(messages, provider, job.size, job.generation)
+        return response.generated_text
+
+    async def _run_batch(self, provider: str, jobs: List[_Job]):
+        batch_size.observe(len(jobs))
+        try:
+            if len(jobs) == 1:
+                result = await self._run_single(provider, jobs[0])
+                if not jobs[0].future.done():
+                    jobs[0].future.set_result(result)
+                return
+
+            messages = templates.batch_review_messages(
+                [(j.key, j.pr_info, j.changes) for j in jobs], repo=jobs[0].repo
+            )
+            # Each PR keeps the output budget it would have had alone; submit
+            # splits batches before the sum passes the providers' cap
+            generation = GenerationParams(
+                models=jobs[0].generation.models,
+                temperature=jobs[0].generation.temperature,
+                max_tokens=min(sum(j.generation.max_tokens for j in jobs), self.max_tokens)
+            )
+            response = await self.run_prompt(messages, provider, sum(j.size for j in jobs), generation)
+            sections = split_batch_review(response.generated_text, [j.key for j in jobs])
+            logger.info("Batched review of %d PRs returned %d sections", len(jobs), len(sections))
+
+            missing = [job for job in jobs if job.key not in sections]
+            for job in jobs:
+                if job.key in sections and not job.future.done():
+                    job.future.set_result(sections[job.key])
+            if missing:
+                # The model skipped these PRs' markers; review each on its own, concurrently
+                batch_fallbacks.inc(amount=len(missing))
+                results = await asyncio.gather(*(self._run_single(provider, job) for job in missing),
+                                               return_exceptions=True)
+                for job, result in zip(missing, results):
+                    if job.future.done():
+                        continue
+                    if isinstance(result, BaseException):
+                        job.future.set_exception(result)
+                    else:
+                        job.future.set_result(result)
+        except Exception as e:
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
+        except asyncio.CancelledError:
+            for job in jobs:
+                job.future.cancel()
+            raise
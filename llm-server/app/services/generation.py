@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import re
+from typing import Dict, List, Optional
+
+from app.models.llm import GenerationParams, GenerationProfile
+
+logger = logging.getLogger(__name__)
+
+# Extra or overriding profiles, a JSON list of GenerationProfile objects, e.g.
+# [{"name": "strict", "temperature": 0.2, "max_comments": 10, "json_mode": true}]
+GENERATION_PROFILES = os.getenv("GENERATION_PROFILES")
+# Profile per repository, a JSON object such as {"acme/widgets": "thorough"}
+GENERATION_REPO_PROFILES = os.getenv("GENERATION_REPO_PROFILES")
+GENERATION_DEFAULT_PROFILE = os.getenv("GENERATION_DEFAULT_PROFILE", "default")
+
+BUILTIN_PROFILES = [
+    GenerationProfile(name="default"),
+    # Fewer, higher-signal comments for small or routine PRs
+    GenerationProfile(name="quick", temperature=0.3, min_tokens=300, max_tokens=1500, max_comments=5),
+    GenerationProfile(name="thorough", temperature=0.5, min_tokens=800, max_tokens=8000,
+                      tokens_per_line=10.0, tokens_per_file=200),
+]
+
+# Written after the last comment when a comment limit is set; also the stop sequence,
+# so the provider stops generating (and billing) as soon as the model is done
+REVIEW_END_MARKER = "=== END OF REVIEW ==="
+
+JSON_OUTPUT_INSTRUCTIONS = """Respond with a single JSON object and nothing else, in this shape:
+{"comments": [{"file": "filename.ext", "line": 18, "message": "Your comment", "suggestion": "replacement code or null"}]}
+Use only line numbers from the list above, and order comments from most to least important."""
+JSON_COMMENTS_START = re.compile(r'"comments"\s*:\s*\[')
+JSON_SEPARATOR = re.compile(r"[\s,]*")
+COMMENT_HEADER = re.compile(r"^\[[^\]]+\]:\d+", re.MULTILINE)
+
+
+class UnknownProfileError(Exception):
+    pass
+
+
+def changed_lines(changes: Dict) -> int:
+    return changes.get("additions", 0) + changes.get("deletions", 0)
+
+
+class GenerationProfiles:
+    """Named generation profiles and the per-repository choice between them"""
+
+    def __init__(self, profiles: Optional[List[GenerationProfile]] = None,
+                 repo_profiles: Optional[Dict[str, str]] = None, default: str = GENERATION_DEFAULT_PROFILE):
+        self.profiles: Dict[str, GenerationProfile] = {p.name: p for p in BUILTIN_PROFILES}
+        for profile in profiles or []:
+            self.profiles[profile.name] = profile
+        self.repo_profiles = repo_profiles or {}
+        self.default = default
+
+    def resolve(self, requested: Optional[Dict] = None, repo: Optional[str] = None) -> GenerationProfile:
+        """The request's profile, else the repository's, else the default.
+
+        `requested` is the request's "generation" object: a "profile" name,
+        optionally with fields overriding that profile for this request only.
+        """
+        requested = dict(requested or {})
+        name = requested.pop("profile", None) or self.repo_profiles.get(repo or "") or self.default
+        profile = self.profiles.get(name)
+        if profile is None:
+            raise UnknownProfileError(f"Unknown generation profile: {name}")
+        if requested:
+            requested.pop("name", None)
+            profile = GenerationProfile(**{**profile.dict(), **requested})
+        return profile
+
+    @staticmethod
+    def params(profile: GenerationProfile, changes: Dict) -> GenerationParams:
+        """Sampling parameters for one review, with max_tokens scaled to the diff"""
+        files = len([f for f in changes.get("changed_files", []) if f.get("patch")])
+        budget = profile.min_tokens + profile.tokens_per_line * changed_lines(changes) + profile.tokens_per_file * files
+        return GenerationParams(
+            models=profile.models,
+            temperature=profile.temperature,
+            max_tokens=int(min(profile.max_tokens, budget)),
+            stop=[REVIEW_END_MARKER] if profile.max_comments and not profile.json_mode else [],
+            json_mode=profile.json_mode,
+        )
+
+
+def output_instructions(profile: GenerationProfile) -> str:
+    """Per-profile output rules, appended to the user message so the system prompt stays cacheable"""
+    if profile.json_mode:
+        limit = f"\nWrite at most {profile.max_comments} comments." if profile.max_comments else ""
+        return JSON_OUTPUT_INSTRUCTIONS + limit
+    if profile.max_comments:
+        return (f"Write at most {profile.max_comments} comments, most important first, "
+                f"then a line containing only {REVIEW_END_MARKER}")
+    return ""
+
+
+def _comment_objects(text: str) -> List[Dict]:
+    """Comment objects from a JSON review, keeping the complete ones of a truncated reply"""
+    try:
+        data = json.loads(text)
+        comments = data.get("comments") if isinstance(data, dict) else data
+        return [c for c in comments if isinstance(c, dict)] if isinstance(comments, list) else []
+    except ValueError:
+        pass
+    # Cut off by max_tokens: decode comment objects one by one until the broken one
+    start = JSON_COMMENTS_START.search(text)
+    if start is None:
+        return []
+    decoder = json.JSONDecoder()
+    comments = []
+    position = start.end()
+    while True:
+        position = JSON_SEPARATOR.match(text, position).end()
+        try:
+            comment, position = decoder.raw_decode(text, position)
+        except ValueError:
+            break
+        if isinstance(comment, dict):
+            comments.append(comment)
+    return comments
+
+
+def review_text_from_json(text: str) -> str:
+    """A JSON-mode review in the text format the review parser reads"""
+    blocks = []
+    for comment in _comment_objects(text):
+        try:
+            block = f"[{comment['file']}]:{int(comment['line'])}\n{str(comment['message']).strip()}"
+        except (KeyError, TypeError, ValueError):
+            logger.info("Skipping malformed JSON review comment: %r", comment)
+            continue
+        if comment.get("suggestion"):
+            block += f"\n```suggestion\n{str(comment['suggestion']).strip(chr(10))}\n```"
+        blocks.append(block)
+    return "\n\n".join(blocks)
+
+
+def limit_comments(text: str, max_comments: int) -> str:
+    """The first max_comments comments of a text review"""
+    headers = list(COMMENT_HEADER.finditer(text))
+    if len(headers) <= max_comments:
+        return text
+    return text[:headers[max_comments].start()].rstrip()
+
+
+def finish_review(profile: GenerationProfile, text: str) -> str:
+    """Model output as review text: JSON converted, end marker removed, comment limit applied"""
+    if profile.json_mode:
+        text = review_text_from_json(text)
+    text = text.replace(REVIEW_END_MARKER, "").rstrip()
+    if profile.max_comments:
+        text = limit_comments(text, profile.max_comments)
+    return text
+
+
+def profiles_from_env() -> GenerationProfiles:
+    profiles = [GenerationProfile(**p) for p in json.loads(GENERATION_PROFILES)] if GENERATION_PROFILES else []
+    repo_profiles = json.loads(GENERATION_REPO_PROFILES) if GENERATION_REPO_PROFILES else {}
+    return GenerationProfiles(profiles, repo_profiles)
+
+
+generation_profiles = profiles_from_env()
@@ -0,0 +1,491 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Union
+
+import httpx
+
+from app.models.llm import GenerationParams, LLMResponse, ProviderConfig
+from app.services.admission import AdmissionController
+from app.utils.tracing import registry
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_CAP = float(os.getenv("LLM_BACKOFF_CAP", "8"))
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+# Expected latency of a provider without enough samples yet, for ordering failover
+# candidates. Such a provider is not hedged: a guess shorter than a typical review
+# would duplicate every early call.
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "20"))
+LLM_FAILOVER_ENABLED = os.getenv("LLM_FAILOVER_ENABLED", "true").lower() == "true"
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+provider_requests = registry.counter(
+    "llm_provider_requests_total", "Provider calls by outcome", ("provider", "outcome")
+)
+provider_latency = registry.histogram(
+    "llm_provider_latency_seconds", "Successful provider call latency", ("provider",)
+)
+hedged_requests = registry.counter(
+    "llm_hedged_requests_total", "Hedge requests sent after the p95 delay", ("provider",)
+)
+llm_tokens = registry.counter(
+    "llm_tokens_total", "Tokens reported by providers", ("provider", "kind")
+)
+breaker_open = registry.gauge(
+    "llm_provider_circuit_open", "1 while the provider circuit breaker is open", ("provider",)
+)
+
+
+# A bare string is sent as a single user message
+Prompt = Union[str, List[Dict[str, str]]]
+
+
+def as_messages(prompt: Prompt) -> List[Dict[str, str]]:
+    if isinstance(prompt, str):
+        return [{"role": "user", "content": prompt}]
+    return prompt
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, in either its seconds or HTTP-date form.
+
+    None if the header is missing or unreadable, so the default backoff applies.
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        return max(0.0, seconds) if math.isfinite(seconds) else None
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logger.warning("Ignoring unreadable Retry-After header: %r", value)
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+class ProviderError(Exception):
+    """A provider call failed; `retryable` tells the router whether to try again"""
+
+    def __init__(self, message: str, retryable: bool = True, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class LatencyTracker:
+    """Sliding window of recent successful call latencies"""
+
+    def __init__(self, window: int = 100, min_samples: int = 5):
+        self._samples = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures, then lets a single probe through after a cool-down"""
+
+    def __init__(self, name: str, failure_threshold: int = LLM_BREAKER_FAILURES,
+                 reset_timeout: float = LLM_BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def available(self) -> bool:
+        """Whether a call would currently be allowed, without claiming the probe"""
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self._opened_at >= self.reset_timeout
+        return not self._probe_in_flight
+
+    def allow(self) -> bool:
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self._probe_in_flight = False
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self._failures = 0
+        self._probe_in_flight = False
+        if self.state != "closed":
+            logger.info("Circuit for provider %s closed", self.name)
+        self.state = "closed"
+        breaker_open.set(0, self.name)
+
+    def record_failure(self):
+        self._failures += 1
+        self._probe_in_flight = False
+        if self.state == "half_open" or self._failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning("Circuit for provider %s opened after %d failures", self.name, self._failures)
+            self.state = "open"
+            self._opened_at = time.monotonic()
+            breaker_open.set(1, self.name)
+
+    def record_cancelled(self):
+        # A cancelled hedge says nothing about provider health
+        self._probe_in_flight = False
+
+
+class OpenAICompatibleProvider:
+    """An LLM backend speaking the OpenAI chat-completions protocol"""
+
+    def __init__(self, name: str, base_url: str, model: str, api_key: Optional[str] = None,
+                 timeout: float = 60.0):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.timeout = timeout
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker(name)
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        """Returns a pooled async HTTP client with the provider's API headers"""
+        if self._client is None:
+            headers = {"Content-Type": "application/json"}
+            if self.api_key:
+                headers["Authorization"] = f"Bearer {self.api_key}"
+            self._client = httpx.AsyncClient(headers=headers, timeout=self.timeout)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def probe(self, timeout: float = 5.0):
+        """Raises unless the endpoint is reachable and accepts our API key"""
+        try:
+            response = await self.get_client().get(f"{self.base_url}/v1/models", timeout=timeout)
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            raise ProviderError(f"{self.name} is unreachable: {e!r}")
+        if response.status_code in (401, 403):
+            raise ProviderError(f"{self.name} rejected the API key", retryable=False)
+        if response.status_code != 200:
+            raise ProviderError(f"{self.name} models endpoint returned {response.status_code}")
+
+    def build_request(self, prompt: Prompt, generation: Optional[GenerationParams] = None) -> Dict:
+        generation = generation or GenerationParams()
+        request = {
+            "model": generation.models.get(self.name, self.model),
+            "messages": as_messages(prompt),
+            "temperature": generation.temperature,
+            "max_tokens": generation.max_tokens
+        }
+        if generation.stop:
+            request["stop"] = generation.stop
+        if generation.json_mode:
+            request["response_format"] = {"type": "json_object"}
+        return request
+
+    async def process_prompt(self, prompt: Prompt, generation: Optional[GenerationParams] = None) -> LLMResponse:
+        """Process a prompt (text or chat messages) through the provider's chat-completions endpoint"""
+        request = self.build_request(prompt, generation)
+
+        start = time.perf_counter()
+        try:
+            response = await self.get_client().post(f"{self.base_url}/v1/chat/completions", json=request)
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            raise ProviderError(f"{self.name} request failed: {e!r}")
+
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = response.headers.get("Retry-After")
+            raise ProviderError(
+                f"{self.name} API error {response.status_code}: {response.text}",
+                retry_after=parse_retry_after(retry_after)
+            )
+        if response.status_code != 200:
+            raise ProviderError(f"{self.name} API error {response.status_code}: {response.text}", retryable=False)
+
+        try:
+            body = response.json()
+            choice = body["choices"][0]
+            content = choice["message"]["content"]
+        except (ValueError, KeyError, IndexError) as e:
+            raise ProviderError(f"{self.name} returned an unexpected response: {e!r}")
+        latency = time.perf_counter() - start
+        usage = body.get("usage") or {}
+        # OpenAI reports cache hits under prompt_tokens_details, DeepSeek as prompt_cache_hit_tokens
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens",
+                                                                        usage.get("prompt_cache_hit_tokens"))
+        for kind, count in (("prompt", usage.get("prompt_tokens")), ("completion", usage.get("completion_tokens")),
+                            ("cached", cached_tokens)):
+            if count:
+                llm_tokens.inc(self.name, kind, amount=count)
+
+        # The full completion is large; only log it when debugging
+        logger.debug(
+            "%s API response received", self.name,
+            extra={"provider": self.name, "response_chars": len(content), "response": content}
+        )
+        return LLMResponse(
+            generated_text=content,
+            provider=self.name,
+            latency=latency,
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+            cached_tokens=cached_tokens,
+            finish_reason=choice.get("finish_reason")
+        )
+
+
+class LocalStubProvider(OpenAICompatibleProvider):
+    """Offline provider returning a canned review, for local runs and tests"""
+
+    def __init__(self, name: str = "local", latency: float = 0.0):
+        super().__init__(name=name, base_url="local://stub", model="stub")
+        self.stub_latency = latency
+
+    async def probe(self, timeout: float = 5.0):
+        pass
+
+    async def process_prompt(self, prompt: Prompt, generation: Optional[GenerationParams] = None) -> LLMResponse:
+        start = time.perf_counter()
+        if self.stub_latency:
+            await asyncio.sleep(self.stub_latency)
+        return LLMResponse(
+            generated_text="No issues found by the local stub provider.",
+            provider=self.name,
+            latency=time.perf_counter() - start
+        )
+
+
+class ProviderRouter:
+    """Routes prompts across providers with retries, hedging and failover"""
+
+    def __init__(self, providers: Optional[List[OpenAICompatibleProvider]] = None,
+                 max_retries: int = LLM_MAX_RETRIES, hedge: bool = LLM_HEDGE_ENABLED,
+                 failover: bool = LLM_FAILOVER_ENABLED, admission: Optional[AdmissionController] = None):
+        self.providers: Dict[str, OpenAICompatibleProvider] = {}
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.failover = failover
+        # A hedge is a second provider call, so it needs a slot of its own;
+        # it is skipped rather than queued when none is free
+        self.admission = admission
+        for provider in providers or []:
+            self.register(provider)
+
+    def register(self, provider: OpenAICompatibleProvider):
+        self.providers[provider.name] = provider
+        breaker_open.set(0, provider.name)
+
+    def get(self, name: str) -> Optional[OpenAICompatibleProvider]:
+        return self.providers.get(name)
+
+    def candidates(self, preferred: Optional[str] = None) -> List[OpenAICompatibleProvider]:
+        """Healthy providers, the requested one first, the rest fastest first"""
+        def expected_latency(provider):
+            p50 = provider.latency.percentile(50)
+            return p50 if p50 is not None else LLM_HEDGE_DEFAULT_DELAY
+
+        first = self.providers.get(preferred)
+        if first is not None and not self.failover:
+            return [first] if first.breaker.available() else []
+        others = sorted(
+            (p for p in self.providers.values() if p is not first and p.breaker.available()),
+            key=expected_latency
+        )
+        if first is not None and first.breaker.available():
+            return [first] + others
+        return others
+
+    def hedge_delay(self, provider: OpenAICompatibleProvider) -> Optional[float]:
+        """Seconds after which a call is hedged; None until the provider has a p95"""
+        p95 = provider.latency.percentile(95)
+        return max(LLM_HEDGE_MIN_DELAY, p95) if p95 is not None else None
+
+    async def _attempt(self, provider: OpenAICompatibleProvider, prompt: Prompt,
+                       generation: Optional[GenerationParams] = None) -> LLMResponse:
+        if not provider.breaker.allow():
+            raise ProviderError(f"Circuit for provider {provider.name} is open")
+        try:
+            response = await provider.process_prompt(prompt, generation)
+        except ProviderError:
+            provider.breaker.record_failure()
+            provider_requests.inc(provider.name, "error")
+            raise
+        except asyncio.CancelledError:
+            provider.breaker.record_cancelled()
+            provider_requests.inc(provider.name, "cancelled")
+            raise
+        provider.breaker.record_success()
+        provider_requests.inc(provider.name, "ok")
+        if response.latency is not None:
+            provider.latency.record(response.latency)
+            provider_latency.observe(response.latency, provider.name)
+        return response
+
+    async def _call_with_retries(self, provider: OpenAICompatibleProvider, prompt: Prompt,
+                                 generation: Optional[GenerationParams] = None) -> LLMResponse:
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._attempt(provider, prompt, generation)
+            except ProviderError as e:
+                if not e.retryable or attempt == self.max_retries or not provider.breaker.available():
+                    raise
+                # Full jitter keeps retries from a burst of failures from synchronising
+                delay = random.uniform(0, min(LLM_BACKOFF_CAP, LLM_BACKOFF_BASE * 2 ** attempt))
+                if e.retry_after:
+                    delay = max(delay, min(e.retry_after, LLM_BACKOFF_CAP))
+                logger.warning("Retrying provider %s in %.2fs after: %s", provider.name, delay, e)
+                await asyncio.sleep(delay)
+
+    async def process_prompt(self, prompt: Prompt, provider: Optional[str] = None,
+                             generation: Optional[GenerationParams] = None) -> LLMResponse:
+        """Run a prompt, hedging slow calls and failing over to other healthy providers"""
+        candidates = self.candidates(provider)
+        if not candidates:
+            raise ProviderError("No healthy LLM providers available", retryable=False)
+
+        remaining = list(candidates)
+        pending: Dict[asyncio.Task, OpenAICompatibleProvider] = {}
+        last_error: Optional[Exception] = None
+
+        def launch(target: OpenAICompatibleProvider) -> asyncio.Task:
+            task = asyncio.create_task(self._call_with_retries(target, prompt, generation))
+            pending[task] = target
+            return task
+
+        primary = remaining.pop(0)
+        launch(primary)
+        hedged = not self.hedge
+        try:
+            while pending:
+                timeout = None if hedged else self.hedge_delay(primary)
+                done, _ = await asyncio.wait(set(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    # The same request to the same provider doubles the cost for nothing
+                    if not remaining:
+                        continue
+                    if self.admission is not None and not self.admission.try_acquire():
+                        logger.info("Not hedging slow %s request: no LLM slot free", primary.name)
+                        continue
+                    # Primary is slower than its p95: race a second provider against it
+                    backup = remaining.pop(0)
+                    hedged_requests.inc(backup.name)
+                    logger.info("Hedging %s request with %s", primary.name, backup.name)
+                    hedge = launch(backup)
+                    if self.admission is not None:
+                        # Also released if the hedge is cancelled before it starts
+                        hedge.add_done_callback(lambda _: self.admission.release())
+                    continue
+                for task in done:
+                    failed_provider = pending.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                    logger.warning("Provider %s failed: %s", failed_provider.name, last_error)
+                if not pending and remaining:
+                    # Every in-flight request failed: fail over to the next provider
+                    primary = remaining.pop(0)
+                    hedged = not self.hedge
+                    launch(primary)
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def aclose(self):
+        for provider in self.providers.values():
+            await provider.aclose()
+
+    async def probe(self) -> Dict:
+        """Probe every provider; raises only if none can serve, since requests fail over"""
+        providers = list(self.providers.values())
+
+        async def timed(provider):
+            start = time.perf_counter()
+            try:
+                await provider.probe()
+                result = {"status": "ok"}
+            except Exception as e:
+                result = {"status": "down", "error": str(e)}
+            result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            result["circuit"] = provider.breaker.state
+            return result
+
+        results = dict(zip((p.name for p in providers), await asyncio.gather(*(timed(p) for p in providers))))
+        if not any(r["status"] == "ok" and r["circuit"] != "open" for r in results.values()):
+            raise Exception("No LLM provider is usable: " + "; ".join(
+                f"{name}: {r.get('error', 'circuit open')}" for name, r in results.items()
+            ))
+        return {"providers": results}
+
+    def status(self) -> List[Dict]:
+        return [
+            {
+                "name": p.name,
+                "model": p.model,
+                "circuit": p.breaker.state,
+                "p50": p.latency.percentile(50),
+                "p95": p.latency.percentile(95),
+            }
+            for p in self.providers.values()
+        ]
+
+
+def build_router_from_env() -> ProviderRouter:
+    """Build the provider registry from DEEPSEEK_API_KEY, LLM_PROVIDERS and LLM_ENABLE_LOCAL_STUB.
+
+    LLM_PROVIDERS is a JSON list of ProviderConfig objects describing extra
+    OpenAI-compatible endpoints, e.g.
+    [{"name": "openai", "base_url": "https://api.openai.com", "model": "gpt-4o-mini",
+      "api_key_env": "OPENAI_API_KEY"}]
+    """
+    from app.services.deepseek import DeepSeekService
+
+    router = ProviderRouter()
+    if os.getenv("DEEPSEEK_API_KEY"):
+        router.register(DeepSeekService())
+    for raw in json.loads(os.getenv("LLM_PROVIDERS", "[]")):
+        config = ProviderConfig(**raw)
+        router.register(OpenAICompatibleProvider(
+            name=config.name,
+            base_url=config.base_url,
+            model=config.model,
+            api_key=os.getenv(config.api_key_env) if config.api_key_env else None,
+            timeout=config.timeout
+        ))
+    if os.getenv("LLM_ENABLE_LOCAL_STUB", "false").lower() == "true":
+        router.register(LocalStubProvider(latency=float(os.getenv("LLM_LOCAL_STUB_LATENCY", "0"))))
+    if not router.providers:
+        raise ValueError("No LLM providers configured; set DEEPSEEK_API_KEY or LLM_PROVIDERS")
+    return router
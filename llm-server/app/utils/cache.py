@@ -0,0 +1,279 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from app.utils.tracing import registry
+
+logger = logging.getLogger(__name__)
+
+# "memory://" keeps entries in this process; "sqlite:///path/to/cache.db" shares
+# them with every worker and replica that opens the same file
+CACHE_URL = os.getenv("CACHE_URL", "memory://")
+# Bound of the in-process cache, in entries
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+# Bound of the SQLite cache, in bytes of stored values
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Seconds between writes of an entry's last access time, so hits rarely take the write lock
+CACHE_TOUCH_INTERVAL = float(os.getenv("CACHE_TOUCH_INTERVAL", "60"))
+
+cache_lookups = registry.counter(
+    "cache_lookups_total", "Shared cache lookups by namespace", ("namespace", "result")
+)
+cache_evictions = registry.counter(
+    "cache_evictions_total", "Entries evicted to keep the cache within its bound"
+)
+
+Compute = Callable[[], Awaitable[Any]]
+
+
+class Cache:
+    """Namespaced key-value cache with TTLs and single-flight computation.
+
+    Values are anything json.dumps accepts; None is never stored, so a get
+    returning None is a miss. Keys only need to be unique within a namespace.
+    """
+
+    def __init__(self):
+        self._computing: Dict[Tuple[str, str], asyncio.Task] = {}
+        # Computations whose caller was cancelled while they ran
+        self._abandoned: "weakref.WeakSet[asyncio.Task]" = weakref.WeakSet()
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        """Store a value, expiring after `ttl` seconds, or only when evicted if ttl is None"""
+        raise NotImplementedError
+
+    async def delete(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    async def get_or_compute(self, namespace: str, key: str, compute: Compute, ttl: Optional[float] = None,
+                             store: Optional[Callable[[Any], bool]] = None) -> Any:
+        """The cached value, or the result of `compute()` stored under the key.
+
+        Concurrent misses for one key in this process share one computation;
+        another process sharing the cache finds the value once it is stored.
+        Errors are raised to every waiter and not cached, and neither is a
+        result `store` rejects.
+        """
+        value = await self.get(namespace, key)
+        if value is not None:
+            return value
+        flight = (namespace, key)
+        while True:
+            task = self._computing.get(flight)
+            if task is not None:
+                try:
+                    return await asyncio.shield(task)
+                except Exception:
+                    if task not in self._abandoned:
+                        raise
+                    # Its caller was cancelled and may have closed what the
+                    # computation used, such as an HTTP client; compute again
+                    continue
+            # Detached from the caller, so a caller that is cancelled (a client
+            # disconnecting, a shutdown drain) does not cancel it for the others
+            task = asyncio.ensure_future(self._compute(namespace, key, compute, ttl, store))
+            self._computing[flight] = task
+            task.add_done_callback(lambda done: self._computed(flight, done))
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                self._abandoned.add(task)
+                raise
+
+    async def _compute(self, namespace: str, key: str, compute: Compute, ttl: Optional[float],
+                       store: Optional[Callable[[Any], bool]]) -> Any:
+        value = await compute()
+        if value is not None and (store is None or store(value)):
+            await self.set(namespace, key, value, ttl)
+        return value
+
+    def _computed(self, flight: Tuple[str, str], task: asyncio.Task):
+        if self._computing.get(flight) is task:
+            del self._computing[flight]
+        if not task.cancelled():
+            # Every waiter may have gone; keep the loop from warning about an unretrieved error
+            task.exception()
+
+
+def expiry(ttl: Optional[float]) -> Optional[float]:
+    return time.time() + ttl if ttl is not None else None
+
+
+class MemoryCache(Cache):
+    """Entries in this process only, least recently used evicted past `max_entries`.
+
+    Values are returned as stored, not copied, so callers must not mutate them.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        super().__init__()
+        self.max_entries = max_entries
+        # (namespace, key) -> (expires at or None, value)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Optional[float], Any]]" = OrderedDict()
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        entry = self._entries.get((namespace, key))
+        if entry is None:
+            cache_lookups.inc(namespace, "miss")
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self._entries[(namespace, key)]
+            cache_lookups.inc(namespace, "expired")
+            return None
+        self._entries.move_to_end((namespace, key))
+        cache_lookups.inc(namespace, "hit")
+        return value
+
+    async def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        self._entries[(namespace, key)] = (expiry(ttl), value)
+        self._entries.move_to_end((namespace, key))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            cache_evictions.inc()
+
+    async def delete(self, namespace: str, key: str):
+        self._entries.pop((namespace, key), None)
+
+
+class SQLiteCache(Cache):
+    """Entries in a SQLite file, shared by every process that opens it.
+
+    Worker processes and replicas mounting the same volume on one host see
+    each other's entries. Values are stored as JSON; once they outgrow
+    `max_bytes`, expired entries and then the least recently used ones are
+    deleted down to 90% of the budget.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS cache (
+        namespace TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        expires_at REAL,
+        accessed_at REAL NOT NULL,
+        PRIMARY KEY (namespace, key)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at);
+    """
+
+    def __init__(self, path: str, max_bytes: int = CACHE_MAX_BYTES, touch_interval: float = CACHE_TOUCH_INTERVAL):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._conn: Optional[sqlite3.Connection] = None
+        # Bytes this process believes are stored; recounted before evicting,
+        # since other processes write to the same file
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(self.SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, fn, *args):
+        return await asyncio.to_thread(self._locked, fn, *args)
+
+    def _locked(self, fn, *args):
+        with self._lock:
+            return fn(self._connection(), *args)
+
+    def _get(self, conn: sqlite3.Connection, namespace: str, key: str) -> Tuple[str, Optional[str]]:
+        row = conn.execute(
+            "SELECT value, expires_at, accessed_at FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None:
+            return "miss", None
+        value, expires_at, accessed_at = row
+        now = time.time()
+        if expires_at is not None and expires_at <= now:
+            conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+            return "expired", None
+        if now - accessed_at >= self.touch_interval:
+            conn.execute("UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?", (now, namespace, key))
+        return "hit", value
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        result, value = await self._run(self._get, namespace, key)
+        cache_lookups.inc(namespace, result)
+        return json.loads(value) if value is not None else None
+
+    def _set(self, conn: sqlite3.Connection, namespace: str, key: str, value: str, expires_at: Optional[float]):
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, size, expires_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (namespace, key, value, len(value), expires_at, time.time())
+        )
+        if self._size is None:
+            self._size = self._stored_bytes(conn)
+        else:
+            self._size += len(value)
+        if self._size > self.max_bytes:
+            self._size = self._stored_bytes(conn)
+            if self._size > self.max_bytes:
+                self._evict(conn)
+
+    @staticmethod
+    def _stored_bytes(conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def _evict(self, conn: sqlite3.Connection):
+        # Down to 90% of the budget, so eviction does not run on every write
+        target = self.max_bytes * 0.9
+        evicted = conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),)).rowcount
+        self._size = self._stored_bytes(conn)
+        rows = conn.execute("SELECT namespace, key, size FROM cache ORDER BY accessed_at").fetchall()
+        oldest = []
+        for namespace, key, size in rows:
+            if self._size <= target:
+                break
+            oldest.append((namespace, key))
+            self._size -= size
+        conn.executemany("DELETE FROM cache WHERE namespace = ? AND key = ?", oldest)
+        cache_evictions.inc(amount=evicted + len(oldest))
+        logger.info("Evicted %d cache entries down to %d bytes in %s", evicted + len(oldest), self._size, self.path)
+
+    async def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        await self._run(self._set, namespace, key, json.dumps(value), expiry(ttl))
+
+    async def delete(self, namespace: str, key: str):
+        await self._run(lambda conn: conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?",
+                                                  (namespace, key)))
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(lambda conn: conn.close())
+            self._conn = None
+
+
+def create_cache(url: str = CACHE_URL) -> Cache:
+    """A cache for CACHE_URL: "memory://" or "sqlite:///path/to/cache.db" """
+    if url == "memory://":
+        return MemoryCache()
+    if url.startswith("sqlite:///"):
+        return SQLiteCache(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported CACHE_URL: {url}")
@@ -1,6 +1,8 @@
-def create_pr_review_prompt(pr_info: dict, changes: dict) -> str:
-    """Create a structured prompt that will generate parseable responses"""
-    # First, create a list of valid line numbers for each file
+from typing import Dict, List
+
+
+def extract_line_numbers(changes: dict) -> Dict[str, List[int]]:
+    """Map each changed file to the line numbers the model may comment on"""
     file_line_numbers = {}
     for file in changes['changed_files']:
         if file['patch']:
@@ -18,6 +20,17 @@ def create_pr_review_prompt(pr_info: dict, changes: dict) -> str:
                         lines.append(current_line)
                         current_line += 1
             file_line_numbers[file['filename']] = sorted(set(lines))
+    return file_line_numbers
+
+
+def create_pr_review_prompt(pr_info: dict, changes: dict) -> str:
+    """Create a structured prompt that will generate parseable responses.
+
+    Single-message layout with PR data interleaved in the instructions; the
+    services use the cache-friendly system/user split in app.utils.prompts.
+    """
+    # First, create a list of valid line numbers for each file
+    file_line_numbers = extract_line_numbers(changes)
     
     # Create a summary of available line numbers for each file
     line_number_summary = "\n".join([
@@ -87,4 +100,5 @@ Please provide a detailed review focusing on:
 
 Remember: Your comments will be rejected if they reference line numbers that are not shown in the diff.
 """
-    return prompt
\ No newline at end of file
+    return prompt
+
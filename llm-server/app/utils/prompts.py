@@ -0,0 +1,231 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from app.utils.general import extract_line_numbers
+
+logger = logging.getLogger(__name__)
+
+# Directory with per-repo overrides: <dir>/<owner>/<repo>/system.txt replaces the
+# system prompt, <dir>/<owner>/<repo>/guidelines.txt is appended to it
+PROMPT_TEMPLATE_DIR = os.getenv("PROMPT_TEMPLATE_DIR")
+
+# Static review instructions. Kept byte-identical across requests and placed
+# first, so providers with prompt prefix caching (DeepSeek, OpenAI) can reuse
+# it; everything PR-specific goes in the user message after it.
+REVIEW_SYSTEM_PROMPT = """You review pull requests and provide specific comments in the following format:
+
+For each issue or suggestion, use this structure:
+[filename.ext]:<line_number>
+Your comment about the code
+```suggestion
+Your suggested code change (if applicable)
+```
+
+CRITICAL INSTRUCTIONS:
+1. You MUST use EXACT line numbers from the provided diff only. The available line numbers for each file are listed with the pull request.
+
+2. DO NOT comment on line 1 of any file unless it is explicitly shown in the diff with a + or - prefix.
+
+3. Only comment on lines that are shown in the diff with + or - prefixes.
+
+4. The line numbers in your comments MUST match exactly with the line numbers shown in the diff.
+
+5. If you want to comment on multiple lines, use a range like this: [filename.ext]:start-end
+   For example: [main.py]:13-21
+   The parser will automatically use the first line number (13 in this case).
+
+For example, if you see this in the diff:
+@@ -15,3 +15,4 @@
+  def some_function():
+      print("Hello")
++     print("World")  # This is on line 18
+      return True
+
+You can comment on line 18 like this:
+[main.py]:18
+Consider adding a docstring to explain the function's purpose
+```suggestion
+def some_function():
+    Prints a greeting and returns True.
+    print("Hello")
+    print("World")
+    return True
+```
+
+Please provide a detailed review focusing on:
+1. Code quality and best practices
+2. Potential bugs or issues
+3. Performance considerations
+4. Specific suggestions for improvement
+
+Remember: Your comments will be rejected if they reference line numbers that are not shown in the diff."""
+
+PR_SECTION_TEMPLATE = """PR Details:
+Title: {title}
+Author: {author}
+Branch: {head_branch} → {base_branch}
+
+Available line numbers for each file:
+{line_number_summary}
+
+Changes to review:
+{files_with_changes}"""
+
+BATCH_MARKER = "=== PR {key} ==="
+
+BATCH_PREAMBLE = """You are reviewing {count} independent pull requests. Review each one separately.
+Begin the review of each pull request with a line containing only its marker ({markers}),
+write every comment for that pull request below its marker, and use only the line numbers
+listed for that same pull request."""
+
+
+def repo_from_pr_url(pr_url: Optional[str]) -> Optional[str]:
+    """Extract "owner/repo" from an API PR URL such as https://api.github.com/repos/o/r/pulls/1"""
+    if not pr_url:
+        return None
+    parts = pr_url.rstrip('/').split('/')
+    try:
+        index = parts.index('repos')
+        return f"{parts[index + 1]}/{parts[index + 2]}"
+    except (ValueError, IndexError):
+        return None
+
+
+def render_file_changes(f: dict) -> str:
+    """One file's patch, followed by its enclosing definitions when remote-repo-server sent them"""
+    text = f"File: {f['filename']}\nChanges:\n{f['patch']}\n"
+    if f.get('context'):
+        text += f"Enclosing code (reference only; comment on changed lines):\n{f['context']}\n"
+    return text
+
+
+def render_pr_section(pr_info: dict, changes: dict) -> str:
+    """The PR-specific part of a review prompt"""
+    line_number_summary = "\n".join([
+        f"File: {filename}\nAvailable line numbers: {', '.join(map(str, lines))}"
+        for filename, lines in extract_line_numbers(changes).items()
+    ])
+    files_with_changes = "\n".join([
+        render_file_changes(f) for f in changes['changed_files'] if f['patch']
+    ])
+    return PR_SECTION_TEMPLATE.format(
+        title=pr_info['title'],
+        author=pr_info['author'],
+        head_branch=pr_info['head_branch'],
+        base_branch=pr_info['base_branch'],
+        line_number_summary=line_number_summary,
+        files_with_changes=files_with_changes
+    )
+
+
+class PromptTemplates:
+    """Compiled system prompts, with per-repo overrides loaded once and cached"""
+
+    def __init__(self, template_dir: Optional[str] = PROMPT_TEMPLATE_DIR,
+                 default_system_prompt: str = REVIEW_SYSTEM_PROMPT):
+        self.template_dir = template_dir
+        self.default_system_prompt = default_system_prompt
+        self._system_prompts: Dict[str, str] = {}
+
+    def _read(self, repo: str, name: str) -> Optional[str]:
+        path = os.path.join(self.template_dir, *repo.split('/'), name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return f.read().strip()
+
+    def system_prompt(self, repo: Optional[str] = None) -> str:
+        if not repo or not self.template_dir:
+            return self.default_system_prompt
+        cached = self._system_prompts.get(repo)
+        if cached is None:
+            system = self._read(repo, "system.txt") or self.default_system_prompt
+            guidelines = self._read(repo, "guidelines.txt")
+            if guidelines:
+                # Appended rather than prepended so the shared prefix stays cacheable
+                system = f"{system}\n\nRepository-specific review guidelines:\n{guidelines}"
+            cached = self._system_prompts[repo] = system
+            logger.info("Loaded prompt template for %s", repo)
+        return cached
+
+    def review_messages(self, pr_info: dict, changes: dict, repo: Optional[str] = None,
+                        instructions: str = "") -> List[Dict]:
+        """System + user messages reviewing a single PR.
+
+        `instructions` are the generation profile's output rules; they go last
+        so every profile shares the cached system prompt.
+        """
+        user = "Please review this pull request.\n\n" + render_pr_section(pr_info, changes)
+        if instructions:
+            user += f"\n\n{instructions}"
+        return [
+            {"role": "system", "content": self.system_prompt(repo)},
+            {"role": "user", "content": user},
+        ]
+
+    def batch_review_messages(self, jobs: List[Tuple[str, dict, dict]], repo: Optional[str] = None) -> List[Dict]:
+        """System + user messages reviewing several PRs at once.
+
+        `jobs` holds (key, pr_info, changes) tuples; the model is asked to start
+        each PR's review with its marker line so the output can be split per PR.
+        """
+        markers = ", ".join(BATCH_MARKER.format(key=key) for key, _, _ in jobs)
+        sections = "\n\n".join(
+            f"{BATCH_MARKER.format(key=key)}\n{render_pr_section(pr_info, changes)}"
+            for key, pr_info, changes in jobs
+        )
+        preamble = BATCH_PREAMBLE.format(count=len(jobs), markers=markers)
+        return [
+            {"role": "system", "content": self.system_prompt(repo)},
+            {"role": "user", "content": f"{preamble}\n\n{sections}"},
+        ]
+
+
+def prompt_hash(provider: str, messages: List[Dict], sampling: Optional[Dict] = None) -> str:
+    """Stable identity of a review prompt, used to find stored reviews of an identical one.
+
+    `sampling` holds the profile name and generation parameters: the same
+    messages sampled with another temperature or token budget are a different review.
+    """
+    digest = hashlib.sha256(provider.encode("utf-8"))
+    digest.update(json.dumps(messages, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    if sampling:
+        digest.update(json.dumps(sampling, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def patch_bytes(changes: dict) -> int:
+    """Size of the diff and context text a prompt is built from"""
+    return sum(len(f.get('patch') or '') + len(f.get('context') or '') for f in changes.get('changed_files', []))
+
+
+def build_review_prompt(provider: str, pr_info: dict, changes: dict, repo: Optional[str] = None,
+                        instructions: str = "", sampling: Optional[Dict] = None) -> Tuple[List[Dict], str]:
+    """Review messages for one PR and their prompt hash.
+
+    Module-level so it can run in a worker process for very large diffs.
+    """
+    messages = templates.review_messages(pr_info, changes, repo=repo, instructions=instructions)
+    return messages, prompt_hash(provider, messages, sampling)
+
+
+def split_batch_review(review_text: str, keys: List[str]) -> Dict[str, str]:
+    """Split a batched review back into per-PR text using the marker lines"""
+    markers = {BATCH_MARKER.format(key=key): key for key in keys}
+    sections: Dict[str, List[str]] = {}
+    current = None
+    for line in review_text.split('\n'):
+        stripped = line.strip()
+        if stripped in markers:
+            current = markers[stripped]
+            sections.setdefault(current, [])
+            continue
+        if current is not None:
+            sections[current].append(line)
+    return {key: '\n'.join(lines).strip() for key, lines in sections.items()}
+
+
+templates = PromptTemplates()
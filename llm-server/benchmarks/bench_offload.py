@@ -0,0 +1,81 @@
+"""Benchmark event-loop responsiveness while building a prompt for a huge diff.
+
+Run from the llm-server directory:
+
+    python -m benchmarks.bench_offload [--mb 20] [--files 200]
+
+A ticker task sleeps 10 ms at a time and records how late it wakes up while
+the prompt is built inline, in a thread pool and in a process pool.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils import offload  # noqa: E402
+from app.utils.prompts import build_review_prompt, patch_bytes  # noqa: E402
+
+TICK = 0.01
+
+
+def make_changes(megabytes: float, files: int):
+    lines_per_file = int(megabytes * 1024 * 1024 / files / 40)
+    changed_files = []
+    for i in range(files):
+        added = "\n".join(f"+    value_{j} = compute(value_{j - 1}, {i})" for j in range(1, lines_per_file))
+        changed_files.append({
+            "filename": f"pkg/module_{i}.py",
+            "patch": f"@@ -1,1 +1,{lines_per_file} @@\n def handler():\n{added}",
+        })
+    return {"changed_files": changed_files, "additions": lines_per_file * files, "deletions": 0}
+
+
+async def measure(mode: str, pr_info, changes):
+    offload.OFFLOAD_EXECUTOR = mode
+    offload.OFFLOAD_MIN_BYTES = 0
+    offload.shutdown_executor()
+    if offload.get_executor() is not None:
+        # Warm the pool so worker start-up is not counted
+        await offload.run_cpu_bound(len, "warm-up", size=1)
+
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        loop = asyncio.get_running_loop()
+        while not done.is_set():
+            start = loop.time()
+            await asyncio.sleep(TICK)
+            lags.append(loop.time() - start - TICK)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(TICK * 3)
+    start = time.perf_counter()
+    await offload.run_cpu_bound(build_review_prompt, "deepseek", pr_info, changes, None, size=patch_bytes(changes))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await task
+    offload.shutdown_executor()
+    return elapsed, max(lags)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mb", type=float, default=20)
+    parser.add_argument("--files", type=int, default=200)
+    args = parser.parse_args()
+    changes = make_changes(args.mb, args.files)
+    pr_info = {"title": "Huge PR", "author": "dev", "head_branch": "feature", "base_branch": "main"}
+
+    print(f"Diff: {patch_bytes(changes) / 1024 / 1024:.1f} MB in {args.files} files")
+    print(f"{'mode':<10}{'build s':>10}{'max loop lag ms':>18}")
+    for mode in ("inline", "thread", "process"):
+        elapsed, lag = await measure(mode, pr_info, changes)
+        print(f"{mode:<10}{elapsed:>10.3f}{lag * 1000:>18.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,90 +1,259 @@
 import os
+from dotenv import load_dotenv
+
+# Load environment variables before the app modules read their settings
+load_dotenv()
+
 from fastapi import FastAPI, HTTPException, Response
 from app.models.deepseek import PromptRequest, LLMReviewData
-from app.services.deepseek import DeepSeekService
-from app.utils.general import create_pr_review_prompt
+from app.models.llm import GenerationParams, GenerationProfile, LLMResponse
+from app.services.admission import AdmissionController, QueueFullError
+from app.services.batching import LLM_BATCHING_ENABLED, ReviewBatcher
+from app.services.generation import UnknownProfileError, finish_review, generation_profiles, output_instructions
+from app.services.providers import Prompt, ProviderRouter, build_router_from_env
+from app.utils.cache import create_cache
+from app.utils.offload import run_cpu_bound, shutdown_executor
+from app.utils.prompts import build_review_prompt, patch_bytes, repo_from_pr_url
+from app.utils.health import ReadinessCheck, add_health_routes, probe_url
+from app.utils.log import SAMPLED, setup_logging
+from app.utils.tracing import instrument_app, span, trace_headers
 import httpx
 import logging
-from dotenv import load_dotenv
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+setup_logging("llm-server")
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-
 REMOTE_REPO_SERVER_URL = os.getenv("REMOTE_REPO_SERVER_URL")
+# Look up remote-repo-server's review store before paying for an identical prompt
+REVIEW_CACHE_ENABLED = os.getenv("REVIEW_CACHE_ENABLED", "true").lower() == "true"
+# Seconds a generated review is kept in the shared cache, keyed by prompt hash; 0 disables
+REVIEW_MEMO_TTL = float(os.getenv("REVIEW_MEMO_TTL", "86400"))
+REVIEW_NAMESPACE = "review"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Uvicorn has finished or timed out the in-flight reviews by now
+    await batcher.close()
+    if _llm_router is not None:
+        await _llm_router.aclose()
+    await cache.close()
+    shutdown_executor()
 
 app = FastAPI(title="AI Code Review API", 
-              description="API for code review using various AI models")
+              description="API for code review using various AI models",
+              lifespan=lifespan)
+instrument_app(app, "llm-server")
 
-deepseek_service = DeepSeekService()
+_llm_router: Optional[ProviderRouter] = None
 
-@app.post("/process-prompt/deepseek")
-async def process_prompt_deepseek(request: PromptRequest):
-    """
-    Receives a prompt as a string and forwards it to the DeepSeek API
-    """
+def get_router() -> ProviderRouter:
+    """Provider registry, built on first use rather than at import"""
+    global _llm_router
+    if _llm_router is None:
+        _llm_router = build_router_from_env()
+        _llm_router.admission = admission
+    return _llm_router
+
+admission = AdmissionController()
+cache = create_cache()
+
+async def run_prompt(prompt: Prompt, provider: str, size: int,
+                     generation: Optional[GenerationParams] = None) -> LLMResponse:
+    """Run one prompt through admission control and the provider router"""
+    async with admission.slot(size=size):
+        with span("llm_call", provider=provider) as attributes:
+            response = await get_router().process_prompt(prompt, provider=provider, generation=generation)
+            attributes["served_by"] = response.provider
+            attributes["completion_tokens"] = response.completion_tokens
+    return response
+
+batcher = ReviewBatcher(run_prompt)
+
+async def check_providers():
+    return await get_router().probe()
+
+readiness = ReadinessCheck()
+readiness.add("llm_providers", check_providers)
+if REMOTE_REPO_SERVER_URL:
+    # Only the review cache and the legacy forward path use it; the event
+    # pipeline posts reviews itself, so it does not fail readiness
+    readiness.add("remote_repo_server", lambda: probe_url(f"{REMOTE_REPO_SERVER_URL}/health/live"), critical=False)
+add_health_routes(app, readiness)
+
+async def find_cached_review(review_hash: str) -> Optional[str]:
+    """Stored output for an identical prompt, or None on a miss or lookup failure"""
+    if not REVIEW_CACHE_ENABLED or not REMOTE_REPO_SERVER_URL:
+        return None
     try:
-        logger.info("=== Starting DeepSeek request processing ===")
+        async with httpx.AsyncClient(timeout=2.0) as client:
+            with span("cache_lookup") as attributes:
+                response = await client.get(
+                    f"{REMOTE_REPO_SERVER_URL}/reviews/cache/{review_hash}",
+                    headers=trace_headers()
+                )
+                attributes["hit"] = response.status_code == 200
+    except httpx.HTTPError as e:
+        logger.warning("Review cache lookup failed: %s", e)
+        return None
+    if response.status_code != 200:
+        return None
+    return response.json()["generated_text"]
 
-        # Create the prompt
+async def generate_review(provider: str, request: PromptRequest, repo: Optional[str], profile: GenerationProfile,
+                          generation: GenerationParams, prompt: Prompt, review_hash: str) -> Tuple[str, Optional[Dict]]:
+    """(review text, token usage) for a prompt, from the review store, a batch or the provider"""
+    # Token usage of this request's own LLM call; None for stored and batched reviews
+    usage = None
+    # An identical prompt was already reviewed; reuse the stored output
+    generated_text = await find_cached_review(review_hash)
+    if generated_text is not None:
+        logger.info("Reusing stored review for prompt %s", review_hash[:12])
+    # Small PRs share one batched LLM request when batching is enabled
+    elif LLM_BATCHING_ENABLED and ReviewBatcher.is_small(request.content) and ReviewBatcher.accepts(generation):
         try:
-            prompt = create_pr_review_prompt(changes=request.content, pr_info=request.pr_info)
-            logger.info("Prompt created successfully")
+            with span("batched_review"):
+                generated_text = await batcher.submit(provider, request.pr_info, request.content, repo, generation)
+        except QueueFullError:
+            raise
         except Exception as e:
-            logger.error(f"Error creating prompt: {str(e)}", exc_info=True)
+            logger.error("Error in batched LLM processing: %s", e, exc_info=True)
             raise
-            
-        # Process through DeepSeek
+    else:
+        # Process through the provider router
         try:
-            logger.info("Processing prompt through DeepSeek...")
-            response = await deepseek_service.process_prompt(prompt=prompt)
-            logger.info("DeepSeek processing completed successfully")
+            logger.info("Processing prompt through %s...", provider, extra=SAMPLED)
+            pr_size = request.content.get("additions", 0) + request.content.get("deletions", 0)
+            response = await run_prompt(prompt, provider, pr_size, generation)
+            generated_text = finish_review(profile, response.generated_text)
+            usage = {
+                "prompt_tokens": response.prompt_tokens,
+                "completion_tokens": response.completion_tokens,
+                "cached_tokens": response.cached_tokens,
+                "finish_reason": response.finish_reason,
+            }
+            logger.info(
+                "LLM processing completed successfully by %s", response.provider,
+                extra={"profile": profile.name, "max_tokens": generation.max_tokens, **usage}
+            )
+            if response.finish_reason == "length":
+                logger.warning("Review for %s was cut off at %d tokens", request.pr_url, generation.max_tokens)
+        except QueueFullError:
+            raise
         except Exception as e:
-            logger.error(f"Error in DeepSeek processing: {str(e)}", exc_info=True)
+            logger.error("Error in LLM processing: %s", e, exc_info=True)
             raise
+    return generated_text, usage
+
+@app.post("/process-prompt/{provider}")
+async def process_prompt(provider: str, request: PromptRequest):
+    """
+    Receives PR changes, builds the review prompt and runs it through the
+    requested provider, failing over to other healthy providers if needed
+    """
+    if get_router().get(provider) is None:
+        raise HTTPException(status_code=404, detail=f"Unknown LLM provider: {provider}")
+    repo = repo_from_pr_url(request.pr_url)
+    try:
+        profile = generation_profiles.resolve(request.generation, repo)
+    except (UnknownProfileError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    generation = generation_profiles.params(profile, request.content)
+    try:
+        logger.info("=== Starting %s request processing ===", provider, extra=SAMPLED)
+
+        # Create the prompt
+        try:
+            with span("build_prompt"):
+                prompt, review_hash = await run_cpu_bound(
+                    build_review_prompt, provider, request.pr_info, request.content, repo,
+                    output_instructions(profile), {"profile": profile.name, **generation.dict()},
+                    size=patch_bytes(request.content)
+                )
+            logger.info("Prompt created successfully", extra=SAMPLED)
+        except Exception as e:
+            logger.error("Error creating prompt: %s", e, exc_info=True)
+            raise
+
+        if REVIEW_MEMO_TTL > 0:
+            # Tokens are only reported by the request that spent them
+            usage = None
+
+            async def generate() -> str:
+                nonlocal usage
+                text, usage = await generate_review(provider, request, repo, profile, generation, prompt, review_hash)
+                return text
+
+            # Deliveries of the same PR revision, here or on another replica, share one review
+            generated_text = await cache.get_or_compute(REVIEW_NAMESPACE, review_hash, generate, ttl=REVIEW_MEMO_TTL)
+        else:
+            generated_text, usage = await generate_review(
+                provider, request, repo, profile, generation, prompt, review_hash
+            )
+        
+        if not request.forward:
+            logger.info("Request processing completed successfully", extra=SAMPLED)
+            return {"pr_url": request.pr_url, "generated_text": generated_text, "prompt_hash": review_hash,
+                    "profile": profile.name, "usage": usage}
         
         # If PR URL is provided, forward to remote-repo-server
         if request.pr_url:
             try:
-                logger.info(f"Forwarding review to remote-repo-server for PR: {request.pr_url}")
+                logger.info("Forwarding review to remote-repo-server for PR: %s", request.pr_url)
                 async with httpx.AsyncClient() as client:
                     review_data = LLMReviewData(
                         pr_url=request.pr_url,
-                        generated_text=response.generated_text
+                        generated_text=generated_text,
+                        head_sha=request.pr_info.get("head_sha"),
+                        prompt_hash=review_hash
                     )
                     
-                    forward_response = await client.post(
-                        REMOTE_REPO_SERVER_URL + "/reviews/create",
-                        json=review_data.dict()
-                    )
-                    logger.info(f"Remote-repo-server response: {forward_response.status_code}")
+                    with span("forward_review"):
+                        forward_response = await client.post(
+                            REMOTE_REPO_SERVER_URL + "/reviews/create",
+                            json=review_data.dict(),
+                            headers=trace_headers()
+                        )
+                    logger.info("Remote-repo-server response: %s", forward_response.status_code)
                     if forward_response.status_code != 200:
-                        logger.error(f"Remote-repo-server error: {forward_response.text}")
+                        logger.error("Remote-repo-server error: %s", forward_response.text)
             except Exception as e:
-                logger.error(f"Error forwarding to remote-repo-server: {str(e)}", exc_info=True)
+                logger.error("Error forwarding to remote-repo-server: %s", e, exc_info=True)
                 # Don't raise the error, just log it since the main processing succeeded
         
-        logger.info("Request processing completed successfully")
+        logger.info("Request processing completed successfully", extra=SAMPLED)
         return Response(status_code=200)
         
+    except QueueFullError as e:
+        logger.warning("Shedding request for PR %s: %s", request.pr_url, e)
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except Exception as e:
-        logger.error(f"Error processing request: {str(e)}", exc_info=True)
+        logger.error("Error processing request: %s", e, exc_info=True)
         raise HTTPException(
             status_code=500,
             detail=str(e)
         )
 
+@app.get("/providers")
+async def list_providers():
+    """Registered providers with circuit state and recent latency"""
+    return get_router().status()
+
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
+    """Liveness check; /health/ready also probes the LLM providers"""
     return Response(status_code=200)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8001, reload=True) 
+    uvicorn.run("main:app", host="0.0.0.0", port=8001, reload=os.getenv("UVICORN_RELOAD", "false").lower() == "true")
     
     # To start the server, run:
     # uvicorn main:app --host 0.0.0.0 --port 8001 --reload
\ No newline at end of file
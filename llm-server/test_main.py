@@ -0,0 +1,461 @@
+import asyncio
+import json
+import os
+
+os.environ.setdefault("DEEPSEEK_API_KEY", "test-key")
+# Tests reuse one prompt; test_identical_prompts_share_one_review turns memoization on
+os.environ.setdefault("REVIEW_MEMO_TTL", "0")
+
+from fastapi.testclient import TestClient
+from app.models.llm import GenerationParams, LLMResponse
+from app.services.admission import AdmissionController, QueueFullError
+from app.services.batching import ReviewBatcher
+from app.services.providers import LocalStubProvider, ProviderError, ProviderRouter, parse_retry_after
+import main
+
+client = TestClient(main.app)
+
+PROMPT_REQUEST = {
+    "content": {
+        "additions": 1,
+        "deletions": 0,
+        "changed_files": [{"filename": "app.py", "patch": "@@ -1,1 +1,2 @@\n context\n+added"}],
+    },
+    "pr_url": "",
+    "pr_info": {"title": "Test PR", "author": "tester", "head_branch": "feature", "base_branch": "main"},
+}
+
+
+def test_process_prompt(monkeypatch):
+    async def fake_process_prompt(prompt: str, generation=None):
+        return LLMResponse(generated_text="[app.py]:2\nLooks good", provider="deepseek", latency=0.1)
+
+    monkeypatch.setattr(main.get_router().get("deepseek"), "process_prompt", fake_process_prompt)
+    response = client.post("/process-prompt/deepseek", json=PROMPT_REQUEST)
+    assert response.status_code == 200, response.text
+
+
+def test_process_prompt_without_forwarding_returns_review(monkeypatch):
+    async def fake_process_prompt(prompt, generation=None):
+        return LLMResponse(generated_text="[app.py]:2\nLooks good", provider="deepseek", latency=0.1)
+
+    monkeypatch.setattr(main.get_router().get("deepseek"), "process_prompt", fake_process_prompt)
+    request = {**PROMPT_REQUEST, "pr_url": "https://api.github.com/repos/o/r/pulls/1", "forward": False}
+    response = client.post("/process-prompt/deepseek", json=request)
+    assert response.status_code == 200, response.text
+    assert response.json()["generated_text"] == "[app.py]:2\nLooks good"
+
+
+def test_generation_profile_sets_request_parameters_and_reports_usage():
+    import httpx
+    from app.services.generation import REVIEW_END_MARKER, generation_profiles
+    from app.services.providers import OpenAICompatibleProvider
+
+    sent = []
+
+    def handler(request):
+        sent.append(json.loads(request.content))
+        return httpx.Response(200, json={
+            "choices": [{"message": {"content": "[app.py]:2\nLooks good"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 900, "completion_tokens": 40, "prompt_cache_hit_tokens": 768},
+        })
+
+    provider = OpenAICompatibleProvider("deepseek", "https://llm.test", "deepseek-coder")
+    provider._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    profile = generation_profiles.resolve({"profile": "quick", "models": {"deepseek": "deepseek-chat"}})
+    generation = generation_profiles.params(profile, PROMPT_REQUEST["content"])
+    response = asyncio.run(provider.process_prompt("prompt", generation))
+
+    # One changed line in one file: well under the profile's cap
+    assert sent[0]["max_tokens"] == 300 + 6 + 120
+    assert sent[0]["stop"] == [REVIEW_END_MARKER]
+    assert sent[0]["model"] == "deepseek-chat" and sent[0]["temperature"] == 0.3
+    assert (response.prompt_tokens, response.completion_tokens, response.cached_tokens) == (900, 40, 768)
+    assert response.finish_reason == "stop"
+
+
+def test_json_mode_review_is_converted_and_truncated_output_salvaged(monkeypatch):
+    # Cut off by max_tokens in the middle of the third comment
+    reply = ('{"comments": [{"file": "app.py", "line": 2, "message": "Name this", "suggestion": "added_one = 1"}, '
+             '{"file": "app.py", "line": 2, "message": "Add a test", "suggestion": null}, {"file": "app.py", "li')
+
+    async def fake_process_prompt(prompt, generation=None):
+        assert generation.json_mode and "single JSON object" in prompt[-1]["content"]
+        return LLMResponse(generated_text=reply, provider="deepseek", latency=0.1,
+                           prompt_tokens=500, completion_tokens=60, finish_reason="length")
+
+    monkeypatch.setattr(main.get_router().get("deepseek"), "process_prompt", fake_process_prompt)
+    request = {**PROMPT_REQUEST, "forward": False, "generation": {"profile": "default", "json_mode": True}}
+    response = client.post("/process-prompt/deepseek", json=request)
+    assert response.status_code == 200, response.text
+    assert response.json()["generated_text"] == (
+        "[app.py]:2\nName this\n```suggestion\nadded_one = 1\n```\n\n[app.py]:2\nAdd a test"
+    )
+    assert response.json()["usage"]["completion_tokens"] == 60
+
+    unknown = client.post("/process-prompt/deepseek", json={**request, "generation": {"profile": "nope"}})
+    assert unknown.status_code == 400, unknown.text
+
+
+def test_prompt_hash_depends_on_the_generation_profile(monkeypatch):
+    async def fake_process_prompt(prompt, generation=None):
+        return LLMResponse(generated_text="[app.py]:2\nLooks good", provider="deepseek", latency=0.1)
+
+    monkeypatch.setattr(main.get_router().get("deepseek"), "process_prompt", fake_process_prompt)
+    hashes = set()
+    # Same messages for both profiles, sampled with different temperature and max_tokens
+    for profile in ("default", "thorough"):
+        request = {**PROMPT_REQUEST, "forward": False, "generation": {"profile": profile}}
+        response = client.post("/process-prompt/deepseek", json=request)
+        assert response.status_code == 200, response.text
+        hashes.add(response.json()["prompt_hash"])
+    assert len(hashes) == 2
+
+
+def test_stored_review_skips_the_llm(monkeypatch):
+    async def cached(review_hash):
+        return "[app.py]:2\nFrom the store"
+
+    async def fail(prompt, generation=None):
+        raise AssertionError("LLM should not be called")
+
+    monkeypatch.setattr(main, "find_cached_review", cached)
+    monkeypatch.setattr(main.get_router().get("deepseek"), "process_prompt", fail)
+    response = client.post("/process-prompt/deepseek", json={**PROMPT_REQUEST, "forward": False})
+    assert response.status_code == 200, response.text
+    assert response.json()["generated_text"] == "[app.py]:2\nFrom the store"
+    assert len(response.json()["prompt_hash"]) == 64
+
+
+def test_identical_prompts_share_one_review(monkeypatch):
+    from app.utils.cache import MemoryCache
+
+    calls = []
+
+    async def slow_review(prompt, generation=None):
+        calls.append(prompt)
+        await asyncio.sleep(0.05)
+        return LLMResponse(generated_text="[app.py]:2\nOnce", provider="deepseek", latency=0.05,
+                           prompt_tokens=300, completion_tokens=10)
+
+    async def no_stored_review(review_hash):
+        return None
+
+    monkeypatch.setattr(main, "REVIEW_MEMO_TTL", 3600)
+    monkeypatch.setattr(main, "cache", MemoryCache())
+    monkeypatch.setattr(main, "LLM_BATCHING_ENABLED", False)
+    monkeypatch.setattr(main, "find_cached_review", no_stored_review)
+    monkeypatch.setattr(main.get_router().get("deepseek"), "process_prompt", slow_review)
+
+    async def deliver_three_times():
+        # Concurrent deliveries of one PR revision
+        return await asyncio.gather(*(
+            main.process_prompt("deepseek", main.PromptRequest(**{**PROMPT_REQUEST, "forward": False}))
+            for _ in range(3)
+        ))
+
+    results = asyncio.run(deliver_three_times())
+    assert len(calls) == 1
+    assert [r["generated_text"] for r in results] == ["[app.py]:2\nOnce"] * 3
+    assert sorted(r["usage"] is None for r in results) == [False, True, True]
+
+    response = client.post("/process-prompt/deepseek", json={**PROMPT_REQUEST, "forward": False})
+    assert response.json()["generated_text"] == "[app.py]:2\nOnce" and response.json()["usage"] is None
+    assert len(calls) == 1
+
+
+def test_queue_full_returns_503_with_retry_after(monkeypatch):
+    monkeypatch.setattr(main, "admission", AdmissionController(max_concurrency=0, max_queue=0))
+    response = client.post("/process-prompt/deepseek", json=PROMPT_REQUEST)
+    assert response.status_code == 503, response.text
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_admission_prefers_small_requests():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1, max_queue=10)
+        order = []
+
+        async def job(name: str, size: int):
+            async with admission.slot(size=size):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        async with admission.slot():
+            tasks = [asyncio.create_task(job("large", 5000)), asyncio.create_task(job("small", 10))]
+            await asyncio.sleep(0.01)
+            assert admission.depth == 2
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["small", "large"]
+
+
+def test_admission_sheds_when_queue_full():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1, max_queue=1)
+        async with admission.slot():
+            waiter = asyncio.create_task(admission.slot().__aenter__())
+            await asyncio.sleep(0)
+            try:
+                async with admission.slot():
+                    pass
+            except QueueFullError as e:
+                waiter.cancel()
+                return e.retry_after
+
+    assert asyncio.run(scenario()) >= 1
+
+
+def test_unknown_provider_returns_404():
+    response = client.post("/process-prompt/nope", json=PROMPT_REQUEST)
+    assert response.status_code == 404, response.text
+
+
+class FlakyProvider(LocalStubProvider):
+    def __init__(self, name, failures=0, latency=0.0):
+        super().__init__(name=name, latency=latency)
+        self.failures = failures
+        self.calls = 0
+
+    async def process_prompt(self, prompt, generation=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ProviderError(f"{self.name} unavailable")
+        return await super().process_prompt(prompt, generation)
+
+
+def test_router_retries_then_fails_over(monkeypatch):
+    monkeypatch.setattr("app.services.providers.LLM_BACKOFF_BASE", 0.001)
+    broken = FlakyProvider("broken", failures=100)
+    healthy = FlakyProvider("healthy")
+    router = ProviderRouter([broken, healthy], max_retries=1, hedge=False)
+
+    response = asyncio.run(router.process_prompt("prompt", provider="broken"))
+    assert response.provider == "healthy"
+    assert broken.calls == 2
+
+
+def slow_provider_with_history():
+    slow = FlakyProvider("slow", latency=1.0)
+    for _ in range(5):
+        slow.latency.record(0.01)
+    return slow
+
+
+def test_router_hedges_slow_primary(monkeypatch):
+    monkeypatch.setattr("app.services.providers.LLM_HEDGE_MIN_DELAY", 0.01)
+    slow = slow_provider_with_history()
+    fast = FlakyProvider("fast", latency=0.01)
+    router = ProviderRouter([slow, fast], hedge=True, admission=AdmissionController(max_concurrency=2))
+
+    response = asyncio.run(router.process_prompt("prompt", provider="slow"))
+    assert response.provider == "fast"
+    assert router.admission._active == 0
+
+
+def test_router_does_not_hedge_without_a_second_provider_or_slot(monkeypatch):
+    monkeypatch.setattr("app.services.providers.LLM_HEDGE_MIN_DELAY", 0.01)
+
+    async def served_by(router):
+        return (await asyncio.wait_for(router.process_prompt("prompt", provider="slow"), 0.5)).provider
+
+    # Without latency history there is no p95 to hedge at
+    fresh = FlakyProvider("slow", latency=0.1)
+    router = ProviderRouter([fresh, FlakyProvider("fast", latency=0.01)], hedge=True)
+    assert asyncio.run(served_by(router)) == "slow"
+
+    alone = slow_provider_with_history()
+    alone.stub_latency = 0.1
+    router = ProviderRouter([alone], hedge=True)
+    assert asyncio.run(served_by(router)) == "slow"
+    assert alone.calls == 1
+
+    full = AdmissionController(max_concurrency=1)
+    full.try_acquire()
+    slow = slow_provider_with_history()
+    slow.stub_latency = 0.1
+    fast = FlakyProvider("fast", latency=0.01)
+    router = ProviderRouter([slow, fast], hedge=True, admission=full)
+    assert asyncio.run(served_by(router)) == "slow"
+    assert fast.calls == 0
+
+
+def test_retry_after_accepts_seconds_and_http_dates():
+    from email.utils import format_datetime
+    from datetime import datetime, timedelta, timezone
+
+    assert parse_retry_after("2") == 2.0
+    assert parse_retry_after("0.5") == 0.5
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after("inf") is None
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < parse_retry_after(later) <= 30
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+def test_circuit_opens_after_repeated_failures():
+    broken = FlakyProvider("broken", failures=100)
+    broken.breaker.failure_threshold = 2
+    router = ProviderRouter([broken], max_retries=0, hedge=False)
+    for _ in range(2):
+        try:
+            asyncio.run(router.process_prompt("prompt"))
+        except ProviderError:
+            pass
+    assert broken.breaker.state == "open"
+    assert router.candidates("broken") == []
+
+
+def test_readiness_needs_one_usable_provider(monkeypatch):
+    unreachable = FlakyProvider("unreachable")
+    healthy = FlakyProvider("healthy")
+
+    async def fail_probe(timeout=5.0):
+        raise ProviderError("unreachable is unreachable: ConnectError()")
+
+    monkeypatch.setattr(unreachable, "probe", fail_probe)
+    router = ProviderRouter([unreachable, healthy], hedge=False)
+    monkeypatch.setattr(main, "get_router", lambda: router)
+
+    main.readiness._checked_at = None
+    response = client.get("/health/ready")
+    assert response.status_code == 200, response.text
+    providers = response.json()["checks"]["llm_providers"]["providers"]
+    assert providers["unreachable"]["status"] == "down" and providers["healthy"]["status"] == "ok"
+
+    # An open circuit counts as unusable even if the endpoint answers
+    healthy.breaker.state = "open"
+    main.readiness._checked_at = None
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert "No LLM provider is usable" in response.json()["checks"]["llm_providers"]["error"]
+
+
+def test_batcher_demultiplexes_small_prs():
+    prompts = []
+
+    async def fake_run_prompt(prompt, provider, size, generation=None):
+        prompts.append(prompt)
+        return LLMResponse(
+            generated_text="=== PR 1 ===\n[a.py]:1\nFirst\n=== PR 2 ===\n[b.py]:1\nSecond",
+            provider=provider
+        )
+
+    def changes(filename):
+        return {"additions": 1, "deletions": 0,
+                "changed_files": [{"filename": filename, "patch": "@@ -0,0 +1,1 @@\n+x"}]}
+
+    async def scenario():
+        batcher = ReviewBatcher(fake_run_prompt, window_ms=10)
+        info = PROMPT_REQUEST["pr_info"]
+        return await asyncio.gather(
+            batcher.submit("deepseek", info, changes("a.py")),
+            batcher.submit("deepseek", info, changes("b.py")),
+        )
+
+    first, second = asyncio.run(scenario())
+    assert len(prompts) == 1
+    assert first == "[a.py]:1\nFirst"
+    assert second == "[b.py]:1\nSecond"
+
+
+def test_batches_stay_within_the_output_token_cap():
+    budgets = []
+
+    async def fake_run_prompt(prompt, provider, size, generation=None):
+        budgets.append(generation.max_tokens)
+        await asyncio.sleep(0.05)
+        # The batched reply only has the first PR's section
+        return LLMResponse(generated_text="=== PR 1 ===\n[a.py]:1\nFirst", provider=provider)
+
+    async def scenario():
+        batcher = ReviewBatcher(fake_run_prompt, window_ms=10, max_tokens=6500)
+        info = PROMPT_REQUEST["pr_info"]
+        generation = GenerationParams(max_tokens=2000)
+        started = asyncio.get_running_loop().time()
+        results = await asyncio.gather(*(
+            batcher.submit("deepseek", info, PROMPT_REQUEST["content"], generation=generation) for _ in range(4)
+        ))
+        return results, asyncio.get_running_loop().time() - started
+
+    results, elapsed = asyncio.run(scenario())
+    # Three jobs fit under the cap; the fourth goes alone
+    assert sorted(budgets) == [2000, 2000, 2000, 6000]
+    assert results[0] == "[a.py]:1\nFirst"
+    # The two PRs missing from the batched reply were re-run side by side
+    assert elapsed < 0.05 * 2.8
+
+
+def test_batcher_close_sends_waiting_jobs_and_cancels_stuck_batches():
+    async def fake_run_prompt(prompt, provider, size, generation=None):
+        if "stuck" in json.dumps(prompt):
+            await asyncio.sleep(60)
+        return LLMResponse(generated_text="[a.py]:1\nFirst", provider=provider)
+
+    def changes(filename):
+        return {"additions": 1, "deletions": 0,
+                "changed_files": [{"filename": filename, "patch": "@@ -0,0 +1,1 @@\n+x"}]}
+
+    async def scenario():
+        batcher = ReviewBatcher(fake_run_prompt, window_ms=60_000)
+        info = PROMPT_REQUEST["pr_info"]
+        waiting = asyncio.ensure_future(batcher.submit("deepseek", info, changes("a.py")))
+        stuck = asyncio.ensure_future(batcher.submit("other", info, changes("stuck.py")))
+        await asyncio.sleep(0)
+        await batcher.close(timeout=0.05)
+        return await waiting, await asyncio.gather(stuck, return_exceptions=True), batcher._running
+
+    result, (stuck,), running = asyncio.run(scenario())
+    # Flushed by close rather than after its 60 s window
+    assert result == "[a.py]:1\nFirst"
+    assert isinstance(stuck, asyncio.CancelledError)
+    assert not running
+
+
+def test_review_messages_keep_static_prefix(tmp_path):
+    from app.utils.prompts import PromptTemplates, repo_from_pr_url
+
+    (tmp_path / "acme" / "widgets").mkdir(parents=True)
+    (tmp_path / "acme" / "widgets" / "guidelines.txt").write_text("Prefer dataclasses.")
+    templates = PromptTemplates(template_dir=str(tmp_path))
+
+    repo = repo_from_pr_url("https://api.github.com/repos/acme/widgets/pulls/7")
+    assert repo == "acme/widgets"
+
+    default = templates.review_messages(PROMPT_REQUEST["pr_info"], PROMPT_REQUEST["content"])
+    override = templates.review_messages(PROMPT_REQUEST["pr_info"], PROMPT_REQUEST["content"], repo=repo)
+
+    assert [m["role"] for m in default] == ["system", "user"]
+    assert "app.py" not in default[0]["content"]
+    assert "app.py" in default[1]["content"]
+    assert override[0]["content"].startswith(default[0]["content"])
+    assert override[0]["content"].endswith("Prefer dataclasses.")
+
+    # Enclosing definitions follow the file's patch, in the user message only
+    context = "Lines 1-2 (def handler):\ndef handler():\n    return added"
+    changes = {**PROMPT_REQUEST["content"],
+               "changed_files": [{**PROMPT_REQUEST["content"]["changed_files"][0], "context": context}]}
+    with_context = templates.review_messages(PROMPT_REQUEST["pr_info"], changes)
+    assert with_context[0] == default[0]
+    assert with_context[1]["content"].endswith(context + "\n")
+
+
+def test_cpu_bound_work_is_offloaded_above_threshold(monkeypatch):
+    import threading
+    from app.utils import offload
+
+    monkeypatch.setattr(offload, "OFFLOAD_EXECUTOR", "thread")
+    monkeypatch.setattr(offload, "OFFLOAD_MIN_BYTES", 100)
+    offload.shutdown_executor()
+
+    async def scenario():
+        small = await offload.run_cpu_bound(threading.get_ident, size=10)
+        large = await offload.run_cpu_bound(threading.get_ident, size=1000)
+        return small, large
+
+    small, large = asyncio.run(scenario())
+    offload.shutdown_executor()
+    assert small == threading.get_ident()
+    assert large != threading.get_ident()
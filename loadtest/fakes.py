@@ -0,0 +1,176 @@
+"""Local stand-ins for the GitHub REST API and the DeepSeek chat-completions API.
+
+Both apps serve deterministic data and support injected latency and failures,
+so the review pipeline can be exercised without network access.
+"""
+import asyncio
+import base64
+import hashlib
+import random
+import re
+import time
+from typing import Dict
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+
+
+class FaultConfig:
+    """Latency and failure injection for a fake endpoint"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, failure_rate: float = 0.0,
+                 failure_status: int = 500):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+
+    async def apply(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise HTTPException(status_code=self.failure_status, detail="Injected failure")
+
+
+# Patch shape the review mapper can always resolve: line 3 is an added line
+FAKE_PATCH = "@@ -1,2 +1,5 @@\n context\n+added_one = 1\n+added_two = 2\n+added_three = 3\n context"
+FAKE_CONTENT = "context\nadded_one = 1\nadded_two = 2\nadded_three = 3\ncontext\n"
+FAKE_LOCKFILE_PATCH = "@@ -10,40 +10,40 @@\n" + "".join(
+    f'-    "resolved": "https://registry.npmjs.org/pkg-{i}/-/pkg-{i}-1.0.0.tgz",\n'
+    f'+    "resolved": "https://registry.npmjs.org/pkg-{i}/-/pkg-{i}-1.0.1.tgz",\n'
+    for i in range(40)
+)
+FAKE_BLOBS = {
+    hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest(): content
+    for content in (FAKE_CONTENT.encode(), FAKE_LOCKFILE_PATCH.encode())
+}
+FAKE_CONTENT_SHA, FAKE_LOCKFILE_SHA = FAKE_BLOBS
+FAKE_GITATTRIBUTES = "*.py text eol=lf\ngenerated/** linguist-generated=true\n"
+
+
+def create_fake_github(faults: FaultConfig, files_per_pr: int = 3) -> FastAPI:
+    app = FastAPI(title="Fake GitHub API")
+    app.state.reviews = []
+    app.state.blob_fetches = 0
+    app.state.review_comments = {}
+
+    @app.post("/app/installations/{installation_id}/access_tokens", status_code=201)
+    async def access_token(installation_id: str):
+        await faults.apply()
+        return {"token": f"fake-installation-token-{installation_id}", "expires_at": "2099-01-01T00:00:00Z"}
+
+    @app.get("/repos/{owner}/{repo}/pulls/{number}")
+    async def get_pull(owner: str, repo: str, number: int, request: Request):
+        await faults.apply()
+        return {
+            "number": number,
+            "url": str(request.url),
+            "head": {"ref": f"feature-{number}", "sha": f"{number:040d}"},
+            "base": {"ref": "main"},
+        }
+
+    @app.get("/repos/{owner}/{repo}/pulls/{number}/files")
+    async def get_pull_files(owner: str, repo: str, number: int, request: Request):
+        await faults.apply()
+        base = str(request.base_url).rstrip("/")
+        return [
+            {
+                "filename": f"src/module_{i}.py",
+                "status": "modified",
+                "additions": 3,
+                "deletions": 0,
+                "patch": FAKE_PATCH,
+                "sha": FAKE_CONTENT_SHA,
+                "contents_url": f"{base}/repos/{owner}/{repo}/contents/src/module_{i}.py",
+            }
+            for i in range(files_per_pr)
+        ] + [
+            # Should be filtered out before the prompt is built
+            {
+                "filename": "package-lock.json",
+                "status": "modified",
+                "additions": 40,
+                "deletions": 40,
+                "patch": FAKE_LOCKFILE_PATCH,
+                "sha": FAKE_LOCKFILE_SHA,
+                "contents_url": f"{base}/repos/{owner}/{repo}/contents/package-lock.json",
+            }
+        ]
+
+    @app.post("/repos/{owner}/{repo}/pulls/{number}/reviews", status_code=201)
+    async def create_review(owner: str, repo: str, number: int, review: Dict):
+        await faults.apply()
+        app.state.reviews.append({"repo": f"{owner}/{repo}", "number": number,
+                                  "comments": len(review.get("comments", [])), "at": time.time()})
+        app.state.review_comments.setdefault((owner, repo, number), []).extend(
+            # Positions stand in for line numbers; the fake diff hunks start at line 1
+            {"path": c["path"], "line": c["position"], "body": c["body"], "user": {"login": "fake-bot[bot]", "type": "Bot"}}
+            for c in review.get("comments", [])
+        )
+        return {"id": len(app.state.reviews)}
+
+    @app.get("/repos/{owner}/{repo}/pulls/{number}/comments")
+    async def list_review_comments(owner: str, repo: str, number: int, request: Request):
+        await faults.apply()
+        comments = list(reversed(app.state.review_comments.get((owner, repo, number), [])))
+        etag = f'"{len(comments)}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304)
+        return JSONResponse(comments, headers={"ETag": etag})
+
+    @app.get("/repos/{owner}/{repo}/git/blobs/{sha}")
+    async def get_blob(owner: str, repo: str, sha: str):
+        await faults.apply()
+        app.state.blob_fetches += 1
+        if sha not in FAKE_BLOBS:
+            raise HTTPException(status_code=404, detail="Not Found")
+        content = FAKE_BLOBS[sha]
+        return {"sha": sha, "size": len(content), "encoding": "base64",
+                "content": base64.b64encode(content).decode()}
+
+    @app.get("/raw/{owner}/{repo}/{ref}/{path:path}", response_class=PlainTextResponse)
+    async def raw_content(owner: str, repo: str, ref: str, path: str):
+        await faults.apply()
+        if path == ".gitattributes":
+            return FAKE_GITATTRIBUTES
+        return FAKE_CONTENT
+
+    return app
+
+
+def create_fake_deepseek(faults: FaultConfig, comments_per_file: int = 1) -> FastAPI:
+    app = FastAPI(title="Fake DeepSeek API")
+    app.state.requests = 0
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(body: Dict):
+        app.state.requests += 1
+        await faults.apply()
+        prompt = "\n".join(m.get("content", "") for m in body.get("messages", []))
+        # Batched prompts carry one "=== PR n ===" section per pull request
+        sections = re.split(r"^(=== PR \S+ ===)$", prompt, flags=re.MULTILINE)
+        if len(sections) > 1:
+            parts = [(sections[i], sections[i + 1]) for i in range(1, len(sections), 2)]
+        else:
+            parts = [(None, prompt)]
+        reviews = []
+        for marker, text in parts:
+            files = re.findall(r"^File: (\S+)\nChanges:", text, flags=re.MULTILINE)
+            comments = "\n\n".join(
+                f"[{filename}]:3\nConsider naming this constant more descriptively ({n}).\n"
+                f"```suggestion\nadded_one = 1\n```"
+                for filename in files
+                for n in range(comments_per_file)
+            )
+            reviews.append(f"{marker}\n{comments}" if marker else comments)
+        review = "\n\n".join(reviews)
+        return {
+            "id": "fake-completion",
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": review},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(review) // 4},
+        }
+
+    return app
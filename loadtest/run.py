@@ -0,0 +1,306 @@
+"""Offline end-to-end load test for the review pipeline.
+
+Starts fake GitHub and DeepSeek servers in-process, launches webhook,
+remote-repo-server and llm-server as uvicorn subprocesses pointed at them,
+then drives signed `pull_request` deliveries through pr-listener.py at a
+target rate. Reports p50/p95/p99 latency and error rates for the webhook
+response, end to end (until the review is posted) and per pipeline stage (collected from each service's /traces endpoint).
+
+Run from the repository root:
+
+    python loadtest/run.py --rate 5 --duration 30 --deepseek-latency 1.5
+
+--noisy-share 0.9 sends that share of PRs to repo-0 and reports its end-to-end
+latency apart from the other repositories; compare --scheduler on and off.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+import uvicorn
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from fakes import FaultConfig, create_fake_deepseek, create_fake_github
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBHOOK_SECRET = "loadtest-secret"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def generate_private_key() -> str:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption(),
+    ).decode()
+
+
+def sign(body: bytes) -> str:
+    return "sha256=" + hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+
+def pull_request_delivery(github_url: str, repo_index: int, number: int) -> bytes:
+    owner, repo = "loadtest", f"repo-{repo_index}"
+    return json.dumps({
+        "action": "opened",
+        "number": number,
+        "pull_request": {
+            "url": f"{github_url}/repos/{owner}/{repo}/pulls/{number}",
+            "title": f"Load test PR {number}",
+            "user": {"login": "loadtest-bot"},
+            "base": {"ref": "main"},
+            "head": {"ref": f"feature-{number}", "sha": f"{number:040d}"},
+        },
+        "repository": {"full_name": f"{owner}/{repo}"},
+        "sender": {"login": "loadtest-bot"},
+    }).encode()
+
+
+async def serve(app, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server
+
+
+def start_service(directory: str, module: str, port: int, env: Dict[str, str], workers: int):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module, "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.join(ROOT, directory),
+        env={**os.environ, "LOG_LEVEL": "WARNING", **env},
+    )
+
+
+async def wait_healthy(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(f"{url}/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not become healthy within {timeout}s")
+
+
+def pick_repo(rng: random.Random, number: int, repos: int, noisy_share: float) -> int:
+    """repo-0 gets `noisy_share` of the PRs; the rest rotate over the other repos"""
+    if noisy_share and repos > 1:
+        return 0 if rng.random() < noisy_share else 1 + number % (repos - 1)
+    return number % repos
+
+
+async def drive(webhook_url: str, github_url: str, rate: float, duration: float, repos: int,
+                noisy_share: float = 0.0):
+    """Send deliveries at a fixed arrival rate; returns one result dict per delivery"""
+    results = []
+    rng = random.Random(7)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    async with httpx.AsyncClient(timeout=300.0, limits=limits) as client:
+
+        async def deliver(number: int, repo_index: int):
+            body = pull_request_delivery(github_url, repo_index, number)
+            headers = {
+                "X-GitHub-Event": "pull_request",
+                "X-Hub-Signature-256": sign(body),
+                "Content-Type": "application/json",
+            }
+            sent_at, start = time.time(), time.perf_counter()
+            try:
+                response = await client.post(f"{webhook_url}/webhook", content=body, headers=headers)
+                ok = response.status_code in (200, 202)
+                trace_id = response.headers.get("X-Trace-Id")
+            except httpx.HTTPError:
+                ok, trace_id = False, None
+            results.append({"number": number, "repo": repo_index, "sent_at": sent_at,
+                            "latency": time.perf_counter() - start, "ok": ok, "trace_id": trace_id})
+
+        tasks = []
+        start = time.perf_counter()
+        total = int(rate * duration)
+        for number in range(1, total + 1):
+            # Open-loop arrivals: schedule against the clock, not against completions
+            delay = start + (number - 1) / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(deliver(number, pick_repo(rng, number, repos, noisy_share))))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+async def collect_spans(service_urls: Dict[str, str], trace_ids: List[str]) -> Dict[str, List[Dict]]:
+    stages = defaultdict(list)
+    async with httpx.AsyncClient() as client:
+        for service, url in service_urls.items():
+            for trace_id in trace_ids:
+                response = await client.get(f"{url}/traces/{trace_id}")
+                if response.status_code != 200:
+                    continue
+                for span in response.json()["spans"]:
+                    stages[f"{service}:{span['stage']}"].append(span)
+    return stages
+
+
+async def wait_for_reviews(reviews: List[Dict], expected: int, timeout: float):
+    """In event mode the webhook answers before the review exists; wait for the posts"""
+    deadline = time.monotonic() + timeout
+    while len(reviews) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+
+def report(results: List[Dict], elapsed: float, stages: Dict[str, List[Dict]], reviews: List[Dict],
+           split_noisy: bool = False):
+    # End to end runs from sending the delivery to the review landing on (fake) GitHub
+    posted_at = {review["number"]: review["at"] for review in reviews}
+
+    def end_to_end(subset):
+        return [posted_at[r["number"]] - r["sent_at"] for r in subset if r["number"] in posted_at]
+
+    completed = end_to_end(results)
+    acks = [r["latency"] for r in results if r["ok"]]
+    errors = sum(1 for r in results if not r["ok"])
+    print(f"\nDeliveries: {len(results)} in {elapsed:.1f}s, reviews posted: {len(reviews)}")
+    print(f"{'stage':<36}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'errors':>9}")
+    print(f"{'webhook response':<36}{len(results):>7}{percentile(acks, 50):>9.3f}"
+          f"{percentile(acks, 95):>9.3f}{percentile(acks, 99):>9.3f}"
+          f"{errors / max(len(results), 1):>9.1%}")
+    print(f"{'end-to-end (review posted)':<36}{len(completed):>7}{percentile(completed, 50):>9.3f}"
+          f"{percentile(completed, 95):>9.3f}{percentile(completed, 99):>9.3f}"
+          f"{1 - len(completed) / max(len(results), 1):>9.1%}")
+    if split_noisy:
+        for label, subset in (("  noisy repo (repo-0)", [r for r in results if r["repo"] == 0]),
+                              ("  other repos", [r for r in results if r["repo"] != 0])):
+            times = end_to_end(subset)
+            print(f"{label:<36}{len(times):>7}{percentile(times, 50):>9.3f}"
+                  f"{percentile(times, 95):>9.3f}{percentile(times, 99):>9.3f}"
+                  f"{1 - len(times) / max(len(subset), 1):>9.1%}")
+    for name in sorted(stages):
+        spans = stages[name]
+        durations = [s["duration"] for s in spans]
+        failed = sum(1 for s in spans if s["outcome"] != "ok")
+        print(f"{name:<36}{len(spans):>7}{percentile(durations, 50):>9.3f}"
+              f"{percentile(durations, 95):>9.3f}{percentile(durations, 99):>9.3f}"
+              f"{failed / len(spans):>9.1%}")
+
+
+async def main(args):
+    github_port, deepseek_port = free_port(), free_port()
+    ports = {"webhook": free_port(), "remote-repo-server": free_port(), "llm-server": free_port()}
+    urls = {name: f"http://127.0.0.1:{port}" for name, port in ports.items()}
+    github_url = f"http://127.0.0.1:{github_port}"
+
+    fake_github = create_fake_github(
+        FaultConfig(args.github_latency, args.github_jitter, args.github_failure_rate),
+        files_per_pr=args.files_per_pr,
+    )
+    fake_deepseek = create_fake_deepseek(
+        FaultConfig(args.deepseek_latency, args.deepseek_jitter, args.deepseek_failure_rate,
+                    failure_status=429)
+    )
+    servers = [await serve(fake_github, github_port), await serve(fake_deepseek, deepseek_port)]
+    data_dir = tempfile.mkdtemp(prefix="loadtest-")
+
+    processes = [
+        start_service("webhook", "pr-listener:app", ports["webhook"], {
+            "GITHUB_WEBHOOK_SECRET": WEBHOOK_SECRET,
+            "REMOTE_REPO_SERVER_URL": urls["remote-repo-server"],
+            "LLM_SERVER_URL": urls["llm-server"],
+            "PIPELINE_MODE": args.pipeline_mode,
+            "PIPELINE_BUS": args.pipeline_bus,
+            "PIPELINE_DB_PATH": os.path.join(data_dir, "pipeline.db"),
+            "SCHEDULER_ENABLED": "true" if args.scheduler == "on" else "false",
+        }, args.workers),
+        start_service("remote-repo-server", "main:app", ports["remote-repo-server"], {
+            "GITHUB_TOKEN": "fake-token",
+            "GITHUB_API_URL": github_url,
+            "GITHUB_RAW_URL": f"{github_url}/raw",
+            "GITHUB_APP_ID": "1",
+            "GITHUB_APP_PRIVATE_KEY2": generate_private_key(),
+            "GITHUB_APP_INSTALLATION_ID": "1",
+            "LLM_SERVER_URL": urls["llm-server"],
+            "REVIEW_STORE_PATH": os.path.join(data_dir, "reviews.db"),
+            "BLOB_CACHE_DIR": os.path.join(data_dir, "blobs"),
+        }, args.workers),
+        start_service("llm-server", "main:app", ports["llm-server"], {
+            "DEEPSEEK_API_KEY": "fake-key",
+            "DEEPSEEK_API_URL": f"http://127.0.0.1:{deepseek_port}",
+            "REMOTE_REPO_SERVER_URL": urls["remote-repo-server"],
+        }, args.workers),
+    ]
+    try:
+        for url in urls.values():
+            await wait_healthy(url)
+        print(f"Driving {args.rate}/s for {args.duration}s through {urls['webhook']}")
+        results, elapsed = await drive(urls["webhook"], github_url, args.rate, args.duration, args.repos,
+                                       args.noisy_share)
+        await wait_for_reviews(fake_github.state.reviews, sum(1 for r in results if r["ok"]), args.drain_timeout)
+        trace_ids = [r["trace_id"] for r in results if r["trace_id"]]
+        # Spans live in the worker that served the request, so per-stage numbers
+        # are only complete with --workers 1
+        stages = await collect_spans(urls, trace_ids)
+        report(results, elapsed, stages, fake_github.state.reviews, split_noisy=args.noisy_share > 0)
+        # Every PR's files share a handful of blob SHAs, so nearly all are cache hits
+        print(f"Blob fetches from GitHub: {fake_github.state.blob_fetches}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        for server in servers:
+            server.should_exit = True
+        await asyncio.sleep(0.2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline load test for the review pipeline")
+    parser.add_argument("--rate", type=float, default=2.0, help="webhook deliveries per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to generate load")
+    parser.add_argument("--repos", type=int, default=5, help="distinct repositories to spread PRs over")
+    parser.add_argument("--noisy-share", type=float, default=0.0,
+                        help="share of PRs opened on repo-0, to simulate a noisy neighbour")
+    parser.add_argument("--scheduler", choices=("on", "off"), default="on",
+                        help="fair scheduling between repositories in the webhook pipeline")
+    parser.add_argument("--files-per-pr", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers per service")
+    parser.add_argument("--pipeline-mode", choices=("event", "http"), default="event")
+    parser.add_argument("--pipeline-bus", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--drain-timeout", type=float, default=120.0,
+                        help="seconds to wait for reviews still in the pipeline after the load stops")
+    parser.add_argument("--github-latency", type=float, default=0.05)
+    parser.add_argument("--github-jitter", type=float, default=0.05)
+    parser.add_argument("--github-failure-rate", type=float, default=0.0)
+    parser.add_argument("--deepseek-latency", type=float, default=1.0)
+    parser.add_argument("--deepseek-jitter", type=float, default=0.5)
+    parser.add_argument("--deepseek-failure-rate", type=float, default=0.0)
+    asyncio.run(main(parser.parse_args()))
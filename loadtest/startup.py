@@ -0,0 +1,126 @@
+"""Cold-start report for every service.
+
+For each service this runs a fresh interpreter with `-X importtime` to
+profile module imports, then starts the service under uvicorn and measures
+the time from process start to the first 200 from /health.
+
+Run from the repository root:
+
+    python loadtest/startup.py [--top 8] [--budget-ms 3000] [--runs 3] [--production]
+
+--production starts uvicorn with the flags the Dockerfiles use (uvloop,
+httptools), which need uvicorn[standard].
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import httpx
+
+from run import ROOT, free_port, generate_private_key
+
+SERVICES = {
+    # name: (directory, uvicorn app, service script)
+    "general-server": ("general-server", "main:app", "main.py"),
+    "llm-server": ("llm-server", "main:app", "main.py"),
+    "remote-repo-server": ("remote-repo-server", "main:app", "main.py"),
+    "webhook": ("webhook", "pr-listener:app", "pr-listener.py"),
+}
+
+# Same server flags as the Dockerfiles' CMD
+PRODUCTION_ARGS = ["--loop", "uvloop", "--http", "httptools"]
+
+
+def service_env(data_dir: str) -> Dict[str, str]:
+    return {
+        **os.environ,
+        "LOG_LEVEL": "WARNING",
+        "DEEPSEEK_API_KEY": "fake-key",
+        "GITHUB_APP_ID": "1",
+        "GITHUB_APP_PRIVATE_KEY2": generate_private_key(),
+        "GITHUB_WEBHOOK_SECRET": "startup-secret",
+        "PIPELINE_DB_PATH": os.path.join(data_dir, "pipeline.db"),
+        "REVIEW_STORE_PATH": os.path.join(data_dir, "reviews.db"),
+        "BLOB_CACHE_DIR": os.path.join(data_dir, "blobs"),
+        "DATABASE_URL": f"sqlite:///{data_dir}/users.db",
+    }
+
+
+def import_profile(directory: str, script: str, env: Dict[str, str]) -> Tuple[float, List[Tuple[float, str]]]:
+    """(seconds to load the service module, [(cumulative seconds, module)] for its direct imports)"""
+    code = ("import runpy, time; start = time.perf_counter(); "
+            f"runpy.run_path({script!r}, run_name='service'); print(time.perf_counter() - start)")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.join(ROOT, directory), env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {directory}/{script} failed:\n{result.stderr[-2000:]}")
+    entries = []
+    # Lines look like "import time:       412 |       1530 |   package.module"
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        # One space of indent marks an import made directly by the service module
+        if cumulative_us.strip().isdigit() and not name.startswith("  "):
+            entries.append((int(cumulative_us) / 1e6, name.strip()))
+    entries.sort(reverse=True)
+    return float(result.stdout.strip().splitlines()[-1]), entries
+
+
+def time_to_healthy(directory: str, app: str, env: Dict[str, str], extra_args: List[str],
+                    timeout: float = 60.0) -> float:
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+         *extra_args],
+        cwd=os.path.join(ROOT, directory), env=env,
+    )
+    try:
+        with httpx.Client() as client:
+            while time.perf_counter() - start < timeout:
+                try:
+                    if client.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                        return time.perf_counter() - start
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.01)
+        raise RuntimeError(f"{directory} did not become healthy within {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(args):
+    data_dir = tempfile.mkdtemp(prefix="startup-")
+    env = service_env(data_dir)
+    extra_args = PRODUCTION_ARGS if args.production else []
+    over_budget = []
+    for name, (directory, app, script) in SERVICES.items():
+        total, entries = import_profile(directory, script, env)
+        healthy = sorted(time_to_healthy(directory, app, env, extra_args) for _ in range(args.runs))
+        median = healthy[len(healthy) // 2]
+        print(f"\n{name}: module load {total * 1000:.0f} ms, first healthy response {median * 1000:.0f} ms "
+              f"(median of {args.runs})")
+        for seconds, module_name in entries[:args.top]:
+            print(f"    {seconds * 1000:8.1f} ms  {module_name}")
+        if median * 1000 > args.budget_ms:
+            over_budget.append(name)
+    if over_budget:
+        print(f"\nOver the {args.budget_ms:.0f} ms budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold-start report for every service")
+    parser.add_argument("--top", type=int, default=8, help="slowest top-level imports to list")
+    parser.add_argument("--budget-ms", type=float, default=3000, help="time-to-healthy budget per service")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--production", action="store_true", help="run uvicorn with the Dockerfiles' flags")
+    main(parser.parse_args())
@@ -18,4 +18,7 @@ class PromptRequest(BaseModel):
         
 class LLMReviewData(BaseModel):
     generated_text: str
-    pr_url: str
\ No newline at end of file
+    pr_url: str
+    # Recorded with the stored review; head_sha also keys history lookups
+    head_sha: Optional[str] = None
+    prompt_hash: Optional[str] = None
@@ -0,0 +1,198 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import weakref
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import httpx
+
+from app.utils.tracing import registry
+
+logger = logging.getLogger(__name__)
+
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", "blob-cache")
+BLOB_CACHE_MEMORY_BYTES = int(os.getenv("BLOB_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+BLOB_CACHE_DISK_BYTES = int(os.getenv("BLOB_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))
+# Blobs fetched at once for a single PR
+BLOB_FETCH_CONCURRENCY = int(os.getenv("BLOB_FETCH_CONCURRENCY", "8"))
+
+cache_lookups = registry.counter(
+    "blob_cache_lookups_total", "File content lookups by blob SHA", ("result",)
+)
+cache_bytes = registry.gauge(
+    "blob_cache_bytes", "Bytes held by the blob cache", ("tier",)
+)
+
+
+def git_blob_sha(data: bytes) -> str:
+    """SHA git assigns to a blob with this content"""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class BlobCache:
+    """Content-addressed file contents, keyed by git blob SHA.
+
+    A blob never changes once it has a SHA, so entries need no TTL: a file
+    untouched between two pushes has the same SHA and is served from here.
+    Recently used blobs stay in memory; all of them are kept on disk, where
+    the oldest are evicted once the directory outgrows its budget. The disk
+    tier is shared by every worker process.
+    """
+
+    def __init__(self, directory: str = BLOB_CACHE_DIR, memory_bytes: int = BLOB_CACHE_MEMORY_BYTES,
+                 disk_bytes: int = BLOB_CACHE_DISK_BYTES):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_size = 0
+        self._disk_size: Optional[int] = None
+        self._fetching: Dict[str, asyncio.Task] = {}
+        # Downloads whose caller was cancelled while they ran
+        self._abandoned: "weakref.WeakSet[asyncio.Task]" = weakref.WeakSet()
+
+    def _path(self, sha: str) -> str:
+        return os.path.join(self.directory, sha[:2], sha[2:])
+
+    def _remember(self, sha: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        if sha in self._memory:
+            self._memory.move_to_end(sha)
+            return
+        self._memory[sha] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+        cache_bytes.set(self._memory_size, "memory")
+
+    def _read(self, sha: str) -> Optional[bytes]:
+        try:
+            with open(self._path(sha), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, sha: str, data: bytes):
+        path = self._path(sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name and renamed, so a concurrent reader
+        # in another worker never sees a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if self._disk_size is None:
+            self._disk_size = self._scan()
+        else:
+            self._disk_size += len(data)
+        if self._disk_size > self.disk_bytes:
+            self._evict()
+        cache_bytes.set(self._disk_size, "disk")
+
+    def _scan(self) -> int:
+        return sum(entry[1] for entry in self._entries())
+
+    def _entries(self):
+        """(path, size, last access) for every blob on disk"""
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_atime
+
+    def _evict(self):
+        # Down to 90% of the budget, so eviction does not run on every write
+        target = self.disk_bytes * 0.9
+        for path, size, _ in sorted(self._entries(), key=lambda entry: entry[2]):
+            if self._disk_size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._disk_size -= size
+        logger.info("Evicted blobs down to %d bytes in %s", self._disk_size, self.directory)
+
+    async def get(self, sha: str) -> Optional[bytes]:
+        data = self._memory.get(sha)
+        if data is not None:
+            self._memory.move_to_end(sha)
+            cache_lookups.inc("memory")
+            return data
+        data = await asyncio.to_thread(self._read, sha)
+        if data is not None:
+            self._remember(sha, data)
+            cache_lookups.inc("disk")
+            return data
+        cache_lookups.inc("miss")
+        return None
+
+    async def put(self, sha: str, data: bytes):
+        if git_blob_sha(data) != sha:
+            # Never cache content under a key it does not hash to
+            raise Exception(f"Blob content does not match SHA {sha}")
+        self._remember(sha, data)
+        try:
+            await asyncio.to_thread(self._write, sha, data)
+        except OSError as e:
+            logger.warning("Could not write blob %s to the cache: %s", sha, e)
+
+    async def fetch(self, client: httpx.AsyncClient, api_url: str, owner: str, repo: str, sha: str,
+                    headers: Dict) -> bytes:
+        """Blob content from the cache, or from the Git data API on a miss.
+
+        Concurrent misses for the same SHA share one download.
+        """
+        data = await self.get(sha)
+        if data is not None:
+            return data
+        while True:
+            task = self._fetching.get(sha)
+            if task is not None:
+                try:
+                    return await asyncio.shield(task)
+                except Exception:
+                    if task not in self._abandoned:
+                        raise
+                    # Its caller was cancelled and may have closed the client
+                    # the download used; download again with ours
+                    continue
+            # Detached from the caller, so a caller that is cancelled does not
+            # cancel the download for the others
+            task = asyncio.ensure_future(self._download(client, api_url, owner, repo, sha, headers))
+            self._fetching[sha] = task
+            task.add_done_callback(lambda done: self._fetched(sha, done))
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                self._abandoned.add(task)
+                raise
+
+    def _fetched(self, sha: str, task: asyncio.Task):
+        if self._fetching.get(sha) is task:
+            del self._fetching[sha]
+        if not task.cancelled():
+            # Nobody else may be waiting; keep the loop from warning about it
+            task.exception()
+
+    async def _download(self, client: httpx.AsyncClient, api_url: str, owner: str, repo: str, sha: str,
+                        headers: Dict) -> bytes:
+        response = await client.get(f"{api_url}/repos/{owner}/{repo}/git/blobs/{sha}", headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch blob {sha}: {response.status_code}")
+        blob = response.json()
+        if blob.get("encoding") == "base64":
+            data = base64.b64decode(blob.get("content", ""))
+        else:
+            data = blob.get("content", "").encode()
+        await self.put(sha, data)
+        return data
@@ -0,0 +1,175 @@
+import ast
+import logging
+import os
+import re
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from app.utils.offload import run_cpu_bound
+from app.utils.tracing import registry
+
+logger = logging.getLogger(__name__)
+
+REVIEW_CONTEXT_ENABLED = os.getenv("REVIEW_CONTEXT_ENABLED", "true").lower() == "true"
+# Enclosing definitions longer than this are left out; the hunk itself is still sent
+REVIEW_CONTEXT_MAX_SPAN_LINES = int(os.getenv("REVIEW_CONTEXT_MAX_SPAN_LINES", "150"))
+# Total context lines per file
+REVIEW_CONTEXT_MAX_LINES = int(os.getenv("REVIEW_CONTEXT_MAX_LINES", "400"))
+# Parsed files kept, keyed by blob SHA
+CONTEXT_CACHE_SIZE = int(os.getenv("CONTEXT_CACHE_SIZE", "2048"))
+
+HUNK_HEADER = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+
+context_parses = registry.counter(
+    "review_context_parses_total", "Files parsed for enclosing definitions", ("result",)
+)
+
+# (first line, last line, kind, name), 1-based and inclusive, outermost first
+Definition = Tuple[int, int, str, str]
+
+
+class ContextExtractor:
+    """Finds the definitions in a source file; one subclass per language"""
+
+    def definitions(self, source: str) -> List[Definition]:
+        raise NotImplementedError
+
+
+class PythonExtractor(ContextExtractor):
+    """Functions and classes from Python's own parser"""
+
+    KINDS = {ast.FunctionDef: "def", ast.AsyncFunctionDef: "async def", ast.ClassDef: "class"}
+
+    def definitions(self, source: str) -> List[Definition]:
+        tree = ast.parse(source)
+        found = []
+        for node in ast.walk(tree):
+            kind = self.KINDS.get(type(node))
+            if kind is None:
+                continue
+            # Decorators belong to the definition
+            start = min([node.lineno] + [d.lineno for d in node.decorator_list])
+            found.append((start, node.end_lineno, kind, node.name))
+        found.sort(key=lambda d: (d[0], -d[1]))
+        return found
+
+
+EXTRACTORS: Dict[str, ContextExtractor] = {".py": PythonExtractor(), ".pyi": PythonExtractor()}
+
+
+def register_extractor(extension: str, extractor: ContextExtractor):
+    """Add context extraction for another language, by file extension"""
+    EXTRACTORS[extension] = extractor
+
+
+def extractor_for(filename: str) -> Optional[ContextExtractor]:
+    return EXTRACTORS.get(os.path.splitext(filename)[1].lower())
+
+
+def file_definitions(filename: str, source: str) -> List[Definition]:
+    """Module-level so large files can be parsed in the offload pool"""
+    return extractor_for(filename).definitions(source)
+
+
+def changed_lines(patch: str) -> List[int]:
+    """New-side line numbers touched by a patch; a pure deletion marks the line after it"""
+    lines = []
+    current = None
+    for line in patch.split("\n"):
+        header = HUNK_HEADER.match(line)
+        if header:
+            current = int(header.group(1))
+        elif current is None:
+            continue
+        elif line.startswith("+"):
+            lines.append(current)
+            current += 1
+        elif line.startswith("-"):
+            lines.append(current)
+        elif not line.startswith("\\"):
+            current += 1
+    return sorted(set(lines))
+
+
+def enclosing_spans(definitions: List[Definition], lines: List[int],
+                    max_span_lines: int = REVIEW_CONTEXT_MAX_SPAN_LINES) -> List[Definition]:
+    """The innermost definition around each changed line, skipping any too long to send.
+
+    An enclosing class whose body is too long contributes its header line
+    only, so a changed method still shows which class it belongs to.
+    """
+    chosen: Dict[Tuple[int, int], Definition] = {}
+    for line in lines:
+        around = [d for d in definitions if d[0] <= line <= d[1]]
+        if not around:
+            continue
+        innermost = around[-1]
+        if innermost[1] - innermost[0] + 1 <= max_span_lines:
+            chosen[innermost[:2]] = innermost
+        for outer in around[:-1]:
+            if outer[2] == "class":
+                chosen.setdefault((outer[0], outer[0]), (outer[0], outer[0], outer[2], outer[3]))
+    # Containing spans sort first, so spans inside them can be dropped
+    spans = sorted(chosen.values(), key=lambda d: (d[0], -d[1]))
+    kept: List[Definition] = []
+    for span in spans:
+        if kept and span[0] >= kept[-1][0] and span[1] <= kept[-1][1]:
+            continue
+        kept.append(span)
+    return kept
+
+
+def render_spans(source: str, spans: List[Definition], max_lines: int = REVIEW_CONTEXT_MAX_LINES) -> str:
+    source_lines = source.split("\n")
+    blocks = []
+    total = 0
+    for start, end, kind, name in spans:
+        if total + end - start + 1 > max_lines:
+            break
+        total += end - start + 1
+        body = "\n".join(source_lines[start - 1:end])
+        blocks.append(f"Lines {start}-{end} ({kind} {name}):\n{body}")
+    return "\n".join(blocks)
+
+
+class ContextBuilder:
+    """Enclosing functions and classes of each hunk, to send instead of whole files.
+
+    A file is parsed once per blob SHA: its definitions are cached, so the
+    files a PR leaves untouched between pushes are not parsed again.
+    """
+
+    def __init__(self, cache_size: int = CONTEXT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._definitions: "OrderedDict[str, List[Definition]]" = OrderedDict()
+
+    async def definitions(self, sha: Optional[str], filename: str, source: str) -> List[Definition]:
+        cached = self._definitions.get(sha) if sha else None
+        if cached is not None:
+            self._definitions.move_to_end(sha)
+            context_parses.inc("cached")
+            return cached
+        try:
+            found = await run_cpu_bound(file_definitions, filename, source, size=len(source))
+        except (SyntaxError, ValueError) as e:
+            # Half-written or mis-detected files still get reviewed, just without context;
+            # cached all the same, since the same blob fails the same way
+            logger.info("Could not parse %s for context: %s", filename, e)
+            context_parses.inc("error")
+            found = []
+        else:
+            context_parses.inc("parsed")
+        if sha:
+            self._definitions[sha] = found
+            if len(self._definitions) > self.cache_size:
+                self._definitions.popitem(last=False)
+        return found
+
+    async def context(self, file: Dict, source: str) -> str:
+        """Enclosing definitions of a changed file's hunks, or "" when there are none"""
+        if file.get("status") == "removed" or not file.get("patch") or extractor_for(file.get("filename", "")) is None:
+            return ""
+        definitions = await self.definitions(file.get("sha"), file["filename"], source)
+        if not definitions:
+            return ""
+        return render_spans(source, enclosing_spans(definitions, changed_lines(file["patch"])))
@@ -0,0 +1,190 @@
+import hashlib
+import logging
+import os
+import re
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from app.models.github import Comment
+from app.utils.tracing import registry
+
+logger = logging.getLogger(__name__)
+
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+
+COMMENT_DEDUP_ENABLED = os.getenv("COMMENT_DEDUP_ENABLED", "true").lower() == "true"
+# Estimated Jaccard similarity of shingles at which two remarks count as the same
+COMMENT_DEDUP_THRESHOLD = float(os.getenv("COMMENT_DEDUP_THRESHOLD", "0.6"))
+# Earlier comments this many lines away still count, since pushes shift lines
+COMMENT_DEDUP_LINE_WINDOW = int(os.getenv("COMMENT_DEDUP_LINE_WINDOW", "3"))
+# Login of the bot whose comments are compared; by default any GitHub App (user type "Bot")
+COMMENT_DEDUP_AUTHOR = os.getenv("COMMENT_DEDUP_AUTHOR")
+COMMENT_DEDUP_MAX_PAGES = int(os.getenv("COMMENT_DEDUP_MAX_PAGES", "10"))
+# PRs whose comment index is kept between reviews
+COMMENT_DEDUP_CACHE_SIZE = int(os.getenv("COMMENT_DEDUP_CACHE_SIZE", "512"))
+
+MINHASH_PERMUTATIONS = 64
+# Character shingles: review remarks are short, and word shingles make one
+# inserted word cost too much similarity
+SHINGLE_CHARS = 5
+_PRIME = (1 << 61) - 1
+# Fixed, so signatures agree across processes and restarts
+_PERMUTATIONS = [
+    (int.from_bytes(hashlib.sha256(f"a{i}".encode()).digest()[:8], "big") % (_PRIME - 1) + 1,
+     int.from_bytes(hashlib.sha256(f"b{i}".encode()).digest()[:8], "big") % _PRIME)
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+comments_deduplicated = registry.counter(
+    "review_comments_deduplicated_total", "Comments not posted because the PR already has them", ("match",)
+)
+comment_index_requests = registry.counter(
+    "review_comment_index_requests_total", "Existing-comment fetches by response", ("result",)
+)
+
+SUGGESTION_BLOCK = re.compile(r"```suggestion\n.*?```", re.DOTALL)
+WORD = re.compile(r"\w+")
+
+
+def normalize(message: str) -> List[str]:
+    """Lowercase words of a comment, without its suggestion block or punctuation"""
+    return WORD.findall(SUGGESTION_BLOCK.sub(" ", message).lower())
+
+
+def message_hash(words: List[str]) -> str:
+    return hashlib.sha1(" ".join(words).encode("utf-8")).hexdigest()
+
+
+def minhash(words: List[str]) -> Tuple[int, ...]:
+    """MinHash signature of a comment's normalized text, shingled by characters"""
+    text = " ".join(words)
+    shingles = {text[i:i + SHINGLE_CHARS] for i in range(max(1, len(text) - SHINGLE_CHARS + 1))}
+    hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles]
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def similarity(left: Tuple[int, ...], right: Tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures"""
+    return sum(1 for a, b in zip(left, right) if a == b) / len(left)
+
+
+class CommentIndex:
+    """Fingerprints of the comments already on a PR: (path, line, normalized message hash)
+    for exact repeats, and MinHash signatures per path for reworded ones."""
+
+    def __init__(self, threshold: float = COMMENT_DEDUP_THRESHOLD, line_window: int = COMMENT_DEDUP_LINE_WINDOW):
+        self.threshold = threshold
+        self.line_window = line_window
+        self.fingerprints = set()
+        # path -> [line, normalized words, MinHash signature or None]
+        self.signatures: Dict[str, List[list]] = {}
+
+    def add(self, path: str, line: int, message: str):
+        words = normalize(message)
+        self.fingerprints.add((path, line, message_hash(words)))
+        # Signed on first comparison: most comments are never near a new one
+        self.signatures.setdefault(path, []).append([line, words, None])
+
+    def match(self, path: str, line: int, message: str) -> Optional[str]:
+        """"exact" or "similar" if the PR already has this remark near this line, else None"""
+        words = normalize(message)
+        if (path, line, message_hash(words)) in self.fingerprints:
+            return "exact"
+        signature = None
+        for entry in self.signatures.get(path, ()):
+            if abs(entry[0] - line) > self.line_window:
+                continue
+            if entry[2] is None:
+                entry[2] = minhash(entry[1])
+            signature = signature or minhash(words)
+            if similarity(signature, entry[2]) >= self.threshold:
+                return "similar"
+        return None
+
+
+def is_bot_comment(comment: Dict, author: Optional[str] = COMMENT_DEDUP_AUTHOR) -> bool:
+    user = comment.get("user") or {}
+    if author:
+        return user.get("login") == author
+    return user.get("type") == "Bot"
+
+
+class CommentDeduplicator:
+    """Drops new review comments that repeat what an earlier review already said.
+
+    Existing comments are listed once per review, newest first, with the
+    previous ETag: an unchanged PR answers 304, which GitHub does not count
+    against the rate limit, and the cached index is reused.
+    """
+
+    def __init__(self, api_url: str = GITHUB_API_URL, cache_size: int = COMMENT_DEDUP_CACHE_SIZE):
+        self.api_url = api_url
+        self.cache_size = cache_size
+        # "owner/repo#number" -> (ETag of the first page, index)
+        self._indexes: "OrderedDict[str, Tuple[Optional[str], CommentIndex]]" = OrderedDict()
+
+    async def index(self, client: httpx.AsyncClient, owner: str, repo: str, pr_number: str,
+                    headers: Dict) -> CommentIndex:
+        key = f"{owner}/{repo}#{pr_number}"
+        etag, cached = self._indexes.get(key, (None, None))
+        url = f"{self.api_url}/repos/{owner}/{repo}/pulls/{pr_number}/comments"
+        params = {"sort": "created", "direction": "desc", "per_page": 100}
+        first_headers = {**headers, "If-None-Match": etag} if cached is not None and etag else headers
+        response = await client.get(url, params=params, headers=first_headers)
+        if response.status_code == 304:
+            comment_index_requests.inc("not-modified")
+            self._indexes.move_to_end(key)
+            return cached
+        if response.status_code != 200:
+            raise Exception(f"Failed to list review comments: {response.status_code}")
+        comment_index_requests.inc("fetched")
+
+        index = CommentIndex()
+        etag = response.headers.get("ETag")
+        for _ in range(COMMENT_DEDUP_MAX_PAGES):
+            for comment in response.json():
+                # Outdated comments (line is null) no longer sit on the diff
+                if is_bot_comment(comment) and comment.get("line"):
+                    index.add(comment["path"], comment["line"], comment.get("body") or "")
+            next_url = response.links.get("next", {}).get("url")
+            if not next_url:
+                break
+            response = await client.get(next_url, headers=headers)
+            if response.status_code != 200:
+                raise Exception(f"Failed to list review comments: {response.status_code}")
+
+        self._indexes[key] = (etag, index)
+        self._indexes.move_to_end(key)
+        if len(self._indexes) > self.cache_size:
+            self._indexes.popitem(last=False)
+        return index
+
+    async def filter(self, client: httpx.AsyncClient, pr_url: str, comments: List[Comment],
+                     headers: Dict) -> List[Comment]:
+        """Comments the PR does not already have; repeats within `comments` are dropped too"""
+        parts = pr_url.rstrip('/').split('/')
+        owner, repo, pr_number = parts[-4], parts[-3], parts[-1]
+        try:
+            index = await self.index(client, owner, repo, pr_number, headers)
+        except Exception as e:
+            # Posting a duplicate beats posting nothing
+            logger.warning("Could not list existing comments on %s, skipping dedup: %s", pr_url, e)
+            return comments
+
+        fresh = []
+        batch = CommentIndex(index.threshold, index.line_window)
+        for comment in comments:
+            path = comment.file.strip('[]')
+            # Posted bodies are compared without their suggestion block, so compare messages only
+            match = index.match(path, comment.line, comment.message) or batch.match(path, comment.line, comment.message)
+            if match:
+                comments_deduplicated.inc(match)
+                continue
+            batch.add(path, comment.line, comment.message)
+            fresh.append(comment)
+        if len(fresh) < len(comments):
+            logger.info("Dropped %d comments already on %s", len(comments) - len(fresh), pr_url)
+        return fresh
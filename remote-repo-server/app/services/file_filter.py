@@ -0,0 +1,192 @@
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter as CharCounter
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from app.utils.tracing import registry
+
+logger = logging.getLogger(__name__)
+
+REVIEW_FILE_FILTER_ENABLED = os.getenv("REVIEW_FILE_FILTER_ENABLED", "true").lower() == "true"
+# Extra comma-separated globs to skip, on top of DEFAULT_EXCLUDE_GLOBS
+REVIEW_EXCLUDE_GLOBS = [g.strip() for g in os.getenv("REVIEW_EXCLUDE_GLOBS", "").split(",") if g.strip()]
+REPO_CONFIG_TTL_SECONDS = float(os.getenv("REPO_CONFIG_TTL_SECONDS", "600"))
+
+# Heuristics for generated or minified content in an added hunk
+MAX_LINE_LENGTH = int(os.getenv("REVIEW_FILTER_MAX_LINE_LENGTH", "1000"))
+MAX_AVERAGE_LINE_LENGTH = int(os.getenv("REVIEW_FILTER_MAX_AVERAGE_LINE_LENGTH", "300"))
+# Bits per character; English prose and code sit around 4-5, base64 near 6
+MAX_ENTROPY = float(os.getenv("REVIEW_FILTER_MAX_ENTROPY", "5.5"))
+
+# Rough characters per token, for reporting savings
+CHARS_PER_TOKEN = 4
+
+DEFAULT_EXCLUDE_GLOBS = (
+    # Lockfiles
+    "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "poetry.lock", "Pipfile.lock", "Cargo.lock",
+    "go.sum", "composer.lock", "Gemfile.lock", "*.lock",
+    # Bundles and build output
+    "*.min.js", "*.min.css", "*.map", "*.bundle.js", "dist/**", "build/**",
+    # Snapshots
+    "**/__snapshots__/**", "*.snap",
+    # Generated code
+    "*_pb2.py", "*_pb2_grpc.py", "*.pb.go", "*.pb.cc", "*.pb.h", "*.g.dart", "*.designer.cs",
+    # Vendored dependencies
+    "vendor/**", "node_modules/**", "third_party/**",
+    # Binary assets
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.ico", "*.pdf", "*.zip", "*.gz", "*.jar", "*.woff", "*.woff2",
+    "*.ttf", "*.so", "*.dll", "*.exe",
+)
+
+GENERATED_MARKERS = re.compile(r"@generated|Code generated .* DO NOT EDIT|auto-?generated", re.IGNORECASE)
+
+files_skipped = registry.counter(
+    "review_filter_files_skipped_total", "Changed files left out of review prompts", ("reason",)
+)
+bytes_saved = registry.counter(
+    "review_filter_bytes_saved_total", "Patch bytes kept out of review prompts"
+)
+
+
+@lru_cache(maxsize=1024)
+def _compile_glob(pattern: str) -> re.Pattern:
+    """gitignore-style glob: no slash matches the basename at any depth, ** spans directories"""
+    anchored = "/" in pattern.rstrip("/")
+    pattern = pattern.lstrip("/")
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    if pattern.endswith("/"):
+        regex += ".*"
+    prefix = "" if anchored else "(?:.*/)?"
+    return re.compile(f"{prefix}{regex}")
+
+
+def glob_match(path: str, pattern: str) -> bool:
+    return _compile_glob(pattern).fullmatch(path) is not None
+
+
+def parse_gitattributes(text: str) -> List[Tuple[str, bool]]:
+    """(pattern, excluded) rules from linguist-generated / linguist-vendored attributes"""
+    rules = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        pattern, *attributes = line.split()
+        for attribute in attributes:
+            name, _, value = attribute.partition("=")
+            if name.lstrip("-") not in ("linguist-generated", "linguist-vendored"):
+                continue
+            excluded = not (name.startswith("-") or value == "false")
+            rules.append((pattern, excluded))
+    return rules
+
+
+def shannon_entropy(text: str) -> float:
+    if not text:
+        return 0.0
+    counts = CharCounter(text)
+    total = len(text)
+    return -sum(n / total * math.log2(n / total) for n in counts.values())
+
+
+def classify_patch(patch: str) -> Optional[str]:
+    """Reason to skip a file judging by its diff alone, or None to review it"""
+    added = [line[1:] for line in patch.split("\n") if line.startswith("+")]
+    if not added:
+        return None
+    if GENERATED_MARKERS.search("\n".join(added[:20])):
+        return "generated-marker"
+    lengths = [len(line) for line in added]
+    if max(lengths) > MAX_LINE_LENGTH:
+        return "long-lines"
+    if sum(lengths) / len(lengths) > MAX_AVERAGE_LINE_LENGTH:
+        return "long-lines"
+    text = "".join(added)
+    if len(text) > 512 and shannon_entropy(text) > MAX_ENTROPY:
+        return "high-entropy"
+    return None
+
+
+class FileFilter:
+    """Decides which changed files are worth sending to the LLM.
+
+    Per-repository .gitattributes rules are fetched once per TTL and cached.
+    """
+
+    def __init__(self, raw_url: str, exclude_globs: Tuple[str, ...] = DEFAULT_EXCLUDE_GLOBS,
+                 extra_globs: List[str] = REVIEW_EXCLUDE_GLOBS, ttl: float = REPO_CONFIG_TTL_SECONDS):
+        self.raw_url = raw_url
+        self.exclude_globs = tuple(exclude_globs) + tuple(extra_globs)
+        self.ttl = ttl
+        self._repo_rules: Dict[Tuple[str, str], Tuple[float, List[Tuple[str, bool]]]] = {}
+
+    async def repo_rules(self, client: httpx.AsyncClient, owner: str, repo: str, ref: str,
+                         headers: Dict) -> List[Tuple[str, bool]]:
+        key = (f"{owner}/{repo}", ref)
+        cached = self._repo_rules.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        rules: List[Tuple[str, bool]] = []
+        try:
+            response = await client.get(f"{self.raw_url}/{owner}/{repo}/{ref}/.gitattributes", headers=headers)
+            if response.status_code == 200:
+                rules = parse_gitattributes(response.text)
+        except httpx.HTTPError as e:
+            # Fall back to the default globs; the next PR retries
+            logger.warning("Could not fetch .gitattributes for %s/%s: %s", owner, repo, e)
+            return rules
+        self._repo_rules[key] = (time.monotonic(), rules)
+        return rules
+
+    def classify(self, file: Dict, repo_rules: List[Tuple[str, bool]]) -> Optional[str]:
+        """Reason to skip a changed file (from the GitHub files API), or None to review it"""
+        path = file.get("filename", "")
+        # The last matching .gitattributes line wins, as in git
+        for pattern, excluded in reversed(repo_rules):
+            if glob_match(path, pattern):
+                if excluded:
+                    return "gitattributes"
+                break
+        else:
+            if any(glob_match(path, pattern) for pattern in self.exclude_globs):
+                return "path"
+        patch = file.get("patch")
+        if not patch:
+            # GitHub omits the patch for binary files and very large diffs
+            return "no-patch" if file.get("status") != "removed" else None
+        return classify_patch(patch)
+
+    def record(self, pr_url: str, skipped: List[Dict]) -> Dict:
+        """Count what was skipped for one PR and return its summary"""
+        saved = sum(f["bytes"] for f in skipped)
+        for f in skipped:
+            files_skipped.inc(f["reason"])
+        bytes_saved.inc(amount=saved)
+        summary = {"skipped_files": len(skipped), "bytes_saved": saved, "tokens_saved": saved // CHARS_PER_TOKEN}
+        if skipped:
+            logger.info("Skipped %d files (%d bytes, ~%d tokens) for %s", len(skipped), saved,
+                        summary["tokens_saved"], pr_url, extra=summary)
+        return summary
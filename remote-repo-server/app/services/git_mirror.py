@@ -0,0 +1,189 @@
+import asyncio
+import base64
+import fcntl
+import logging
+import os
+import re
+import subprocess
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.utils.tracing import registry
+
+logger = logging.getLogger(__name__)
+
+# "rest" fetches each PR through the GitHub API; "mirror" diffs a local bare clone
+REVIEW_FETCH_MODE = os.getenv("REVIEW_FETCH_MODE", "rest")
+GIT_MIRROR_DIR = os.getenv("GIT_MIRROR_DIR", "git-mirrors")
+# Where mirrors are cloned from; {owner} and {repo} are filled in
+GIT_MIRROR_REMOTE = os.getenv("GIT_MIRROR_REMOTE", "https://github.com/{owner}/{repo}.git")
+GIT_MIRROR_FETCH_TIMEOUT_SECONDS = float(os.getenv("GIT_MIRROR_FETCH_TIMEOUT_SECONDS", "300"))
+
+mirror_fetch_seconds = registry.histogram(
+    "git_mirror_fetch_seconds", "Time to bring a repository mirror up to date", ("outcome",)
+)
+
+# Status letters of `git diff --raw`, as the GitHub files API names them
+STATUSES = {"A": "added", "M": "modified", "D": "removed", "R": "renamed", "C": "copied", "T": "changed"}
+NULL_SHA = "0" * 40
+
+
+def split_diff(diff: str) -> List[str]:
+    """Per-file hunks of a `git diff` in GitHub's patch format (headers dropped), in file order"""
+    patches = []
+    for section in re.split(r"^diff --git ", diff, flags=re.MULTILINE)[1:]:
+        start = re.search(r"^@@", section, flags=re.MULTILINE)
+        # Binary files and pure renames have no hunks; GitHub leaves the patch out
+        patches.append(section[start.start():].rstrip("\n") if start else "")
+    return patches
+
+
+def count_lines(patch: str) -> Tuple[int, int]:
+    """(additions, deletions) in a patch"""
+    additions = deletions = 0
+    for line in patch.split("\n"):
+        if line.startswith("+"):
+            additions += 1
+        elif line.startswith("-"):
+            deletions += 1
+    return additions, deletions
+
+
+def parse_raw(raw: bytes) -> List[Dict]:
+    """Entries of `git diff --raw -z --no-abbrev`: status, paths and blob SHAs"""
+    fields = raw.decode("utf-8", errors="replace").split("\0")
+    entries = []
+    i = 0
+    while i < len(fields) and fields[i]:
+        _, _, old_sha, new_sha, status = fields[i].lstrip(":").split(" ")
+        letter = status[0]
+        if letter in ("R", "C"):
+            previous, filename = fields[i + 1], fields[i + 2]
+            i += 3
+        else:
+            previous, filename = None, fields[i + 1]
+            i += 2
+        entry = {
+            "filename": filename,
+            "status": STATUSES.get(letter, "modified"),
+            # GitHub reports the deleted blob for removed files
+            "sha": old_sha if letter == "D" else new_sha,
+        }
+        if previous is not None:
+            entry["previous_filename"] = previous
+        entries.append(entry)
+    return entries
+
+
+def parse_batch(output: bytes, shas: List[str]) -> Dict[str, bytes]:
+    """Blob contents from `git cat-file --batch` output for the requested SHAs"""
+    blobs = {}
+    pos = 0
+    for sha in shas:
+        end = output.index(b"\n", pos)
+        header = output[pos:end].decode()
+        pos = end + 1
+        if header.endswith(" missing"):
+            continue
+        _, _, size = header.split(" ")
+        blobs[sha] = output[pos:pos + int(size)]
+        # Content is followed by a newline
+        pos += int(size) + 1
+    return blobs
+
+
+class GitMirror:
+    """Bare clones of reviewed repositories, one per repo, fetched incrementally.
+
+    A PR is diffed locally instead of through one REST call per changed file:
+    each review runs one `git fetch` of the base branch and the PR head
+    (refs/pull/N/head, which also covers forks), then `git diff` and a
+    single `git cat-file --batch` for the contents. Fetches of a repository
+    are serialized with a lock file, which also holds across worker processes.
+    """
+
+    def __init__(self, directory: str = GIT_MIRROR_DIR, remote: str = GIT_MIRROR_REMOTE,
+                 fetch_timeout: float = GIT_MIRROR_FETCH_TIMEOUT_SECONDS):
+        self.directory = directory
+        self.remote = remote
+        self.fetch_timeout = fetch_timeout
+
+    def path(self, owner: str, repo: str) -> str:
+        return os.path.join(self.directory, owner, f"{repo}.git")
+
+    def _git(self, path: str, *args: str, input: Optional[bytes] = None, env: Optional[Dict] = None,
+             timeout: Optional[float] = None) -> bytes:
+        result = subprocess.run(
+            ["git", "--git-dir", path, *args], input=input, capture_output=True, env=env, timeout=timeout,
+        )
+        if result.returncode != 0:
+            raise Exception(f"git {args[0]} failed: {result.stderr.decode(errors='replace').strip()}")
+        return result.stdout
+
+    def _auth_env(self, url: str, token: Optional[str]) -> Dict:
+        env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+        if token and url.startswith("https://"):
+            # Passed through the environment so the token never shows up in argv
+            credentials = base64.b64encode(f"x-access-token:{token}".encode()).decode()
+            env.update({"GIT_CONFIG_COUNT": "1", "GIT_CONFIG_KEY_0": "http.extraHeader",
+                        "GIT_CONFIG_VALUE_0": f"Authorization: Basic {credentials}"})
+        return env
+
+    def _fetch(self, owner: str, repo: str, pr_number: int, base_branch: str, token: Optional[str]) -> str:
+        path = self.path(owner, repo)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        url = self.remote.format(owner=owner, repo=repo)
+        with open(f"{path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isdir(path):
+                subprocess.run(["git", "init", "--quiet", "--bare", path], check=True, capture_output=True)
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                self._git(
+                    path, "fetch", "--quiet", "--no-tags", "--force", url,
+                    f"+refs/heads/{base_branch}:refs/heads/{base_branch}",
+                    f"+refs/pull/{pr_number}/head:refs/pull/{pr_number}/head",
+                    env=self._auth_env(url, token), timeout=self.fetch_timeout,
+                )
+                outcome = "ok"
+            finally:
+                mirror_fetch_seconds.observe(time.perf_counter() - start, outcome)
+        return path
+
+    def _diff(self, path: str, pr_number: int, base_branch: str, head_sha: Optional[str]) -> Tuple[List[Dict], str]:
+        head = head_sha or f"refs/pull/{pr_number}/head"
+        # Three dots: against the merge base, as GitHub shows a PR
+        revisions = f"refs/heads/{base_branch}...{head}"
+        options = ("-M", "--no-color", "--no-ext-diff")
+        entries = parse_raw(self._git(path, "diff", "--raw", "-z", "--no-abbrev", *options, revisions))
+        patches = split_diff(self._git(path, "diff", "--unified=3", *options, revisions)
+                             .decode("utf-8", errors="replace"))
+        if len(patches) != len(entries):
+            raise Exception(f"git diff listed {len(entries)} files but produced {len(patches)} patches")
+        files = []
+        for entry, patch in zip(entries, patches):
+            additions, deletions = count_lines(patch)
+            files.append({**entry, "additions": additions, "deletions": deletions, "patch": patch or None})
+        try:
+            gitattributes = self._git(path, "show", f"refs/heads/{base_branch}:.gitattributes").decode(
+                "utf-8", errors="replace")
+        except Exception:
+            gitattributes = ""
+        return files, gitattributes
+
+    def _read_blobs(self, path: str, shas: List[str]) -> Dict[str, bytes]:
+        shas = [sha for sha in dict.fromkeys(shas) if sha and sha != NULL_SHA]
+        if not shas:
+            return {}
+        output = self._git(path, "cat-file", "--batch", input="".join(f"{sha}\n" for sha in shas).encode())
+        return parse_batch(output, shas)
+
+    async def pr_files(self, owner: str, repo: str, pr_number: int, base_branch: str,
+                       head_sha: Optional[str] = None, token: Optional[str] = None) -> Tuple[List[Dict], str]:
+        """(changed files shaped like the GitHub files API, base branch .gitattributes)"""
+        path = await asyncio.to_thread(self._fetch, owner, repo, pr_number, base_branch, token)
+        return await asyncio.to_thread(self._diff, path, pr_number, base_branch, head_sha)
+
+    async def read_blobs(self, owner: str, repo: str, shas: List[str]) -> Dict[str, bytes]:
+        return await asyncio.to_thread(self._read_blobs, self.path(owner, repo), shas)
@@ -1,13 +1,44 @@
 from datetime import datetime, timedelta, UTC
-import jwt
 import httpx
-from dotenv import load_dotenv
+import logging
 import os
-from typing import List
+from typing import Dict, List, Optional
 from app.models.github import Comment
+from app.services.blob_cache import BlobCache
+from app.services.dedup import CommentDeduplicator
+from app.services.suggestions import SuggestionValidator
+from app.utils.cache import MemoryCache
+from app.utils.general import map_comment_positions
+from app.utils.offload import run_cpu_bound
+from app.utils.tracing import span
 
-# Load environment variables from .env file
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+
+TOKEN_NAMESPACE = "github-installation-token"
+# Installation tokens expire after an hour; stop handing one out a little before that
+TOKEN_TTL = 55 * 60
+
+async def check_rate_limit(token: str) -> Dict:
+    """Remaining core API quota for a token; raises if GitHub rejects the token.
+
+    /rate_limit does not count against the quota, so it is safe to poll.
+    """
+    async with httpx.AsyncClient(timeout=10.0) as client:
+        response = await client.get(
+            f"{GITHUB_API_URL}/rate_limit",
+            headers={
+                "Authorization": f"token {token}",
+                "Accept": "application/vnd.github.v3+json",
+                "User-Agent": "Code-Helper-App"
+            }
+        )
+    if response.status_code == 401:
+        raise Exception("GitHub rejected the token")
+    if response.status_code != 200:
+        raise Exception(f"GitHub rate_limit returned {response.status_code}")
+    return {"rate_remaining": response.json()["resources"]["core"]["remaining"]}
 
 class GitHubApp:
     def __init__(self, app_id: str, private_key: str):
@@ -19,6 +50,14 @@ class GitHubApp:
         if not key.endswith('-----END RSA PRIVATE KEY-----'):
             key = key + '\n-----END RSA PRIVATE KEY-----'
         self.private_key = key
+        self._signing_key = None
+
+    def signing_key(self):
+        """RSA key object, parsed once on first use; jwt and cryptography are slow to import"""
+        if self._signing_key is None:
+            from cryptography.hazmat.primitives.serialization import load_pem_private_key
+            self._signing_key = load_pem_private_key(self.private_key.encode(), password=None)
+        return self._signing_key
 
     def generate_jwt(self) -> str:
         """Generate a JWT for GitHub App authentication"""
@@ -30,12 +69,12 @@ class GitHubApp:
         }
         
         try:
-            print("Generating JWT with payload:", payload)
-            token = jwt.encode(payload, self.private_key, algorithm='RS256')
-            print("Successfully generated JWT")
+            import jwt
+            token = jwt.encode(payload, self.signing_key(), algorithm='RS256')
+            logger.debug("Generated JWT for app %s", self.app_id)
             return token
         except Exception as e:
-            print(f"Error generating JWT: {str(e)}")
+            logger.error("Error generating JWT: %s", e)
             raise Exception(f"Failed to generate JWT: {str(e)}")
 
     async def get_installation_token(self, installation_id: str) -> str:
@@ -44,7 +83,7 @@ class GitHubApp:
         
         async with httpx.AsyncClient() as client:
             response = await client.post(
-                f"https://api.github.com/app/installations/{installation_id}/access_tokens",
+                f"{GITHUB_API_URL}/app/installations/{installation_id}/access_tokens",
                 headers={
                     "Authorization": f"Bearer {jwt_token}",
                     "Accept": "application/vnd.github.v3+json",
@@ -59,24 +98,43 @@ class GitHubApp:
 
 
 class ReviewBot:
-    def __init__(self):
+    def __init__(self, blob_cache: Optional[BlobCache] = None,
+                 suggestion_validator: Optional[SuggestionValidator] = None,
+                 deduplicator: Optional[CommentDeduplicator] = None):
         self.app = GitHubApp(
             app_id=os.getenv("GITHUB_APP_ID"),
             private_key=os.getenv("GITHUB_APP_PRIVATE_KEY2")
         )
         self.installation_id = os.getenv("GITHUB_APP_INSTALLATION_ID")
-        self._token = None
-        self._token_expires_at = None
+        # Kept in this process only: a secret does not belong in the shared cache,
+        # and minting one token per worker is cheap
+        self.tokens = MemoryCache(max_entries=16)
+        # Suggestions are checked against file contents read through the blob cache
+        self.blob_cache = blob_cache
+        self.suggestion_validator = suggestion_validator
+        self.deduplicator = deduplicator
 
     async def get_token(self) -> str:
-        """Get a valid installation token, refreshing if necessary"""
-        if not self._token or not self._token_expires_at or datetime.now(UTC) >= self._token_expires_at:
-            self._token = await self.app.get_installation_token(self.installation_id)
-            self._token_expires_at = datetime.now(UTC) + timedelta(minutes=55)  # Tokens expire after 1 hour
-        return self._token
+        """Get a valid installation token, minting one if the cache has none"""
+        return await self.tokens.get_or_compute(
+            TOKEN_NAMESPACE, str(self.installation_id),
+            lambda: self.app.get_installation_token(self.installation_id), ttl=TOKEN_TTL
+        )
+
+    async def forget_token(self):
+        await self.tokens.delete(TOKEN_NAMESPACE, str(self.installation_id))
 
-    async def create_github_review(self, pr_url: str, comments: List[Comment]):
-        """Create GitHub review with comments and suggestions"""
+    async def check_token(self) -> Dict:
+        """Confirm GitHub accepts the installation token; for readiness probes"""
+        try:
+            return await check_rate_limit(await self.get_token())
+        except Exception:
+            # Revoked or expired early; mint a new one on the next call
+            await self.forget_token()
+            raise
+
+    async def create_github_review(self, pr_url: str, comments: List[Comment]) -> int:
+        """Create GitHub review with comments and suggestions; returns the number of comments posted"""
         # Get fresh installation token
         token = await self.get_token()
         
@@ -88,44 +146,54 @@ class ReviewBot:
         
         # Only proceed if we have comments
         if not comments:
-            print("No comments parsed from the review")
-            return
+            logger.info("No comments parsed from the review")
+            return 0
         
         # First, fetch the PR diff to get the line positions
         async with httpx.AsyncClient() as client:
             try:
                 # Get PR details to get the diff URL
-                pr_response = await client.get(
-                    pr_url,
-                    headers=headers
-                )
-                if pr_response.status_code != 200:
-                    print(f"Error fetching PR details: {pr_response.text}")
-                    return
+                with span("fetch_diff"):
+                    pr_response = await client.get(
+                        pr_url,
+                        headers=headers
+                    )
+                    if pr_response.status_code != 200:
+                        raise Exception(f"Failed to fetch PR details: {pr_response.text}")
+                        
+                    pr_data = pr_response.json()
                     
-                pr_data = pr_response.json()
-                
-                # Extract owner, repo, and PR number from the PR URL
-                # Example URL: https://api.github.com/repos/owner/repo/pulls/123
-                pr_parts = pr_url.split('/')
-                owner = pr_parts[-4]
-                repo = pr_parts[-3]
-                pr_number = pr_parts[-1]
-                
-                # Construct the correct diff URL
-                diff_url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}/files"
-                
-                # Get the diff content
-                diff_response = await client.get(
-                    diff_url,
-                    headers=headers
-                )
+                    # Extract owner, repo, and PR number from the PR URL
+                    # Example URL: https://api.github.com/repos/owner/repo/pulls/123
+                    pr_parts = pr_url.split('/')
+                    owner = pr_parts[-4]
+                    repo = pr_parts[-3]
+                    pr_number = pr_parts[-1]
+                    
+                    # Construct the correct diff URL
+                    diff_url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls/{pr_number}/files"
+                    
+                    # Get the diff content
+                    diff_response = await client.get(
+                        diff_url,
+                        headers=headers
+                    )
                 if diff_response.status_code != 200:
-                    print(f"Error fetching diff: {diff_response.text}")
-                    return
+                    raise Exception(f"Failed to fetch diff: {diff_response.text}")
                     
                 diff_data = diff_response.json()
                 
+                if self.suggestion_validator is not None and self.blob_cache is not None:
+                    with span("check_suggestions"):
+                        comments = await self.suggestion_validator.validate(
+                            comments, diff_data,
+                            lambda sha: self.blob_cache.fetch(client, GITHUB_API_URL, owner, repo, sha, headers)
+                        )
+                
+                if self.deduplicator is not None:
+                    with span("dedup_comments", comments=len(comments)):
+                        comments = await self.deduplicator.filter(client, pr_url, comments, headers)
+                
                 # Create review data with line comments
                 review_data = {
                     "body": "Code review by DeepSeek AI",
@@ -134,73 +202,31 @@ class ReviewBot:
                 }
                 
                 # Process each comment and find its position in the diff
-                for comment in comments:
-                    # Find the file in the diff
-                    file_found = False
-                    for file_data in diff_data:
-                        # Remove any square brackets from the file path
-                        comment_file = comment.file.strip('[]')
-                        if file_data['filename'] == comment_file:
-                            file_found = True
-                            # Get the patch content
-                            patch = file_data.get('patch', '')
-                            if not patch:
-                                continue
-                                
-                            # Find the line in the patch
-                            patch_lines = patch.split('\n')
-                            line_found = False
-                            position = 0
-                            current_line = 0
-                            
-                            for i, line in enumerate(patch_lines):
-                                if line.startswith('@@'):
-                                    # Extract line numbers from diff hunk header
-                                    try:
-                                        # Format: @@ -old_start,old_lines +new_start,new_lines @@
-                                        hunk_info = line.split('@@')[1].strip()
-                                        new_start = int(hunk_info.split('+')[1].split(',')[0])
-                                        current_line = new_start
-                                    except (IndexError, ValueError):
-                                        continue
-                                elif line.startswith('+'):
-                                    current_line += 1
-                                    if current_line == comment.line:
-                                        position = i
-                                        line_found = True
-                                        break
-                                elif not line.startswith('-'):
-                                    current_line += 1
-                            
-                            if line_found:
-                                review_data["comments"].append({
-                                    "path": comment_file,
-                                    "position": position,
-                                    "body": f"{comment.message}\n\n" + (f"```suggestion\n{comment.suggestion}\n```" if comment.suggestion else "")
-                                })
-                            else:
-                                print(f"Warning: Could not find line {comment.line} in file {comment_file}")
-                            break
-                    
-                    if not file_found:
-                        print(f"Warning: Could not find file {comment_file} in the diff")
+                with span("map_positions", comments=len(comments)):
+                    review_data["comments"] = await run_cpu_bound(
+                        map_comment_positions, comments, diff_data,
+                        size=sum(len(f.get('patch') or '') for f in diff_data)
+                    )
                 
                 # Only create the review if we have valid comments
                 if review_data["comments"]:
                     # Create the review with line comments
-                    response = await client.post(
-                        f"{pr_url}/reviews",
-                        headers=headers,
-                        json=review_data
-                    )
+                    with span("post_review", comments=len(review_data["comments"])):
+                        response = await client.post(
+                            f"{pr_url}/reviews",
+                            headers=headers,
+                            json=review_data
+                        )
                     
                     if response.status_code == 201:
-                        print(f"Successfully created review with {len(review_data['comments'])} line comments")
+                        logger.info("Successfully created review with %d line comments", len(review_data['comments']))
+                        return len(review_data["comments"])
                     else:
-                        print(f"Error creating review: {response.text}")
+                        raise Exception(f"Failed to create review: {response.text}")
                 else:
-                    print("No valid comments to create review with")
+                    logger.info("No valid comments to create review with")
+                    return 0
                     
             except Exception as e:
-                print(f"Request failed: {str(e)}")
+                logger.error("Request failed: %s", e)
                 raise
\ No newline at end of file
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+from app.models.github import Comment
+
+logger = logging.getLogger(__name__)
+
+REVIEW_STORE_PATH = os.getenv("REVIEW_STORE_PATH", "reviews.db")
+
+# Posting status of a stored review
+PENDING = "pending"
+POSTED = "posted"
+EMPTY = "empty"
+FAILED = "failed"
+
+
+def split_pr_url(pr_url: str):
+    """("owner/repo", number) from https://api.github.com/repos/owner/repo/pulls/123"""
+    parts = pr_url.rstrip('/').split('/')
+    return f"{parts[-4]}/{parts[-3]}", int(parts[-1])
+
+
+class ReviewStore:
+    """SQLite-backed history of generated reviews and whether they reached GitHub"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS reviews (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        repo TEXT NOT NULL,
+        pr_number INTEGER NOT NULL,
+        pr_url TEXT NOT NULL,
+        head_sha TEXT,
+        prompt_hash TEXT,
+        generated_text TEXT NOT NULL,
+        comments TEXT NOT NULL DEFAULT '[]',
+        status TEXT NOT NULL,
+        posted_comments INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS reviews_repo_pr ON reviews (repo, pr_number, created_at);
+    CREATE INDEX IF NOT EXISTS reviews_head_sha ON reviews (head_sha);
+    CREATE INDEX IF NOT EXISTS reviews_prompt_hash ON reviews (prompt_hash);
+    """
+
+    COLUMNS = ("id", "repo", "pr_number", "pr_url", "head_sha", "prompt_hash", "generated_text",
+               "comments", "status", "posted_comments", "error", "attempts", "created_at", "updated_at")
+
+    def __init__(self, path: str = REVIEW_STORE_PATH):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(self.SCHEMA)
+        self._lock = asyncio.Lock()
+
+    async def _run(self, fn, *args):
+        async with self._lock:
+            return await asyncio.to_thread(fn, *args)
+
+    def _row(self, row) -> Dict:
+        review = dict(zip(self.COLUMNS, row))
+        review["comments"] = json.loads(review["comments"])
+        return review
+
+    def _add(self, pr_url: str, generated_text: str, comments: List[Dict],
+             head_sha: Optional[str], prompt_hash: Optional[str]) -> int:
+        repo, pr_number = split_pr_url(pr_url)
+        now = time.time()
+        # Immediate, so another process cannot insert the same review between the lookup and the insert
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if prompt_hash is not None:
+                row = self._conn.execute(
+                    "SELECT id FROM reviews WHERE pr_url = ? AND head_sha IS ? AND prompt_hash = ? "
+                    "ORDER BY id DESC LIMIT 1",
+                    (pr_url, head_sha, prompt_hash)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute("COMMIT")
+                    return row[0]
+            cursor = self._conn.execute(
+                "INSERT INTO reviews (repo, pr_number, pr_url, head_sha, prompt_hash, generated_text, "
+                "comments, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (repo, pr_number, pr_url, head_sha, prompt_hash, generated_text,
+                 json.dumps(comments), PENDING, now, now)
+            )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return cursor.lastrowid
+
+    async def add(self, pr_url: str, generated_text: str, comments: List[Comment],
+                  head_sha: Optional[str] = None, prompt_hash: Optional[str] = None) -> int:
+        """Record a generated review before it is posted; returns its ID.
+
+        A retried handoff of the same review (same PR, head SHA and prompt
+        hash) gets the ID of the row already stored instead of a new one.
+        """
+        return await self._run(self._add, pr_url, generated_text, [vars(c) for c in comments],
+                               head_sha, prompt_hash)
+
+    def _set_status(self, review_id: int, status: str, posted_comments: int, error: Optional[str]):
+        self._conn.execute(
+            "UPDATE reviews SET status = ?, posted_comments = ?, error = ?, attempts = attempts + 1, "
+            "updated_at = ? WHERE id = ?",
+            (status, posted_comments, error, time.time(), review_id)
+        )
+
+    async def set_status(self, review_id: int, status: str, posted_comments: int = 0, error: Optional[str] = None):
+        await self._run(self._set_status, review_id, status, posted_comments, error)
+
+    def _get(self, review_id: int) -> Optional[Dict]:
+        row = self._conn.execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM reviews WHERE id = ?", (review_id,)
+        ).fetchone()
+        return self._row(row) if row else None
+
+    async def get(self, review_id: int) -> Optional[Dict]:
+        return await self._run(self._get, review_id)
+
+    def _find(self, repo: Optional[str], pr_number: Optional[int], head_sha: Optional[str],
+              prompt_hash: Optional[str], status: Optional[str], limit: int) -> List[Dict]:
+        filters, params = [], []
+        for column, value in (("repo", repo), ("pr_number", pr_number), ("head_sha", head_sha),
+                              ("prompt_hash", prompt_hash), ("status", status)):
+            if value is not None:
+                filters.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(filters)}" if filters else ""
+        rows = self._conn.execute(
+            f"SELECT {', '.join(self.COLUMNS)} FROM reviews {where} ORDER BY id DESC LIMIT ?",
+            (*params, limit)
+        ).fetchall()
+        return [self._row(row) for row in rows]
+
+    async def find(self, repo: Optional[str] = None, pr_number: Optional[int] = None,
+                   head_sha: Optional[str] = None, prompt_hash: Optional[str] = None,
+                   status: Optional[str] = None, limit: int = 50) -> List[Dict]:
+        """Newest first, filtered on any combination of repo, PR, head SHA, prompt hash and status"""
+        return await self._run(self._find, repo, pr_number, head_sha, prompt_hash, status, limit)
+
+    async def lookup(self, prompt_hash: str) -> Optional[Dict]:
+        """Latest review generated from an identical prompt, if any"""
+        reviews = await self.find(prompt_hash=prompt_hash, limit=1)
+        return reviews[0] if reviews else None
+
+    async def ping(self):
+        await self._run(self._conn.execute, "SELECT 1")
+
+    async def close(self):
+        await self._run(self._conn.close)
@@ -0,0 +1,149 @@
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.models.github import Comment
+from app.utils.offload import run_cpu_bound
+from app.utils.tracing import registry
+
+logger = logging.getLogger(__name__)
+
+SUGGESTION_VALIDATION_ENABLED = os.getenv("SUGGESTION_VALIDATION_ENABLED", "true").lower() == "true"
+# "downgrade" keeps an invalid suggestion's comment without the suggestion block; "drop" removes it
+SUGGESTION_INVALID_ACTION = os.getenv("SUGGESTION_INVALID_ACTION", "downgrade")
+SUGGESTION_CACHE_SIZE = int(os.getenv("SUGGESTION_CACHE_SIZE", "4096"))
+
+suggestions_checked = registry.counter(
+    "review_suggestions_checked_total", "Suggestions checked before posting", ("result",)
+)
+
+# Content loader for a blob SHA, e.g. BlobCache.fetch bound to a client and repository
+LoadBlob = Callable[[str], Awaitable[bytes]]
+
+
+class SyntaxChecker:
+    """Syntax check for one language; returns an error message or None"""
+
+    def check(self, filename: str, source: str) -> Optional[str]:
+        raise NotImplementedError
+
+
+class PythonChecker(SyntaxChecker):
+    def check(self, filename: str, source: str) -> Optional[str]:
+        try:
+            compile(source, filename, "exec", dont_inherit=True)
+        except (SyntaxError, ValueError) as e:
+            line = getattr(e, "lineno", None)
+            return f"{e.msg if isinstance(e, SyntaxError) else e} (line {line})" if line else str(e)
+        return None
+
+
+CHECKERS: Dict[str, SyntaxChecker] = {".py": PythonChecker(), ".pyi": PythonChecker()}
+
+
+def register_checker(extension: str, checker: SyntaxChecker):
+    """Add suggestion validation for another language, by file extension"""
+    CHECKERS[extension] = checker
+
+
+def checker_for(filename: str) -> Optional[SyntaxChecker]:
+    return CHECKERS.get(os.path.splitext(filename)[1].lower())
+
+
+def splice(source: str, line: int, suggestion: str) -> str:
+    """The file as it would read after GitHub applies a suggestion on a single-line comment"""
+    lines = source.split("\n")
+    return "\n".join(lines[:line - 1] + suggestion.split("\n") + lines[line:])
+
+
+def check_suggestions(files: List[Tuple[str, str, List[Tuple[int, str]]]]) -> List[List[Optional[str]]]:
+    """Syntax errors for suggestions, grouped by file as (filename, content, [(line, suggestion)]).
+
+    Suggestions on a file that does not compile as it is are not judged.
+    Module-level so it can run in the offload pool.
+    """
+    results = []
+    for filename, source, suggestions in files:
+        checker = checker_for(filename)
+        if checker.check(filename, source) is not None:
+            results.append([None] * len(suggestions))
+            continue
+        results.append([checker.check(filename, splice(source, line, suggestion))
+                        for line, suggestion in suggestions])
+    return results
+
+
+class SuggestionValidator:
+    """Checks that each suggestion, applied to the file it comments on, still parses.
+
+    Results are cached per (blob SHA, line, suggestion), so replaying a
+    stored review does not check its suggestions again.
+    """
+
+    def __init__(self, invalid_action: str = SUGGESTION_INVALID_ACTION, cache_size: int = SUGGESTION_CACHE_SIZE):
+        self.invalid_action = invalid_action
+        self.cache_size = cache_size
+        self._results: "OrderedDict[str, Optional[str]]" = OrderedDict()
+
+    @staticmethod
+    def key(sha: str, line: int, suggestion: str) -> str:
+        return hashlib.sha256(f"{sha}\0{line}\0{suggestion}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, error: Optional[str]):
+        self._results[key] = error
+        if len(self._results) > self.cache_size:
+            self._results.popitem(last=False)
+
+    async def validate(self, comments: List[Comment], diff_data: List[Dict], load: LoadBlob) -> List[Comment]:
+        """Comments to post: invalid suggestions downgraded to plain comments, or dropped"""
+        shas = {f["filename"]: f.get("sha") for f in diff_data if f.get("status") != "removed"}
+        errors: Dict[int, Optional[str]] = {}
+        # filename -> [(index into comments, cache key)] still to check
+        pending: Dict[str, List[Tuple[int, str]]] = {}
+        for i, comment in enumerate(comments):
+            filename = comment.file.strip('[]')
+            sha = shas.get(filename)
+            if not comment.suggestion or not sha or checker_for(filename) is None:
+                continue
+            key = self.key(sha, comment.line, comment.suggestion)
+            if key in self._results:
+                self._results.move_to_end(key)
+                errors[i] = self._results[key]
+                suggestions_checked.inc("cached")
+            else:
+                pending.setdefault(filename, []).append((i, key))
+
+        if pending:
+            batch = []
+            for filename, items in pending.items():
+                try:
+                    source = (await load(shas[filename])).decode("utf-8")
+                except Exception as e:
+                    # Unchecked suggestions are posted as they are
+                    logger.warning("Could not load %s to check suggestions: %s", filename, e)
+                    continue
+                batch.append((filename, source, items))
+            results = await run_cpu_bound(
+                check_suggestions,
+                [(filename, source, [(comments[i].line, comments[i].suggestion) for i, _ in items])
+                 for filename, source, items in batch],
+                size=sum(len(source) * len(items) for _, source, items in batch),
+            )
+            for (_, _, items), file_errors in zip(batch, results):
+                for (i, key), error in zip(items, file_errors):
+                    self._remember(key, error)
+                    errors[i] = error
+                    suggestions_checked.inc("invalid" if error else "valid")
+
+        validated = []
+        for i, comment in enumerate(comments):
+            error = errors.get(i)
+            if error is None:
+                validated.append(comment)
+                continue
+            logger.info("Suggestion for %s:%s does not compile: %s", comment.file, comment.line, error)
+            if self.invalid_action != "drop":
+                validated.append(Comment(comment.file, comment.line, comment.message))
+        return validated
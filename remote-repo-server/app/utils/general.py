@@ -1,7 +1,10 @@
-from typing import List
+from typing import Dict, List
+import logging
 import re
 from app.models.github import Comment
 
+logger = logging.getLogger(__name__)
+
 def parse_review_comments(review_text: str) -> List[Comment]:
     comments = []
     current_file = None
@@ -14,8 +17,14 @@ def parse_review_comments(review_text: str) -> List[Comment]:
     lines = review_text.split('\n')
     current_message = []
     current_suggestion = None
+    # Index of the line closing the current suggestion block
+    block_end = -1
     
     for i, line in enumerate(lines):
+        # Suggested code is neither part of the message nor a file reference
+        if i <= block_end:
+            continue
+        
         # Check for file and line reference
         file_match = re.search(file_pattern, line)
         if file_match:
@@ -44,7 +53,9 @@ def parse_review_comments(review_text: str) -> List[Comment]:
             while j < len(lines) and '```' not in lines[j]:
                 suggestion_lines.append(lines[j])
                 j += 1
-            current_suggestion = '\n'.join(suggestion_lines).strip()
+            # Only blank lines are trimmed: indentation is part of the suggested code
+            current_suggestion = '\n'.join(suggestion_lines).strip('\n') or None
+            block_end = j
             continue
         
         # Skip suggestion blocks
@@ -64,12 +75,74 @@ def parse_review_comments(review_text: str) -> List[Comment]:
             current_suggestion
         ))
     
-    # Debug output
-    print("\nParsed Comments:")
+    logger.info("Parsed %d review comments", len(comments))
+    if logger.isEnabledFor(logging.DEBUG):
+        for comment in comments:
+            logger.debug(
+                "Parsed comment",
+                extra={
+                    "file": comment.file,
+                    "line": comment.line,
+                    "comment_message": comment.message,
+                    "suggestion": comment.suggestion,
+                }
+            )
+    
+    return comments
+
+
+def map_comment_positions(comments: List[Comment], diff_data: List[Dict]) -> List[Dict]:
+    """Translate parsed comments into GitHub review comments positioned in the diff"""
+    review_comments = []
     for comment in comments:
-        print(f"\nFile: {comment.file}, Line: {comment.line}")
-        print(f"Message: {comment.message}")
-        if comment.suggestion:
-            print(f"Suggestion: {comment.suggestion}")
+        # Remove any square brackets from the file path
+        comment_file = comment.file.strip('[]')
+        # Find the file in the diff
+        file_found = False
+        for file_data in diff_data:
+            if file_data['filename'] == comment_file:
+                file_found = True
+                # Get the patch content
+                patch = file_data.get('patch', '')
+                if not patch:
+                    continue
+                    
+                # Find the line in the patch
+                patch_lines = patch.split('\n')
+                line_found = False
+                position = 0
+                current_line = 0
+                
+                for i, line in enumerate(patch_lines):
+                    if line.startswith('@@'):
+                        # Extract line numbers from diff hunk header
+                        try:
+                            # Format: @@ -old_start,old_lines +new_start,new_lines @@
+                            hunk_info = line.split('@@')[1].strip()
+                            new_start = int(hunk_info.split('+')[1].split(',')[0])
+                            current_line = new_start
+                        except (IndexError, ValueError):
+                            continue
+                    elif line.startswith('+'):
+                        current_line += 1
+                        if current_line == comment.line:
+                            position = i
+                            line_found = True
+                            break
+                    elif not line.startswith('-'):
+                        current_line += 1
+                
+                if line_found:
+                    review_comments.append({
+                        "path": comment_file,
+                        "position": position,
+                        "body": f"{comment.message}\n\n" + (f"```suggestion\n{comment.suggestion}\n```" if comment.suggestion else "")
+                    })
+                else:
+                    logger.warning("Could not find line %s in file %s", comment.line, comment_file)
+                break
+        
+        if not file_found:
+            logger.warning("Could not find file %s in the diff", comment_file)
     
-    return comments
\ No newline at end of file
+    return review_comments
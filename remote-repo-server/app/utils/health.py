@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+from app.utils.tracing import registry
+
+logger = logging.getLogger(__name__)
+
+# Probe results are reused for this long, so frequent polling by load
+# balancers never turns into a request per poll against a dependency
+HEALTH_PROBE_TTL_SECONDS = float(os.getenv("HEALTH_PROBE_TTL_SECONDS", "10"))
+HEALTH_PROBE_TIMEOUT_SECONDS = float(os.getenv("HEALTH_PROBE_TIMEOUT_SECONDS", "3"))
+# A passing probe slower than this is reported as degraded
+HEALTH_PROBE_SLOW_SECONDS = float(os.getenv("HEALTH_PROBE_SLOW_SECONDS", "1"))
+
+probe_up = registry.gauge(
+    "readiness_probe_up", "1 if the dependency probe last passed, else 0", ("check",)
+)
+probe_latency = registry.gauge(
+    "readiness_probe_latency_seconds", "Duration of the last dependency probe", ("check",)
+)
+
+# A probe raises when the dependency is unusable and may return extra details
+Probe = Callable[[], Awaitable[Optional[Dict]]]
+
+
+async def probe_url(url: str, timeout: float = HEALTH_PROBE_TIMEOUT_SECONDS) -> Dict:
+    """Probe for an HTTP dependency that answers 2xx when it is up"""
+    import httpx
+
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        response = await client.get(url)
+    if response.status_code >= 300:
+        raise Exception(f"{url} returned {response.status_code}")
+    return {"status_code": response.status_code}
+
+
+class ReadinessCheck:
+    """Runs a service's dependency probes for /health/ready.
+
+    Probes run concurrently, each under a timeout. Results are cached for
+    `ttl` seconds and concurrent callers wait for the same run.
+    """
+
+    def __init__(self, ttl: float = HEALTH_PROBE_TTL_SECONDS, timeout: float = HEALTH_PROBE_TIMEOUT_SECONDS,
+                 slow: float = HEALTH_PROBE_SLOW_SECONDS):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.slow = slow
+        self._probes: Dict[str, Tuple[Probe, bool]] = {}
+        self._results: Dict[str, Dict] = {}
+        self._checked_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    def add(self, name: str, probe: Probe, critical: bool = True):
+        """Register a probe; only critical probes can fail readiness"""
+        self._probes[name] = (probe, critical)
+
+    async def _run_probe(self, name: str, probe: Probe, critical: bool) -> Dict:
+        start = time.perf_counter()
+        result = {"critical": critical}
+        try:
+            details = await asyncio.wait_for(probe(), self.timeout)
+            result["status"] = "ok"
+            result.update(details or {})
+        except asyncio.TimeoutError:
+            result["status"] = "down"
+            result["error"] = f"timed out after {self.timeout:g}s"
+        except Exception as e:
+            result["status"] = "down"
+            result["error"] = str(e) or repr(e)
+        latency = time.perf_counter() - start
+        if result["status"] == "ok" and latency > self.slow:
+            result["status"] = "degraded"
+        result["latency_ms"] = round(latency * 1000, 1)
+
+        probe_up.set(0 if result["status"] == "down" else 1, name)
+        probe_latency.set(latency, name)
+        if result["status"] == "down":
+            logger.warning("Readiness probe %s failed: %s", name, result["error"])
+        return result
+
+    async def check(self) -> Tuple[bool, Dict]:
+        """(ready, report); ready is False if any critical probe is down"""
+        async with self._lock:
+            if self._checked_at is None or time.monotonic() - self._checked_at >= self.ttl:
+                names = list(self._probes)
+                results = await asyncio.gather(*(self._run_probe(name, *self._probes[name]) for name in names))
+                self._results = dict(zip(names, results))
+                self._checked_at = time.monotonic()
+        ready = all(r["status"] != "down" for r in self._results.values() if r["critical"])
+        report = {
+            "status": "ready" if ready else "not ready",
+            "age_seconds": round(time.monotonic() - self._checked_at, 1),
+            "checks": self._results,
+        }
+        return ready, report
+
+
+def add_health_routes(app: FastAPI, readiness: ReadinessCheck):
+    """Add /health/live (process is serving) and /health/ready (dependencies usable)"""
+
+    @app.get("/health/live")
+    async def liveness():
+        """Liveness: answers as long as the event loop is serving requests"""
+        return {"status": "alive"}
+
+    @app.get("/health/ready")
+    async def readiness_check():
+        """Readiness: 503 while a critical dependency is down, with per-probe latency"""
+        ready, report = await readiness.check()
+        return JSONResponse(status_code=200 if ready else 503, content=report)
@@ -0,0 +1,68 @@
+"""Run CPU-bound helpers off the event loop.
+
+Small inputs run inline: handing them to a pool costs more than the work.
+Inputs of at least OFFLOAD_MIN_BYTES go to a thread or process pool so one
+huge diff cannot stall every other request served by the same worker.
+Functions sent to the process pool must be importable module-level
+functions with picklable arguments.
+"""
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from app.utils.tracing import registry
+
+logger = logging.getLogger(__name__)
+
+# "process", "thread" or "inline" (never offload)
+OFFLOAD_EXECUTOR = os.getenv("OFFLOAD_EXECUTOR", "process")
+OFFLOAD_WORKERS = int(os.getenv("OFFLOAD_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Inputs smaller than this, in bytes of text, stay on the event loop
+OFFLOAD_MIN_BYTES = int(os.getenv("OFFLOAD_MIN_BYTES", str(256 * 1024)))
+
+T = TypeVar("T")
+
+offload_duration = registry.histogram(
+    "cpu_task_duration_seconds", "CPU-bound helper latency, including pool handoff", ("task", "mode")
+)
+
+_executor: Optional[Executor] = None
+
+
+def get_executor() -> Optional[Executor]:
+    global _executor
+    if _executor is None and OFFLOAD_EXECUTOR != "inline":
+        if OFFLOAD_EXECUTOR == "process":
+            # spawn, not fork: forking a process that runs an event loop copies its state
+            _executor = ProcessPoolExecutor(OFFLOAD_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            _executor = ThreadPoolExecutor(OFFLOAD_WORKERS, thread_name_prefix="offload")
+        logger.info("Started %s pool with %d workers for CPU-bound work", OFFLOAD_EXECUTOR, OFFLOAD_WORKERS)
+    return _executor
+
+
+async def run_cpu_bound(fn: Callable[..., T], *args, size: int = 0) -> T:
+    """Call fn(*args), in the offload pool when `size` reaches OFFLOAD_MIN_BYTES"""
+    start = time.perf_counter()
+    executor = get_executor() if size >= OFFLOAD_MIN_BYTES else None
+    if executor is None:
+        result = fn(*args)
+        mode = "inline"
+    else:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(executor, functools.partial(fn, *args))
+        mode = OFFLOAD_EXECUTOR
+    offload_duration.observe(time.perf_counter() - start, fn.__name__, mode)
+    return result
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
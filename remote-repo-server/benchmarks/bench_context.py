@@ -0,0 +1,101 @@
+"""Benchmark prompt size with enclosing-definition context versus whole files.
+
+Run from the remote-repo-server directory:
+
+    python -m benchmarks.bench_context [--edits 3] [--seed 1]
+
+Uses this repository's own Python sources as the corpus. For each file,
+--edits lines inside randomly chosen functions are changed and turned into
+a unified patch, then the text a prompt would carry is measured three ways:
+the patch alone, the patch plus enclosing definitions, and the patch plus
+the complete file. Extraction time is reported cold and from the per-SHA
+cache.
+"""
+import argparse
+import asyncio
+import glob
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.context import ContextBuilder, PythonExtractor  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_patch(lines, edited):
+    """Unified patch (GitHub format, 3 context lines) for lines replaced in place"""
+    hunks = []
+    for line in sorted(edited):
+        start = max(1, line - 3)
+        end = min(len(lines), line + 3)
+        body = []
+        for n in range(start, end + 1):
+            if n == line:
+                body.append(f"-{lines[n - 1]}")
+                body.append(f"+{lines[n - 1].rstrip()}  # changed")
+            else:
+                body.append(f" {lines[n - 1]}")
+        count = end - start + 1
+        hunks.append(f"@@ -{start},{count} +{start},{count} @@\n" + "\n".join(body))
+    return "\n".join(hunks)
+
+
+def corpus(edits: int, rng: random.Random):
+    extractor = PythonExtractor()
+    for path in sorted(glob.glob(os.path.join(ROOT, "**", "*.py"), recursive=True)):
+        with open(path, encoding="utf-8") as f:
+            source = f.read()
+        try:
+            functions = [d for d in extractor.definitions(source) if d[2] != "class" and d[1] > d[0]]
+        except SyntaxError:
+            continue
+        if not functions:
+            continue
+        lines = source.split("\n")
+        edited = {rng.randint(d[0] + 1, d[1]) for d in rng.sample(functions, min(edits, len(functions)))}
+        file = {
+            "filename": os.path.relpath(path, ROOT),
+            "status": "modified",
+            "patch": make_patch(lines, edited),
+            "sha": hashlib.sha1(source.encode()).hexdigest(),
+        }
+        yield file, source
+
+
+async def run(args):
+    files = list(corpus(args.edits, random.Random(args.seed)))
+    builder = ContextBuilder()
+    patch_chars = sum(len(f["patch"]) for f, _ in files)
+    full_chars = sum(len(f["patch"]) + len(source) for f, source in files)
+
+    start = time.perf_counter()
+    contexts = [await builder.context(f, source) for f, source in files]
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    for f, source in files:
+        await builder.context(f, source)
+    cached = time.perf_counter() - start
+    context_chars = patch_chars + sum(len(c) for c in contexts)
+
+    print(f"Corpus: {len(files)} Python files, {args.edits} edited functions each")
+    print(f"{'prompt file text':<28}{'chars':>10}{'vs full files':>15}")
+    for label, chars in (("patch only", patch_chars), ("patch + enclosing defs", context_chars),
+                         ("patch + complete file", full_chars)):
+        print(f"{label:<28}{chars:>10}{chars / full_chars:>15.1%}")
+    print(f"Extraction: {cold * 1000:.1f} ms cold, {cached * 1000:.1f} ms from the per-SHA cache")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--edits", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
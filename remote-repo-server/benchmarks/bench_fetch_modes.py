@@ -0,0 +1,142 @@
+"""Benchmark fetching a large PR through the GitHub API versus a local git mirror.
+
+Run from the remote-repo-server directory:
+
+    python -m benchmarks.bench_fetch_modes [--files 2000] [--changed 300] [--latency-ms 40]
+
+A local repository stands in for GitHub. REST mode talks to a fake API
+backed by that repository, with --latency-ms added to every call; mirror
+mode clones it with git. Both are timed for the first review of the PR
+(cold blob cache, fresh clone) and for a second push that touches a tenth
+of the files (warm cache, incremental fetch). The mirror fetch reads from
+local disk, so on a real network add one fetch round trip plus the pack
+transfer to its numbers.
+"""
+import argparse
+import asyncio
+import base64
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+_tmp = tempfile.mkdtemp(prefix="bench-fetch-")
+os.environ.update({
+    "GITHUB_APP_ID": "1",
+    "GITHUB_APP_PRIVATE_KEY2": "bench-key",
+    "REVIEW_STORE_PATH": os.path.join(_tmp, "reviews.db"),
+    "LOG_LEVEL": "WARNING",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from app.services.blob_cache import BlobCache  # noqa: E402
+from app.services.git_mirror import GitMirror  # noqa: E402
+
+PR_URL = "https://api.github.com/repos/octo/bench/pulls/1"
+
+
+def git(path, *args, input=None):
+    return subprocess.run(["git", "-c", "user.name=bench", "-c", "user.email=bench@example.com", *args],
+                          cwd=path, input=input, check=True, capture_output=True, text=True).stdout.strip()
+
+
+def module_source(i: int, version: int) -> str:
+    body = "".join(f"    value_{j} = compute(value_{j - 1}, {i}, {version if j % 10 == 0 else 0})\n"
+                   for j in range(1, 120))
+    return f"def handler_{i}(value_0):\n{body}    return value_119\n"
+
+
+def write_modules(path: str, indices, version: int):
+    for i in indices:
+        with open(os.path.join(path, "pkg", f"module_{i}.py"), "w") as f:
+            f.write(module_source(i, version))
+
+
+def make_repo(files: int, changed: int) -> str:
+    path = os.path.join(_tmp, "remote", "octo", "bench")
+    os.makedirs(os.path.join(path, "pkg"))
+    git(path, "init", "--quiet", "-b", "main")
+    write_modules(path, range(files), 0)
+    git(path, "add", "-A")
+    git(path, "commit", "--quiet", "-m", "base")
+    git(path, "checkout", "--quiet", "-b", "feature")
+    write_modules(path, range(changed), 1)
+    git(path, "commit", "--quiet", "-am", "push 1")
+    git(path, "update-ref", "refs/pull/1/head", "HEAD")
+    return path
+
+
+def push_again(path: str, changed: int):
+    write_modules(path, range(0, changed, 10), 2)
+    git(path, "commit", "--quiet", "-am", "push 2")
+    git(path, "update-ref", "refs/pull/1/head", "HEAD")
+
+
+def fake_github(latency: float, calls: list):
+    """httpx transport answering the files and blobs endpoints from the local repository"""
+    reference = GitMirror(os.path.join(_tmp, "reference"), remote=os.path.join(_tmp, "remote", "{owner}", "{repo}"))
+
+    async def handler(request: httpx.Request):
+        calls.append(request.url.path)
+        await asyncio.sleep(latency)
+        path = request.url.path
+        if path.endswith("/pulls/1/files"):
+            files, _ = await reference.pr_files("octo", "bench", 1, "main")
+            return httpx.Response(200, json=files)
+        if "/git/blobs/" in path:
+            sha = path.rsplit("/", 1)[1]
+            content = (await reference.read_blobs("octo", "bench", [sha]))[sha]
+            return httpx.Response(200, json={"sha": sha, "encoding": "base64",
+                                             "content": base64.b64encode(content).decode()})
+        return httpx.Response(404)
+
+    return httpx.MockTransport(handler)
+
+
+async def time_rest(latency: float, pr_info: dict):
+    calls = []
+    async with httpx.AsyncClient(transport=fake_github(latency, calls)) as client:
+        start = time.perf_counter()
+        changes = await main.fetch_pr_changes(client, PR_URL, pr_info, {})
+        return time.perf_counter() - start, len(calls), changes
+
+
+async def time_mirror(pr_info: dict):
+    start = time.perf_counter()
+    changes = await main.fetch_pr_changes_from_mirror(PR_URL, pr_info)
+    return time.perf_counter() - start, changes
+
+
+async def run(args):
+    repo_path = make_repo(args.files, args.changed)
+    main.REVIEW_FILE_FILTER_ENABLED = False
+    main.blob_cache = BlobCache(os.path.join(_tmp, "blobs"))
+    main.git_mirror = GitMirror(os.path.join(_tmp, "mirrors"), remote=os.path.join(_tmp, "remote", "{owner}", "{repo}"))
+    latency = args.latency_ms / 1000
+
+    print(f"Repository: {args.files} files, PR changes {args.changed}; REST latency {args.latency_ms:.0f} ms per call")
+    print(f"{'run':<24}{'REST s':>9}{'calls':>8}{'mirror s':>11}")
+    for label in ("first review", "second push"):
+        if label == "second push":
+            push_again(repo_path, args.changed)
+        pr_info = {"base_branch": "main", "head_branch": "feature", "head_sha": git(repo_path, "rev-parse", "HEAD")}
+        rest_seconds, calls, rest_changes = await time_rest(latency, pr_info)
+        mirror_seconds, mirror_changes = await time_mirror(pr_info)
+        assert rest_changes == mirror_changes, "REST and mirror modes disagree"
+        print(f"{label:<24}{rest_seconds:>9.3f}{calls:>8}{mirror_seconds:>11.3f}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--changed", type=int, default=300)
+    parser.add_argument("--latency-ms", type=float, default=40)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,47 +1,321 @@
-from app.utils.general import parse_review_comments
-from fastapi import FastAPI, HTTPException, Response
+import asyncio
 import os
 from dotenv import load_dotenv
-from app.models.github import LLMReviewData
-from app.services.github import ReviewBot
-import httpx
-from typing import Dict
 
-# Load environment variables from .env file
+# Load environment variables before the app modules read their settings
 load_dotenv()
 
+from app.utils.general import parse_review_comments
+from fastapi import FastAPI, HTTPException, Response
+from app.models.github import Comment, LLMReviewData
+from app.services.blob_cache import BLOB_FETCH_CONCURRENCY, BlobCache
+from app.services.context import REVIEW_CONTEXT_ENABLED, ContextBuilder
+from app.services.dedup import COMMENT_DEDUP_ENABLED, CommentDeduplicator
+from app.services.file_filter import REVIEW_FILE_FILTER_ENABLED, FileFilter, parse_gitattributes
+from app.services.git_mirror import REVIEW_FETCH_MODE, GitMirror
+from app.services.github import ReviewBot, check_rate_limit
+from app.services.review_store import EMPTY, FAILED, POSTED, ReviewStore
+from app.services.suggestions import SUGGESTION_VALIDATION_ENABLED, SuggestionValidator
+from app.utils.cache import create_cache
+from app.utils.health import ReadinessCheck, add_health_routes
+from app.utils.log import setup_logging
+from app.utils.offload import run_cpu_bound, shutdown_executor
+from app.utils.tracing import instrument_app, span, trace_headers
+import httpx
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+setup_logging("remote-repo-server")
+logger = logging.getLogger(__name__)
+
 LLM_SERVER_URL = os.getenv("LLM_SERVER_URL")
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "deepseek")
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+GITHUB_RAW_URL = os.getenv("GITHUB_RAW_URL", "https://raw.githubusercontent.com")
+# Seconds a PR's changes at one head SHA are reused for repeated deliveries and
+# retries; 0 fetches them every time
+PR_CHANGES_CACHE_TTL = float(os.getenv("PR_CHANGES_CACHE_TTL", "3600"))
+PR_CHANGES_NAMESPACE = "pr-changes"
+# complete_content of a file whose content could not be fetched
+UNAVAILABLE_CONTENT = "Could not fetch complete file content"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Uvicorn has finished or timed out in-flight requests; a review whose post was
+    # cut short is posted again by the webhook pipeline's post stage
+    if _review_store is not None:
+        await _review_store.close()
+    await cache.close()
+    shutdown_executor()
 
 app = FastAPI(title="Remote Repository API", 
-              description="API for remote repository operations")
+              description="API for remote repository operations",
+              lifespan=lifespan)
+instrument_app(app, "remote-repo-server")
+
+_review_bot: Optional[ReviewBot] = None
+_review_store: Optional[ReviewStore] = None
+cache = create_cache()
+file_filter = FileFilter(GITHUB_RAW_URL)
+blob_cache = BlobCache()
+git_mirror = GitMirror()
+context_builder = ContextBuilder()
+
+def get_review_bot() -> ReviewBot:
+    """GitHub App client, created on first use rather than at import"""
+    global _review_bot
+    if _review_bot is None:
+        _review_bot = ReviewBot(
+            blob_cache=blob_cache,
+            suggestion_validator=SuggestionValidator() if SUGGESTION_VALIDATION_ENABLED else None,
+            deduplicator=CommentDeduplicator() if COMMENT_DEDUP_ENABLED else None
+        )
+    return _review_bot
+
+def get_review_store() -> ReviewStore:
+    """Review store, opened on first use rather than at import"""
+    global _review_store
+    if _review_store is None:
+        _review_store = ReviewStore()
+    return _review_store
+
+async def check_github_token() -> Dict:
+    """PR contents are fetched with GITHUB_TOKEN rather than the App's token"""
+    return await check_rate_limit(os.getenv("GITHUB_TOKEN"))
+
+async def check_github_app() -> Dict:
+    return await get_review_bot().check_token()
+
+async def ping_review_store():
+    await get_review_store().ping()
 
-review_bot = ReviewBot()
+readiness = ReadinessCheck()
+readiness.add("github_token", check_github_token)
+readiness.add("github_app", check_github_app)
+readiness.add("review_store", ping_review_store)
+add_health_routes(app, readiness)
+
+async def post_stored_review(review_id: int, pr_url: str, comments: List[Comment]) -> Dict:
+    """Post a stored review to GitHub and record the outcome"""
+    try:
+        posted = await get_review_bot().create_github_review(pr_url, comments)
+    except Exception as e:
+        await get_review_store().set_status(review_id, FAILED, error=str(e))
+        raise
+    await get_review_store().set_status(review_id, POSTED if posted else EMPTY, posted_comments=posted)
+    return {"review_id": review_id, "posted_comments": posted}
 
 @app.post("/reviews/create")
 async def create_review(request: LLMReviewData):
     try:
         if request.pr_url:
             try:
-                comments = parse_review_comments(request.generated_text)
-                await review_bot.create_github_review(request.pr_url, comments)
-                print(f"Created GitHub review with {len(comments)} comments")
+                with span("parse"):
+                    comments = await run_cpu_bound(
+                        parse_review_comments, request.generated_text, size=len(request.generated_text)
+                    )
+                # Stored before posting, so a failed post can be replayed without the LLM
+                review_id = await get_review_store().add(
+                    request.pr_url, request.generated_text, comments,
+                    head_sha=request.head_sha, prompt_hash=request.prompt_hash
+                )
+                stored = await get_review_store().get(review_id)
+                if stored["status"] in (POSTED, EMPTY):
+                    # A retried handoff of a review that already reached GitHub
+                    logger.info("Review %d was already posted", review_id)
+                    return {"review_id": review_id, "posted_comments": stored["posted_comments"]}
+                result = await post_stored_review(review_id, request.pr_url, comments)
+                logger.info("Created GitHub review with %d comments", len(comments))
+                return result
             except Exception as e:
-                print(f"Error creating GitHub review: {str(e)}")
+                logger.error("Error creating GitHub review: %s", e, exc_info=True)
+                # Surface the failure so the caller can retry the post
+                raise HTTPException(status_code=502, detail=f"Failed to create GitHub review: {str(e)}")
         
         return Response(status_code=200)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=str(e)
         )
 
+def select_files(files: List[Dict], repo_rules: List) -> Tuple[List[Dict], List[Dict]]:
+    """(files to review, skipped files with the reason) after the generated/vendored/binary filter"""
+    reviewed_files = []
+    skipped_files = []
+    for file in files:
+        reason = file_filter.classify(file, repo_rules) if REVIEW_FILE_FILTER_ENABLED else None
+        if reason:
+            skipped_files.append({
+                "filename": file.get('filename', ''),
+                "reason": reason,
+                "bytes": len(file.get('patch') or '')
+            })
+            continue
+        reviewed_files.append(file)
+    return reviewed_files, skipped_files
+
+async def build_changes(pr_url: str, files: List[Dict], reviewed_files: List[Dict],
+                        contents: List[Optional[str]], skipped_files: List[Dict]) -> Dict:
+    """The `changes` sent to the LLM service, the same whichever way the PR was fetched.
+
+    `contents` holds each reviewed file's head content, or None if it is unavailable.
+    """
+    async def enclosing_context(file: Dict, content: Optional[str]) -> str:
+        if not REVIEW_CONTEXT_ENABLED or content is None:
+            return ""
+        return await context_builder.context(file, content)
+
+    with span("extract_context"):
+        contexts = [await enclosing_context(file, content) for file, content in zip(reviewed_files, contents)]
+    changed_files = [
+        {
+            "filename": file.get('filename', ''),
+            "status": file.get('status', ''),
+            "additions": file.get('additions', 0),
+            "deletions": file.get('deletions', 0),
+            "patch": file.get('patch') or '',
+            "context": context,
+            "complete_content": content if content is not None else (
+                "File was removed" if file.get('status') == 'removed' else UNAVAILABLE_CONTENT
+            )
+        }
+        for file, content, context in zip(reviewed_files, contents, contexts)
+    ]
+    
+    return {
+        "files_changed": len(files),
+        "additions": sum(f['additions'] for f in changed_files),
+        "deletions": sum(f['deletions'] for f in changed_files),
+        "changed_files": changed_files,
+        "skipped_files": skipped_files,
+        "filter_stats": file_filter.record(pr_url, skipped_files)
+    }
+
+async def fetch_pr_changes(client: httpx.AsyncClient, pr_url: str, pr_info: Dict, headers: Dict) -> Dict:
+    """Fetch the changed files of a PR, with complete content, from the GitHub API or a local mirror"""
+    if REVIEW_FETCH_MODE == "mirror":
+        try:
+            return await fetch_pr_changes_from_mirror(pr_url, pr_info)
+        except Exception as e:
+            logger.warning("Mirror fetch failed for %s, falling back to the API: %s", pr_url, e)
+    parts = pr_url.split('/')
+    owner = parts[4]
+    repo = parts[5]
+    pr_number = parts[7]
+    files_url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls/{pr_number}/files"
+    
+    files_response = await client.get(files_url, headers=headers)
+    
+    if files_response.status_code != 200:
+        raise HTTPException(
+            status_code=files_response.status_code,
+            detail=f"Failed to fetch PR changes: {files_response.text}"
+        )
+    
+    files = files_response.json()
+    
+    # Leave out generated, vendored and binary files before fetching anything for them
+    repo_rules = []
+    if REVIEW_FILE_FILTER_ENABLED:
+        with span("classify_files", files=len(files)):
+            repo_rules = await file_filter.repo_rules(client, owner, repo, pr_info['base_branch'], headers)
+    reviewed_files, skipped_files = select_files(files, repo_rules)
+    
+    # Fetch complete file content by blob SHA: immutable, so the head branch
+    # moving mid-fetch cannot mix two commits, and cacheable across pushes
+    fetch_slots = asyncio.Semaphore(BLOB_FETCH_CONCURRENCY)
+
+    async def complete_content(file: Dict) -> Optional[str]:
+        sha = file.get('sha')
+        if file.get('status') == 'removed' or not sha:
+            return None
+        try:
+            async with fetch_slots:
+                data = await blob_cache.fetch(client, GITHUB_API_URL, owner, repo, sha, headers)
+        except Exception as e:
+            logger.warning("Could not fetch %s (%s): %s", file.get('filename'), sha, e)
+            return None
+        return data.decode("utf-8", errors="replace")
+
+    contents = await asyncio.gather(*(complete_content(file) for file in reviewed_files))
+    return await build_changes(pr_url, files, reviewed_files, contents, skipped_files)
+
+async def fetch_pr_changes_from_mirror(pr_url: str, pr_info: Dict) -> Dict:
+    """Same result as the API path, computed from a local bare mirror of the repository"""
+    parts = pr_url.split('/')
+    owner = parts[4]
+    repo = parts[5]
+    pr_number = int(parts[7])
+    
+    with span("mirror_diff"):
+        files, gitattributes = await git_mirror.pr_files(
+            owner, repo, pr_number, pr_info['base_branch'], pr_info.get('head_sha'), os.getenv('GITHUB_TOKEN')
+        )
+    with span("classify_files", files=len(files)):
+        reviewed_files, skipped_files = select_files(files, parse_gitattributes(gitattributes))
+    
+    with span("mirror_contents"):
+        blobs = await git_mirror.read_blobs(
+            owner, repo, [f['sha'] for f in reviewed_files if f['status'] != 'removed']
+        )
+    contents = [
+        blobs[file['sha']].decode("utf-8", errors="replace")
+        if file['status'] != 'removed' and file['sha'] in blobs else None
+        for file in reviewed_files
+    ]
+    return await build_changes(pr_url, files, reviewed_files, contents, skipped_files)
+
+async def current_head_sha(client: httpx.AsyncClient, pr_url: str, headers: Dict) -> Optional[str]:
+    """The PR's head SHA as GitHub reports it now, or None if it cannot be read"""
+    try:
+        response = await client.get(pr_url, headers=headers)
+        if response.status_code == 200:
+            return response.json()["head"]["sha"]
+        logger.warning("Could not read the head of %s: %s", pr_url, response.status_code)
+    except (httpx.HTTPError, KeyError, ValueError) as e:
+        logger.warning("Could not read the head of %s: %s", pr_url, e)
+    return None
+
+async def fetch_pr_changes_memoized(client: httpx.AsyncClient, pr_url: str, pr_info: Dict, headers: Dict) -> Dict:
+    """PR changes at pr_info's head SHA, shared by repeated deliveries and retries.
+
+    The API lists the files of the PR's current head, whatever head was
+    asked for, so a result is only stored if the PR still points at the
+    requested head after the fetch, and if every file's content was fetched.
+    """
+    head_sha = pr_info['head_sha']
+    complete = []
+
+    async def fetch() -> Dict:
+        changes = await fetch_pr_changes(client, pr_url, pr_info, headers)
+        if (all(f['complete_content'] != UNAVAILABLE_CONTENT for f in changes['changed_files'])
+                and await current_head_sha(client, pr_url, headers) == head_sha):
+            complete.append(True)
+        return changes
+
+    # The base branch is in the key because retargeting a PR changes its diff
+    return await cache.get_or_compute(
+        PR_CHANGES_NAMESPACE, f"{pr_url}@{pr_info.get('base_branch')}..{head_sha}", fetch,
+        ttl=PR_CHANGES_CACHE_TTL, store=lambda _: bool(complete)
+    )
+
 @app.post("/pr/changes")
 async def get_pr_changes(request: Dict) -> Dict:
-    """Fetch the PR changes from GitHub API and forward to LLM service"""
+    """Fetch the PR changes from GitHub API and forward to LLM service.
+
+    With "forward": false the changes are returned instead, for callers that
+    drive the next step themselves (the webhook's staged pipeline).
+    """
     try:
         pr_url = request.get('pr_url')
         pr_info = request.get('pr_info')
+        forward = request.get('forward', True)
         
         if not pr_url or not pr_info:
             raise HTTPException(
@@ -56,59 +330,14 @@ async def get_pr_changes(request: Dict) -> Dict:
         }
         
         async with httpx.AsyncClient() as client:
-            parts = pr_url.split('/')
-            owner = parts[4]
-            repo = parts[5]
-            pr_number = parts[7]
-            files_url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}/files"
-            
-            files_response = await client.get(files_url, headers=headers)
-            
-            if files_response.status_code != 200:
-                raise HTTPException(
-                    status_code=files_response.status_code,
-                    detail=f"Failed to fetch PR changes: {files_response.text}"
-                )
-            
-            files = files_response.json()
-            
-            # Fetch complete file content for each changed file
-            changed_files = []
-            for file in files:
-                contents_url = file.get('contents_url', '')
-                if contents_url:
-                    parts = contents_url.split('/')
-                    if len(parts) >= 7:
-                        owner = parts[4]
-                        repo = parts[5]
-                        path = '/'.join(parts[7:])
-                        raw_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{pr_info['head_branch']}/{path}"
-                        
-                        content_response = await client.get(raw_url, headers=headers)
-                        if content_response.status_code == 200:
-                            complete_content = content_response.text
-                        else:
-                            complete_content = "Could not fetch complete file content"
-                    else:
-                        complete_content = "Invalid contents URL format"
+            with span("fetch_files"):
+                if pr_info.get('head_sha') and PR_CHANGES_CACHE_TTL > 0:
+                    changes = await fetch_pr_changes_memoized(client, pr_url, pr_info, headers)
                 else:
-                    complete_content = "No contents URL available"
-                
-                changed_files.append({
-                    "filename": file.get('filename', ''),
-                    "status": file.get('status', ''),
-                    "additions": file.get('additions', 0),
-                    "deletions": file.get('deletions', 0),
-                    "patch": file.get('patch', ''),
-                    "complete_content": complete_content
-                })
+                    changes = await fetch_pr_changes(client, pr_url, pr_info, headers)
             
-            changes = {
-                "files_changed": len(files),
-                "additions": sum(f.get('additions', 0) for f in files),
-                "deletions": sum(f.get('deletions', 0) for f in files),
-                "changed_files": changed_files
-            }
+            if not forward:
+                return changes
             
             # Forward to LLM service
             try:
@@ -118,10 +347,12 @@ async def get_pr_changes(request: Dict) -> Dict:
                     "pr_info": pr_info
                 }
                 
-                response = await client.post(
-                    f"{os.getenv('LLM_SERVER_URL')}/process-prompt/deepseek",
-                    json=llm_data
-                )
+                with span("forward_llm"):
+                    response = await client.post(
+                        f"{os.getenv('LLM_SERVER_URL')}/process-prompt/{LLM_PROVIDER}",
+                        json=llm_data,
+                        headers=trace_headers()
+                    )
                 response.raise_for_status()
                 return response.json()
             except Exception as e:
@@ -135,14 +366,49 @@ async def get_pr_changes(request: Dict) -> Dict:
             detail=f"An unexpected error occurred: {str(e)}"
         )
 
+@app.get("/reviews")
+async def list_reviews(repo: Optional[str] = None, pr: Optional[int] = None, sha: Optional[str] = None,
+                       prompt_hash: Optional[str] = None, status: Optional[str] = None, limit: int = 50):
+    """Stored reviews, newest first, filtered by repo ("owner/name"), PR number, head SHA or status"""
+    return await get_review_store().find(repo=repo, pr_number=pr, head_sha=sha, prompt_hash=prompt_hash,
+                                   status=status, limit=min(limit, 500))
+
+@app.get("/reviews/cache/{prompt_hash}")
+async def cached_review(prompt_hash: str):
+    """The latest review generated from an identical prompt, so callers can skip the LLM"""
+    review = await get_review_store().lookup(prompt_hash)
+    if review is None:
+        raise HTTPException(status_code=404, detail="No review for this prompt")
+    return review
+
+@app.get("/reviews/{review_id}")
+async def get_review(review_id: int):
+    review = await get_review_store().get(review_id)
+    if review is None:
+        raise HTTPException(status_code=404, detail="Review not found")
+    return review
+
+@app.post("/reviews/{review_id}/replay")
+async def replay_review(review_id: int):
+    """Repost a stored review to GitHub without generating it again"""
+    review = await get_review_store().get(review_id)
+    if review is None:
+        raise HTTPException(status_code=404, detail="Review not found")
+    comments = [Comment(**c) for c in review["comments"]]
+    try:
+        return await post_stored_review(review_id, review["pr_url"], comments)
+    except Exception as e:
+        logger.error("Error replaying review %s: %s", review_id, e, exc_info=True)
+        raise HTTPException(status_code=502, detail=f"Failed to create GitHub review: {str(e)}")
+
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
+    """Liveness check; /health/ready also checks GitHub credentials and the review store"""
     return {"status": "healthy"}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True) 
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=os.getenv("UVICORN_RELOAD", "false").lower() == "true")
     
     # To start the server, run:
 
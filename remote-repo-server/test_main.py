@@ -0,0 +1,515 @@
+import os
+import tempfile
+
+os.environ.setdefault("GITHUB_APP_ID", "1")
+os.environ.setdefault("GITHUB_APP_PRIVATE_KEY2", "test-key")
+os.environ.setdefault("REVIEW_STORE_PATH", os.path.join(tempfile.mkdtemp(), "reviews.db"))
+os.environ.setdefault("BLOB_CACHE_DIR", os.path.join(tempfile.mkdtemp(), "blobs"))
+
+from fastapi.testclient import TestClient
+import main
+
+client = TestClient(main.app)
+
+PR_URL = "https://api.github.com/repos/octo/widgets/pulls/7"
+REVIEW_TEXT = "[app.py]:3\nPrefer a context manager here\n"
+
+
+def test_review_is_stored_and_replayed(monkeypatch):
+    posts = []
+    outcomes = [Exception("GitHub is down"), None]
+
+    async def fake_create_github_review(pr_url, comments):
+        posts.append((pr_url, [c.message for c in comments]))
+        outcome = outcomes.pop(0)
+        if outcome is not None:
+            raise outcome
+        return len(comments)
+
+    monkeypatch.setattr(main.get_review_bot(), "create_github_review", fake_create_github_review)
+
+    response = client.post("/reviews/create", json={
+        "pr_url": PR_URL, "generated_text": REVIEW_TEXT, "head_sha": "abc123", "prompt_hash": "hash-1"
+    })
+    assert response.status_code == 502
+
+    stored = client.get("/reviews", params={"repo": "octo/widgets", "pr": 7, "sha": "abc123"}).json()
+    assert len(stored) == 1
+    assert stored[0]["status"] == "failed"
+    assert stored[0]["comments"][0]["line"] == 3
+
+    response = client.post(f"/reviews/{stored[0]['id']}/replay")
+    assert response.status_code == 200, response.text
+    assert response.json()["posted_comments"] == 1
+    assert posts == [(PR_URL, ["Prefer a context manager here"])] * 2
+
+    review = client.get(f"/reviews/{stored[0]['id']}").json()
+    assert review["status"] == "posted" and review["attempts"] == 2
+    assert client.get("/reviews/cache/hash-1").json()["generated_text"] == REVIEW_TEXT
+    assert client.get("/reviews/cache/unknown").status_code == 404
+
+    # A retried handoff of the same review neither stores nor posts it again
+    response = client.post("/reviews/create", json={
+        "pr_url": PR_URL, "generated_text": REVIEW_TEXT, "head_sha": "abc123", "prompt_hash": "hash-1"
+    })
+    assert response.json() == {"review_id": stored[0]["id"], "posted_comments": 1}
+    assert len(posts) == 2
+    assert len(client.get("/reviews", params={"repo": "octo/widgets", "pr": 7}).json()) == 1
+
+
+def test_file_filter_skips_generated_vendored_and_minified_files():
+    from app.services.file_filter import FileFilter, glob_match, parse_gitattributes
+
+    assert glob_match("web/package-lock.json", "package-lock.json")
+    assert glob_match("vendor/lib/a.go", "vendor/**")
+    assert not glob_match("src/vendor/a.go", "vendor/**")
+    assert glob_match("ui/__snapshots__/App.test.js.snap", "**/__snapshots__/**")
+
+    rules = parse_gitattributes("# comment\napi/gen/** linguist-generated=true\napi/gen/keep.py -linguist-generated\n")
+    file_filter = FileFilter("https://raw.example", extra_globs=[])
+    code = {"filename": "src/app.py", "status": "modified", "patch": "@@ -1 +1,2 @@\n x\n+y = compute(x)"}
+
+    def classify(filename, patch=code["patch"]):
+        return file_filter.classify({**code, "filename": filename, "patch": patch}, rules)
+
+    assert classify("src/app.py") is None
+    assert classify("yarn.lock") == "path"
+    assert classify("api/gen/types.py") == "gitattributes"
+    assert classify("api/gen/keep.py") is None
+    assert classify("assets/logo.png", patch=None) == "path"
+    assert classify("assets/model.bin", patch=None) == "no-patch"
+    assert classify("static/app.js", patch="@@ -0,0 +1 @@\n+" + "var a=1;" * 200) == "long-lines"
+    assert classify("src/api.py", patch="@@ -0,0 +1,2 @@\n+# @generated by protoc\n+x = 1") == "generated-marker"
+
+    summary = file_filter.record(PR_URL, [{"filename": "yarn.lock", "reason": "path", "bytes": 4000}])
+    assert summary == {"skipped_files": 1, "bytes_saved": 4000, "tokens_saved": 1000}
+
+
+def test_readiness_checks_tokens_and_store(monkeypatch):
+    import asyncio
+    from app.services import github
+
+    accepted = {"pat-token", "app-token"}
+    checked = []
+
+    async def fake_check_rate_limit(token):
+        checked.append(token)
+        if token not in accepted:
+            raise Exception("GitHub rejected the token")
+        return {"rate_remaining": 4999}
+
+    bot = main.get_review_bot()
+    minted = []
+
+    async def fake_get_installation_token(installation_id):
+        minted.append(installation_id)
+        return "app-token"
+
+    monkeypatch.setenv("GITHUB_TOKEN", "pat-token")
+    monkeypatch.setattr(main, "check_rate_limit", fake_check_rate_limit)
+    monkeypatch.setattr(github, "check_rate_limit", fake_check_rate_limit)
+    monkeypatch.setattr(bot.app, "get_installation_token", fake_get_installation_token)
+
+    main.readiness._checked_at = None
+    response = client.get("/health/ready")
+    assert response.status_code == 200, response.text
+    checks = response.json()["checks"]
+    assert checks["github_app"]["rate_remaining"] == 4999
+    assert checks["review_store"]["status"] == "ok"
+    # Cached: a second poll does not call GitHub again
+    client.get("/health/ready")
+    assert sorted(checked) == ["app-token", "pat-token"]
+
+    accepted.discard("app-token")
+    main.readiness._checked_at = None
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["checks"]["github_app"]["status"] == "down"
+    assert len(minted) == 1
+    # The rejected token is dropped so the next call mints a new one
+    assert asyncio.run(bot.tokens.get(github.TOKEN_NAMESPACE, str(bot.installation_id))) is None
+
+
+def test_file_contents_are_fetched_by_blob_sha_and_cached(monkeypatch):
+    import asyncio
+    import base64
+    import httpx
+    import pytest
+    from app.services.blob_cache import BlobCache, git_blob_sha
+
+    content = b"def handler():\n    return 1\n"
+    sha = git_blob_sha(content)
+    requested = []
+
+    def github(request):
+        requested.append(request.url.path)
+        if request.url.path.endswith("/pulls/7/files"):
+            return httpx.Response(200, json=[
+                {"filename": "app.py", "status": "modified", "additions": 1, "deletions": 0,
+                 "patch": "@@ -1 +1,2 @@\n def handler():\n+    return 1", "sha": sha},
+                {"filename": "old.py", "status": "removed", "additions": 0, "deletions": 3,
+                 "patch": "@@ -1,3 +0,0 @@\n-a\n-b\n-c", "sha": "0" * 40},
+            ])
+        if request.url.path.endswith(f"/git/blobs/{sha}"):
+            return httpx.Response(200, json={"sha": sha, "encoding": "base64",
+                                             "content": base64.b64encode(content).decode()})
+        return httpx.Response(404)
+
+    async def fetch_twice(cache_dir):
+        monkeypatch.setattr(main, "blob_cache", BlobCache(cache_dir))
+        async with httpx.AsyncClient(transport=httpx.MockTransport(github)) as client:
+            pr_info = {"base_branch": "main", "head_branch": "feature"}
+            first = await main.fetch_pr_changes(client, PR_URL, pr_info, {})
+            second = await main.fetch_pr_changes(client, PR_URL, pr_info, {})
+        return first, second
+
+    cache_dir = tempfile.mkdtemp()
+    first, second = asyncio.run(fetch_twice(cache_dir))
+    assert first == second
+    assert [f["complete_content"] for f in first["changed_files"]] == [content.decode(), "File was removed"]
+    # One blob request across both pushes, and nothing from the head branch
+    assert sum("/git/blobs/" in path for path in requested) == 1
+    assert not any("/feature/" in path for path in requested)
+
+    # A fresh process finds the blob on disk
+    requested.clear()
+    asyncio.run(fetch_twice(cache_dir))
+    assert not any("/git/blobs/" in path for path in requested)
+
+    # Content that does not hash to its SHA is never cached
+    with pytest.raises(Exception, match="does not match"):
+        asyncio.run(BlobCache(cache_dir).put(sha, b"tampered"))
+
+
+def test_pr_changes_are_memoized_only_when_complete_and_current(monkeypatch):
+    import asyncio
+    import base64
+    import httpx
+    from app.services.blob_cache import BlobCache, git_blob_sha
+    from app.utils.cache import MemoryCache
+
+    content = b"x = 1\n"
+    sha = git_blob_sha(content)
+    state = {"head": "head-1", "blob_status": 502}
+    requested = []
+
+    def github(request):
+        requested.append(request.url.path)
+        if request.url.path.endswith("/pulls/7/files"):
+            return httpx.Response(200, json=[{"filename": "app.py", "status": "modified", "additions": 1,
+                                              "deletions": 0, "patch": "@@ -0,0 +1 @@\n+x = 1", "sha": sha}])
+        if request.url.path.endswith("/pulls/7"):
+            return httpx.Response(200, json={"head": {"sha": state["head"]}})
+        if request.url.path.endswith(f"/git/blobs/{sha}"):
+            return httpx.Response(state["blob_status"], json={"encoding": "base64",
+                                                              "content": base64.b64encode(content).decode()})
+        return httpx.Response(404)
+
+    async def fetch():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(github)) as client:
+            pr_info = {"base_branch": "main", "head_branch": "feature", "head_sha": "head-1"}
+            return await main.fetch_pr_changes_memoized(client, PR_URL, pr_info, {})
+
+    monkeypatch.setattr(main, "REVIEW_FILE_FILTER_ENABLED", False)
+    monkeypatch.setattr(main, "blob_cache", BlobCache(tempfile.mkdtemp()))
+    monkeypatch.setattr(main, "cache", MemoryCache())
+
+    # A failed blob fetch is not served again from the cache
+    assert asyncio.run(fetch())["changed_files"][0]["complete_content"] == main.UNAVAILABLE_CONTENT
+    state["blob_status"] = 200
+    # Files listed after the PR moved on belong to another head
+    state["head"] = "head-2"
+    assert asyncio.run(fetch())["changed_files"][0]["complete_content"] == "x = 1\n"
+    state["head"] = "head-1"
+    requested.clear()
+    asyncio.run(fetch())
+    assert any(path.endswith("/pulls/7/files") for path in requested)
+    requested.clear()
+    assert asyncio.run(fetch())["changed_files"][0]["complete_content"] == "x = 1\n"
+    assert requested == []
+
+
+def make_remote_repo(root):
+    """A local repository standing in for GitHub, with PR 7 open from `feature` into `main`"""
+    import subprocess
+
+    path = os.path.join(root, "octo", "widgets")
+    os.makedirs(path)
+
+    def git(*args):
+        return subprocess.run(["git", "-c", "user.name=dev", "-c", "user.email=dev@example.com", *args],
+                              cwd=path, check=True, capture_output=True, text=True).stdout.strip()
+
+    def write(name, text):
+        os.makedirs(os.path.dirname(os.path.join(path, name)) or path, exist_ok=True)
+        with open(os.path.join(path, name), "w") as f:
+            f.write(text)
+
+    git("init", "--quiet", "-b", "main")
+    write(".gitattributes", "gen/** linguist-generated=true\n")
+    write("app.py", "def handler():\n    return 1\n")
+    write("old.py", "a = 1\nb = 2\n")
+    write("util.py", "".join(f"line_{i} = {i}\n" for i in range(20)))
+    git("add", "-A")
+    git("commit", "--quiet", "-m", "base")
+    git("checkout", "--quiet", "-b", "feature")
+    write("app.py", "def handler():\n    return 2\n\n\ndef other():\n    pass\n")
+    write("gen/types.py", "X = 1\n")
+    os.remove(os.path.join(path, "old.py"))
+    git("mv", "util.py", "helpers.py")
+    write("helpers.py", "".join(f"line_{i} = {i}\n" for i in range(21)))
+    git("add", "-A")
+    git("commit", "--quiet", "-m", "feature")
+    git("update-ref", "refs/pull/7/head", "HEAD")
+    return path, git, write
+
+
+def test_mirror_mode_builds_the_same_changes_from_a_local_clone(monkeypatch):
+    import asyncio
+    from app.services.git_mirror import GitMirror
+
+    remote_root = tempfile.mkdtemp()
+    path, git, write = make_remote_repo(remote_root)
+    mirror = GitMirror(tempfile.mkdtemp(), remote=os.path.join(remote_root, "{owner}", "{repo}"))
+    monkeypatch.setattr(main, "git_mirror", mirror)
+    pr_info = {"base_branch": "main", "head_branch": "feature", "head_sha": git("rev-parse", "HEAD")}
+
+    changes = asyncio.run(main.fetch_pr_changes_from_mirror(PR_URL, pr_info))
+    files = {f["filename"]: f for f in changes["changed_files"]}
+    assert set(files) == {"app.py", "old.py", "helpers.py"}
+    assert files["app.py"]["status"] == "modified"
+    assert (files["app.py"]["additions"], files["app.py"]["deletions"]) == (5, 1)
+    assert files["app.py"]["patch"].startswith("@@ -1,2 +1,6 @@\n def handler():\n-    return 1\n+    return 2")
+    assert files["app.py"]["complete_content"] == "def handler():\n    return 2\n\n\ndef other():\n    pass\n"
+    assert files["old.py"]["status"] == "removed" and files["old.py"]["complete_content"] == "File was removed"
+    assert files["helpers.py"]["status"] == "renamed" and files["helpers.py"]["additions"] == 1
+    # Marked generated in the base branch's .gitattributes
+    assert changes["skipped_files"] == [{"filename": "gen/types.py", "reason": "gitattributes", "bytes": 20}]
+    assert (changes["files_changed"], changes["additions"], changes["deletions"]) == (4, 6, 3)
+
+    # A new push is picked up by an incremental fetch into the same mirror
+    write("app.py", "def handler():\n    return 3\n")
+    git("commit", "--quiet", "-am", "push 2")
+    git("update-ref", "refs/pull/7/head", "HEAD")
+    pr_info["head_sha"] = git("rev-parse", "HEAD")
+    changes = asyncio.run(main.fetch_pr_changes_from_mirror(PR_URL, pr_info))
+    files = {f["filename"]: f for f in changes["changed_files"]}
+    assert files["app.py"]["complete_content"] == "def handler():\n    return 3\n"
+
+
+def test_context_is_the_enclosing_definitions_of_each_hunk():
+    import asyncio
+    from app.services.context import ContextBuilder, changed_lines
+
+    source = "\n".join([
+        "import os",                       # 1
+        "",                                # 2
+        "class Store:",                    # 3
+        "    def get(self, key):",         # 4
+        "        return self.data[key]",   # 5
+        "",                                # 6
+        "    @property",                   # 7
+        "    def size(self):",             # 8
+        "        return len(self.data)",   # 9
+        "",                                # 10
+        "def helper():",                   # 11
+        "    return 2",                    # 12
+        "",                                # 13
+        "VALUE = helper()",                # 14
+    ]) + "\n"
+    patch = "@@ -7,3 +7,3 @@\n     @property\n     def size(self):\n-        return 0\n+        return len(self.data)\n" \
+            "@@ -14 +14 @@\n-VALUE = 1\n+VALUE = helper()"
+    assert changed_lines(patch) == [9, 14]
+
+    builder = ContextBuilder()
+    file = {"filename": "store.py", "status": "modified", "patch": patch, "sha": "abc"}
+    context = asyncio.run(builder.context(file, source))
+    # The changed method with its decorator, under its class's header; nothing for module-level code
+    assert context == ("Lines 3-3 (class Store):\nclass Store:\n"
+                       "Lines 7-9 (def size):\n    @property\n    def size(self):\n        return len(self.data)")
+
+    # Parsed once per blob SHA; a file that does not parse gets no context
+    parsed = []
+    builder_definitions = builder.definitions
+
+    async def counting_definitions(sha, filename, source):
+        if sha not in builder._definitions:
+            parsed.append(sha)
+        return await builder_definitions(sha, filename, source)
+
+    builder.definitions = counting_definitions
+    assert asyncio.run(builder.context(file, source)) == context
+    assert asyncio.run(builder.context({**file, "sha": "def"}, "not python at all (")) == ""
+    assert asyncio.run(builder.context({**file, "sha": "def"}, "not python at all (")) == ""
+    assert parsed == ["def"]
+    assert asyncio.run(builder.context({**file, "filename": "store.go"}, source)) == ""
+
+
+def test_suggestions_that_do_not_compile_are_downgraded():
+    import asyncio
+    from app.models.github import Comment
+    from app.services.suggestions import SuggestionValidator
+    from app.utils.general import parse_review_comments
+
+    review = ("[app.py]:2\nReturn early\n```suggestion\n    return None\n```\n"
+              "[app.py]:3\nBroken fix\n```suggestion\n    return (1,\n```\n")
+    comments = parse_review_comments(review)
+    # Indentation is kept; it decides whether the suggestion fits
+    assert [c.suggestion for c in comments] == ["    return None", "    return (1,"]
+
+    sources = {"sha-app": b"def handler():\n    x = 1\n    return x\n", "sha-bad": b"def broken(:\n    pass\n"}
+    loaded = []
+
+    async def load(sha):
+        loaded.append(sha)
+        return sources[sha]
+
+    diff_data = [{"filename": "app.py", "status": "modified", "sha": "sha-app"},
+                 {"filename": "bad.py", "status": "modified", "sha": "sha-bad"}]
+    # A file that does not compile as it is cannot judge its suggestions
+    comments.append(Comment("bad.py", 2, "Unrelated", "    return 1"))
+
+    validator = SuggestionValidator()
+    validated = asyncio.run(validator.validate(comments, diff_data, load))
+    assert [(c.message, c.suggestion) for c in validated] == [
+        ("Return early", "    return None"), ("Broken fix", None), ("Unrelated", "    return 1")
+    ]
+    assert sorted(loaded) == ["sha-app", "sha-bad"]
+
+    # Cached per (blob, line, suggestion): a replay loads and compiles nothing
+    loaded.clear()
+    dropping = SuggestionValidator(invalid_action="drop")
+    dropping._results = validator._results
+    validated = asyncio.run(dropping.validate(comments, diff_data, load))
+    assert [c.message for c in validated] == ["Return early", "Unrelated"]
+    assert loaded == []
+
+
+def test_comments_already_on_the_pr_are_not_posted_again():
+    import asyncio
+    import httpx
+    from app.models.github import Comment
+    from app.services.dedup import CommentDeduplicator
+
+    bot = {"login": "code-helper[bot]", "type": "Bot"}
+    existing = [
+        {"path": "app.py", "line": 3, "user": bot,
+         "body": "Prefer a context manager here, so the file is closed on errors.\n\n"
+                 "```suggestion\nwith open(path) as f:\n```"},
+        {"path": "app.py", "line": 20, "user": {"login": "alice", "type": "User"}, "body": "Add a test for this"},
+        # Outdated: its line is gone from the diff
+        {"path": "app.py", "line": None, "user": bot, "body": "Rename this variable"},
+    ]
+    requests = []
+
+    def github(request):
+        requests.append(request.headers.get("if-none-match"))
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, json=existing, headers={"ETag": '"v1"'})
+
+    new = [
+        Comment("app.py", 3, "Prefer a context manager here, so the file is closed on errors."),
+        # Reworded slightly and a line lower after a push
+        Comment("[app.py]", 4, "Prefer a context manager here so that the file is closed on errors!"),
+        Comment("app.py", 20, "Add a test for this"),
+        Comment("app.py", 9, "Rename this variable"),
+        Comment("app.py", 9, "Rename this variable."),
+    ]
+
+    async def run():
+        deduplicator = CommentDeduplicator(api_url="https://github.example")
+        async with httpx.AsyncClient(transport=httpx.MockTransport(github)) as client:
+            first = await deduplicator.filter(client, PR_URL, new, {})
+            second = await deduplicator.filter(client, PR_URL, new, {})
+        return first, second
+
+    first, second = asyncio.run(run())
+    # Only other people's and outdated remarks may be repeated, and only once per review
+    assert [(c.line, c.message) for c in first] == [(20, "Add a test for this"), (9, "Rename this variable")]
+    assert [c.message for c in second] == [c.message for c in first]
+    # The second review revalidated the cached index with the ETag
+    assert requests == [None, '"v1"']
+
+
+def test_cache_expires_evicts_and_computes_once_across_instances():
+    import asyncio
+    from app.utils.cache import MemoryCache, SQLiteCache
+
+    path = os.path.join(tempfile.mkdtemp(), "cache.db")
+    computed = []
+
+    async def compute(value):
+        computed.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    async def exercise():
+        # Two replicas sharing one cache file
+        first, second = SQLiteCache(path), SQLiteCache(path)
+        results = await asyncio.gather(*(first.get_or_compute("pr", "octo/widgets#7", lambda: compute({"files": 2}))
+                                         for _ in range(5)))
+        assert results == [{"files": 2}] * 5 and len(computed) == 1
+        assert await second.get_or_compute("pr", "octo/widgets#7", lambda: compute({"files": 3})) == {"files": 2}
+        assert await second.get("token", "octo/widgets#7") is None
+
+        await first.set("token", "1", "secret", ttl=-1)
+        assert await second.get("token", "1") is None
+        await first.delete("pr", "octo/widgets#7")
+        assert await second.get("pr", "octo/widgets#7") is None
+
+        # Least recently used entries go once the values outgrow the budget
+        small = SQLiteCache(os.path.join(tempfile.mkdtemp(), "cache.db"), max_bytes=100, touch_interval=0)
+        for i in range(4):
+            await small.set("blob", str(i), "x" * 28)
+            await small.get("blob", "0")
+        assert [await small.get("blob", str(i)) is not None for i in range(4)] == [True, False, True, True]
+
+        # Cancelling the caller that started a computation does not fail the others
+        shared = MemoryCache()
+        closed = []
+
+        async def uses_callers_client(value):
+            await asyncio.sleep(0.05)
+            # The cancelled leader closed the client its computation was using
+            if value == "first" and closed:
+                raise Exception("client closed")
+            return value
+
+        async def leader():
+            try:
+                await shared.get_or_compute("pr", "8", lambda: uses_callers_client("first"))
+            except asyncio.CancelledError:
+                closed.append(True)
+                raise
+
+        started = asyncio.ensure_future(leader())
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(shared.get_or_compute("pr", "8", lambda: uses_callers_client("second")))
+        await asyncio.sleep(0.01)
+        started.cancel()
+        assert await follower == "second"
+
+        memory = MemoryCache(max_entries=2)
+        for i in range(3):
+            await memory.set("review", str(i), i)
+        assert [await memory.get("review", str(i)) for i in range(3)] == [None, 1, 2]
+        for cache in (first, second, small):
+            await cache.close()
+
+    asyncio.run(exercise())
+
+
+def test_sampling_drops_only_info_and_above():
+    import logging
+    from app.utils.log import SamplingFilter
+
+    def record(level):
+        entry = logging.LogRecord("test", level, __file__, 1, "message", None, None)
+        entry.sample_rate = 0.0
+        return entry
+
+    sampling = SamplingFilter()
+    assert sampling.filter(record(logging.DEBUG))
+    assert not sampling.filter(record(logging.INFO))
+    assert sampling.filter(logging.LogRecord("test", logging.INFO, __file__, 1, "message", None, None))
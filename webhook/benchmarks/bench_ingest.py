@@ -0,0 +1,149 @@
+"""Benchmark webhook ingestion throughput for mixed GitHub event traffic.
+
+Run from the webhook directory:
+
+    python -m benchmarks.bench_ingest [--requests 2000] [--payload-kb 25]
+
+Compares the previous handler (buffer, verify, json.loads and validate every
+delivery) with the current one (header filter, streaming HMAC, action scan,
+orjson) on the same traffic mix. Deliveries are queued on an in-memory bus
+with no pipeline workers running, so only ingestion is measured.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import importlib.util
+import json
+import os
+import random
+import sys
+import time
+
+WEBHOOK_SECRET = "bench-secret"
+os.environ.update({"GITHUB_WEBHOOK_SECRET": WEBHOOK_SECRET, "PIPELINE_BUS": "memory", "LOG_LEVEL": "WARNING"})
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx  # noqa: E402
+from fastapi import FastAPI, HTTPException, Request  # noqa: E402
+from pydantic import BaseModel  # noqa: E402
+
+from tracing import instrument_app  # noqa: E402
+
+# (event, action, share of traffic); roughly what a busy repository sends
+TRAFFIC = (
+    ("push", None, 0.30),
+    ("check_run", "completed", 0.20),
+    ("check_suite", "completed", 0.10),
+    ("issue_comment", "created", 0.10),
+    ("pull_request", "synchronize", 0.15),
+    ("pull_request", "labeled", 0.08),
+    ("pull_request", "opened", 0.07),
+)
+
+
+def load_listener():
+    spec = importlib.util.spec_from_file_location("pr_listener", os.path.join(ROOT, "pr-listener.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def legacy_app(pipeline) -> FastAPI:
+    """The handler as it was before the fast path, for comparison"""
+    app = FastAPI()
+    # Same middleware as the real app, so only the handlers differ
+    instrument_app(app, "webhook")
+
+    class PullRequestPayload(BaseModel):
+        action: str
+        number: int
+        pull_request: dict
+        repository: dict
+        sender: dict
+
+    @app.post("/webhook")
+    async def github_webhook(request: Request):
+        signature_header = request.headers.get('x-hub-signature-256')
+        event_type = request.headers.get('x-github-event')
+        body = await request.body()
+        sha_name, signature = signature_header.split('=')
+        expected = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        if sha_name != 'sha256' or not hmac.compare_digest(signature, expected):
+            raise HTTPException(status_code=401, detail="Invalid signature")
+        payload = json.loads(body)
+        if event_type == 'pull_request':
+            pr_data = PullRequestPayload(**payload)
+            if pr_data.action in ('opened', 'reopened'):
+                await pipeline.submit(request.headers['x-github-delivery'], {"event": payload})
+
+    return app
+
+
+def make_delivery(event: str, action, number: int, payload_kb: int):
+    payload = {}
+    if action:
+        payload["action"] = action
+    payload.update({
+        "number": number,
+        "pull_request": {
+            "url": f"https://api.github.com/repos/o/r/pulls/{number}",
+            "title": f"PR {number}",
+            "user": {"login": "dev"},
+            "base": {"ref": "main"},
+            "head": {"ref": f"feature-{number}", "sha": f"{number:040d}"},
+            # Stand-in for the many fields GitHub sends that we never read
+            "body": "x" * (payload_kb * 1024),
+        },
+        "repository": {"full_name": "o/r", "description": "y" * 2048},
+        "sender": {"login": "dev"},
+    })
+    body = json.dumps(payload).encode()
+    headers = {
+        "X-GitHub-Event": event,
+        "X-GitHub-Delivery": f"delivery-{number}",
+        "X-Hub-Signature-256": "sha256=" + hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest(),
+        "Content-Type": "application/json",
+    }
+    return body, headers
+
+
+async def run(app, deliveries, concurrency: int = 16) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        queue = list(deliveries)
+
+        async def worker():
+            while queue:
+                body, headers = queue.pop()
+                response = await client.post("/webhook", content=body, headers=headers)
+                assert response.status_code < 400, response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--payload-kb", type=int, default=25)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    events = rng.choices([t[:2] for t in TRAFFIC], weights=[t[2] for t in TRAFFIC], k=args.requests)
+    deliveries = [make_delivery(event, action, n, args.payload_kb) for n, (event, action) in enumerate(events)]
+
+    listener = load_listener()
+    print(f"{args.requests} deliveries, ~{args.payload_kb} KB each, "
+          f"{sum(1 for e in events if e == ('pull_request', 'opened'))} reviewable")
+    print(f"{'handler':<10}{'req/s':>10}")
+    for name, app in (("legacy", legacy_app(listener.pipeline)), ("fast", listener.app)):
+        listener.pipeline.bus = type(listener.pipeline.bus)()
+        elapsed = await run(app, deliveries)
+        print(f"{name:<10}{args.requests / elapsed:>10.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
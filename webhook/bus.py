@@ -0,0 +1,252 @@
+"""Message bus used to hand review jobs between pipeline stages.
+
+Two local implementations share one interface:
+
+- InMemoryBus: asyncio queues; fast, but work is lost on restart.
+- SQLiteBus: a table-backed queue with leases, so messages survive restarts
+  and can be shared by several worker processes on one host.
+
+Delivery is at-least-once. Publishing with a `key` makes the handoff
+idempotent: a second publish of the same key is ignored.
+"""
+import asyncio
+import json
+import sqlite3
+import time
+import uuid
+from typing import Dict, Optional
+
+
+class Message:
+    def __init__(self, id: str, topic: str, payload: Dict, key: Optional[str] = None, attempts: int = 0):
+        self.id = id
+        self.topic = topic
+        self.payload = payload
+        self.key = key
+        self.attempts = attempts
+
+
+class MessageBus:
+    # Seconds a claim lasts before the message is handed out again; None if claims do not expire
+    lease_seconds: Optional[float] = None
+
+    async def publish(self, topic: str, payload: Dict, key: Optional[str] = None) -> bool:
+        """Enqueue a message; returns False if `key` was already published"""
+        raise NotImplementedError
+
+    async def consume(self, topic: str, timeout: float = 1.0) -> Optional[Message]:
+        """Claim the next message on `topic`, waiting up to `timeout` seconds"""
+        raise NotImplementedError
+
+    async def ack(self, message: Message):
+        """Mark a claimed message as done"""
+        raise NotImplementedError
+
+    async def nack(self, message: Message, delay: float = 0.0, dead: bool = False):
+        """Return a claimed message for redelivery after `delay`, or dead-letter it"""
+        raise NotImplementedError
+
+    async def release(self, message: Message):
+        """Hand back a claimed message unprocessed, for immediate redelivery without using up an attempt"""
+        raise NotImplementedError
+
+    async def extend(self, message: Message):
+        """Renew the lease on a claimed message that is still being handled"""
+        pass
+
+    async def depth(self, topic: str) -> int:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class InMemoryBus(MessageBus):
+    def __init__(self):
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._keys = set()
+        self.dead_letters = []
+
+    def _queue(self, topic: str) -> asyncio.Queue:
+        return self._queues.setdefault(topic, asyncio.Queue())
+
+    async def publish(self, topic: str, payload: Dict, key: Optional[str] = None) -> bool:
+        if key is not None:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+        self._queue(topic).put_nowait(Message(uuid.uuid4().hex, topic, payload, key))
+        return True
+
+    async def consume(self, topic: str, timeout: float = 1.0) -> Optional[Message]:
+        try:
+            message = await asyncio.wait_for(self._queue(topic).get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        message.attempts += 1
+        return message
+
+    async def ack(self, message: Message):
+        pass
+
+    async def nack(self, message: Message, delay: float = 0.0, dead: bool = False):
+        if dead:
+            self.dead_letters.append(message)
+            return
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self._queue(message.topic).put_nowait, message)
+        else:
+            self._queue(message.topic).put_nowait(message)
+
+    async def release(self, message: Message):
+        message.attempts -= 1
+        self._queue(message.topic).put_nowait(message)
+
+    async def depth(self, topic: str) -> int:
+        return self._queue(topic).qsize()
+
+
+class SQLiteBus(MessageBus):
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id TEXT PRIMARY KEY,
+        topic TEXT NOT NULL,
+        key TEXT UNIQUE,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'ready',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at REAL NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS messages_ready ON messages (topic, status, available_at);
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 300.0, poll_interval: float = 0.2,
+                 retention_seconds: float = 86400.0, prune_interval: float = 300.0):
+        self.path = path
+        # A claimed message not acked or extended within the lease is handed out again
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        # Done messages keep their key, so a late duplicate publish is still ignored,
+        # for this long; their payload is dropped as soon as they are acked
+        self.retention_seconds = retention_seconds
+        self.prune_interval = prune_interval
+        self._pruned_at = 0.0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(self.SCHEMA)
+        self._lock = asyncio.Lock()
+        self._wakeups: Dict[str, asyncio.Event] = {}
+
+    async def _run(self, fn, *args):
+        async with self._lock:
+            return await asyncio.to_thread(fn, *args)
+
+    def _publish(self, topic: str, payload: Dict, key: Optional[str]) -> bool:
+        now = time.time()
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO messages (id, topic, key, payload, available_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (uuid.uuid4().hex, topic, key, json.dumps(payload), now, now)
+        )
+        return cursor.rowcount == 1
+
+    async def publish(self, topic: str, payload: Dict, key: Optional[str] = None) -> bool:
+        inserted = await self._run(self._publish, topic, payload, key)
+        if inserted and topic in self._wakeups:
+            self._wakeups[topic].set()
+        return inserted
+
+    def _claim(self, topic: str) -> Optional[Message]:
+        now = time.time()
+        row = self._conn.execute(
+            "UPDATE messages SET status = 'claimed', attempts = attempts + 1, available_at = ? "
+            "WHERE id = (SELECT id FROM messages WHERE topic = ? AND available_at <= ? "
+            "AND status IN ('ready', 'claimed') ORDER BY available_at LIMIT 1) "
+            "RETURNING id, topic, key, payload, attempts",
+            (now + self.lease_seconds, topic, now)
+        ).fetchone()
+        if row is None:
+            return None
+        return Message(row[0], row[1], json.loads(row[3]), row[2], row[4])
+
+    async def consume(self, topic: str, timeout: float = 1.0) -> Optional[Message]:
+        deadline = time.monotonic() + timeout
+        wakeup = self._wakeups.setdefault(topic, asyncio.Event())
+        while True:
+            claim = asyncio.ensure_future(self._run(self._claim, topic))
+            try:
+                message = await asyncio.shield(claim)
+            except asyncio.CancelledError:
+                # The claim runs in a thread and may still succeed; hand it back
+                # rather than leave the message leased to a consumer that is gone
+                message = await claim
+                if message is not None:
+                    await self.release(message)
+                raise
+            if message is not None:
+                return message
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            wakeup.clear()
+            try:
+                # Woken early by local publishes; polling picks up other processes
+                await asyncio.wait_for(wakeup.wait(), min(self.poll_interval, remaining))
+            except asyncio.TimeoutError:
+                pass
+
+    def _ack(self, message_id: str):
+        now = time.time()
+        # Review payloads carry whole file contents; a done message only needs its key
+        self._conn.execute(
+            "UPDATE messages SET status = 'done', payload = '{}', available_at = ? WHERE id = ?", (now, message_id)
+        )
+        if now - self._pruned_at >= self.prune_interval:
+            self._pruned_at = now
+            self._conn.execute(
+                "DELETE FROM messages WHERE status = 'done' AND available_at < ?", (now - self.retention_seconds,)
+            )
+
+    async def ack(self, message: Message):
+        await self._run(self._ack, message.id)
+
+    def _nack(self, message_id: str, delay: float, dead: bool):
+        self._conn.execute(
+            "UPDATE messages SET status = ?, available_at = ? WHERE id = ?",
+            ("dead" if dead else "ready", time.time() + delay, message_id)
+        )
+
+    async def nack(self, message: Message, delay: float = 0.0, dead: bool = False):
+        await self._run(self._nack, message.id, delay, dead)
+
+    def _release(self, message_id: str):
+        self._conn.execute(
+            "UPDATE messages SET status = 'ready', available_at = ?, attempts = MAX(attempts - 1, 0) "
+            "WHERE id = ? AND status = 'claimed'",
+            (time.time(), message_id)
+        )
+
+    async def release(self, message: Message):
+        await self._run(self._release, message.id)
+
+    def _extend(self, message_id: str):
+        self._conn.execute(
+            "UPDATE messages SET available_at = ? WHERE id = ? AND status = 'claimed'",
+            (time.time() + self.lease_seconds, message_id)
+        )
+
+    async def extend(self, message: Message):
+        await self._run(self._extend, message.id)
+
+    def _depth(self, topic: str) -> int:
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE topic = ? AND status IN ('ready', 'claimed')", (topic,)
+        ).fetchone()[0]
+
+    async def depth(self, topic: str) -> int:
+        return await self._run(self._depth, topic)
+
+    async def close(self):
+        await self._run(self._conn.close)
@@ -0,0 +1,415 @@
+"""Staged review pipeline: ingest -> [schedule] -> fetch -> review -> post.
+
+Each stage consumes its own topic on the message bus, calls one downstream
+service, and publishes its result to the next stage's topic. Results travel
+with the message, so the bus doubles as the checkpoint store: after a crash a
+job resumes from the last stage that completed. Handoffs are keyed by
+"<job_id>:<stage>", which makes re-running a stage after a redelivery
+harmless up to the call it makes downstream.
+
+With a FairScheduler, ingested jobs wait on the "schedule" topic and are
+released to fetch in fair order between repositories (see scheduler.py).
+"""
+import asyncio
+import logging
+import os
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import httpx
+
+from bus import InMemoryBus, Message, MessageBus, SQLiteBus
+from scheduler import FairScheduler, InMemoryLedger, SQLiteLedger
+from tracing import registry, span, trace_headers, trace_id_var
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_BUS = os.getenv("PIPELINE_BUS", "sqlite")
+PIPELINE_DB_PATH = os.getenv("PIPELINE_DB_PATH", "pipeline.db")
+PIPELINE_MAX_ATTEMPTS = int(os.getenv("PIPELINE_MAX_ATTEMPTS", "5"))
+PIPELINE_RETRY_BASE_SECONDS = float(os.getenv("PIPELINE_RETRY_BASE_SECONDS", "2"))
+PIPELINE_HTTP_TIMEOUT = float(os.getenv("PIPELINE_HTTP_TIMEOUT", "300"))
+# On shutdown, in-flight stages get this long to finish; the rest are handed back
+# to the bus and resume from their last completed stage on the next start
+PIPELINE_DRAIN_SECONDS = float(os.getenv("PIPELINE_DRAIN_SECONDS", "20"))
+# A claimed message goes to another worker if its lease is not renewed; the
+# handling worker renews it every third of the lease while the stage runs
+PIPELINE_LEASE_SECONDS = float(os.getenv("PIPELINE_LEASE_SECONDS", "120"))
+# Finished messages are kept this long so duplicate deliveries are still recognized
+PIPELINE_DONE_RETENTION_SECONDS = float(os.getenv("PIPELINE_DONE_RETENTION_SECONDS", "86400"))
+
+REMOTE_REPO_SERVER_URL = os.getenv("REMOTE_REPO_SERVER_URL")
+LLM_SERVER_URL = os.getenv("LLM_SERVER_URL")
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "deepseek")
+
+# Default workers per stage; override with PIPELINE_WORKERS_<STAGE>
+DEFAULT_WORKERS = {"ingest": 1, "fetch": 4, "review": 8, "post": 2}
+
+REVIEW_ACTIONS = ("opened", "reopened")
+
+# Rough characters per token, for charging review jobs against token budgets
+CHARS_PER_TOKEN = 4
+
+stage_messages = registry.counter(
+    "pipeline_messages_total", "Messages handled per pipeline stage", ("stage", "outcome")
+)
+stage_depth = registry.gauge(
+    "pipeline_queue_depth", "Messages waiting or in flight per pipeline stage", ("stage",)
+)
+
+
+class StageError(Exception):
+    def __init__(self, message: str, retryable: bool = True, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+# payload -> payload for the next stage, or None to end the job here
+Handler = Callable[[Dict], Awaitable[Optional[Dict]]]
+
+
+class Stage:
+    def __init__(self, name: str, handler: Handler, next_stage: Optional[str] = None, workers: int = 1):
+        self.name = name
+        self.handler = handler
+        self.next_stage = next_stage
+        self.workers = workers
+
+
+def stage_workers(name: str) -> int:
+    return int(os.getenv(f"PIPELINE_WORKERS_{name.upper()}", DEFAULT_WORKERS.get(name, 1)))
+
+
+def create_bus(kind: str = PIPELINE_BUS) -> MessageBus:
+    if kind == "memory":
+        return InMemoryBus()
+    if kind == "sqlite":
+        return SQLiteBus(PIPELINE_DB_PATH, lease_seconds=PIPELINE_LEASE_SECONDS,
+                         retention_seconds=PIPELINE_DONE_RETENTION_SECONDS)
+    raise ValueError(f"Unknown PIPELINE_BUS: {kind}")
+
+
+def create_scheduler(kind: str = PIPELINE_BUS) -> FairScheduler:
+    """Fair scheduler whose ledger is shared the same way as the bus"""
+    ledger = SQLiteLedger(PIPELINE_DB_PATH) if kind == "sqlite" else InMemoryLedger()
+    return FairScheduler(ledger)
+
+
+class Pipeline:
+    """Runs a pool of workers per stage on top of a message bus"""
+
+    def __init__(self, bus: MessageBus, max_attempts: int = PIPELINE_MAX_ATTEMPTS,
+                 retry_base: float = PIPELINE_RETRY_BASE_SECONDS):
+        self.bus = bus
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.stages: Dict[str, Stage] = {}
+        self._first: Optional[str] = None
+        self._tasks: List[asyncio.Task] = []
+        # Worker tasks currently handling a message, as opposed to waiting for one
+        self._handling: Set[asyncio.Task] = set()
+        self._running = False
+        self.scheduler: Optional[FairScheduler] = None
+        self._schedule_topic: Optional[str] = None
+        self._scheduled_stage: Optional[str] = None
+
+    def add_stage(self, stage: Stage):
+        if self._first is None:
+            self._first = stage.name
+        self.stages[stage.name] = stage
+
+    def add_scheduler(self, topic: str, next_stage: str, scheduler: FairScheduler):
+        """Put `scheduler` between the stage publishing to `topic` and `next_stage`"""
+        self.scheduler = scheduler
+        self._schedule_topic = topic
+        self._scheduled_stage = next_stage
+
+    async def submit(self, job_id: str, payload: Dict) -> bool:
+        """Start a job at the first stage; returns False if the job was already submitted"""
+        return await self.bus.publish(self._first, {**payload, "job_id": job_id}, key=f"{job_id}:{self._first}")
+
+    async def start(self):
+        self._running = True
+        for stage in self.stages.values():
+            for _ in range(stage.workers):
+                self._tasks.append(asyncio.create_task(self._worker(stage)))
+        if self.scheduler is not None:
+            self._tasks.append(asyncio.create_task(self.scheduler.intake(self.bus, self._schedule_topic)))
+            self._tasks.append(asyncio.create_task(self.scheduler.dispatch(self.bus, self._scheduled_stage)))
+            if self.bus.lease_seconds:
+                self._tasks.append(asyncio.create_task(self.scheduler.keep_claimed(self.bus)))
+        logger.info("Pipeline started: %s",
+                    ", ".join(f"{s.name}x{s.workers}" for s in self.stages.values()))
+
+    async def stop(self, drain_seconds: float = PIPELINE_DRAIN_SECONDS):
+        """Stop taking messages, let in-flight stages finish within `drain_seconds`,
+        and hand back whatever is still running so the next start resumes it"""
+        self._running = False
+        busy = [task for task in self._tasks if task in self._handling]
+        for task in self._tasks:
+            if task not in self._handling:
+                task.cancel()
+        if busy:
+            logger.info("Draining %d in-flight pipeline messages", len(busy))
+            _, unfinished = await asyncio.wait(busy, timeout=drain_seconds)
+            if unfinished:
+                logger.warning("Handing back %d pipeline messages still running after %.0fs",
+                               len(unfinished), drain_seconds)
+            for task in unfinished:
+                task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.scheduler is not None:
+            # Claimed by intake but not yet released: hand them back now rather
+            # than after their lease, and without using up an attempt
+            for message in self.scheduler.drain():
+                try:
+                    await self.bus.release(message)
+                except Exception as e:
+                    logger.warning("Handing back scheduled message %s failed: %s", message.id, e)
+        await self.bus.close()
+        if self.scheduler is not None:
+            await self.scheduler.ledger.close()
+
+    async def status(self) -> Dict:
+        depths = {}
+        for name in self.stages:
+            depths[name] = await self.bus.depth(name)
+            stage_depth.set(depths[name], name)
+        status = {"stages": {name: {"workers": s.workers, "depth": depths[name]} for name, s in self.stages.items()}}
+        if self.scheduler is not None:
+            status["scheduler"] = {"depth": await self.bus.depth(self._schedule_topic), **self.scheduler.status()}
+        return status
+
+    async def _worker(self, stage: Stage):
+        while self._running:
+            try:
+                message = await self.bus.consume(stage.name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Consuming %s failed: %s", stage.name, e, exc_info=True)
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            task = asyncio.current_task()
+            self._handling.add(task)
+            try:
+                await self._handle(stage, message)
+            finally:
+                self._handling.discard(task)
+
+    async def _handle(self, stage: Stage, message: Message):
+        token = trace_id_var.set(message.payload.get("trace_id"))
+        job_id = message.payload.get("job_id")
+        heartbeat = asyncio.create_task(self._keep_claimed(message)) if self.bus.lease_seconds else None
+        try:
+            with span(stage.name, job_id=job_id, attempt=message.attempts):
+                result = await stage.handler(message.payload)
+            if result is not None and stage.next_stage:
+                # Publish before ack: a crash in between redelivers this message,
+                # and the keyed publish turns the second handoff into a no-op
+                await self.bus.publish(stage.next_stage, {**message.payload, **result},
+                                       key=f"{job_id}:{stage.next_stage}")
+            await self.bus.ack(message)
+            stage_messages.inc(stage.name, "ok")
+            if result is None or not stage.next_stage:
+                await self._finish(message)
+        except asyncio.CancelledError:
+            # Shut down before the stage finished: the message still carries the
+            # previous stages' results, so the next start resumes from here
+            try:
+                await self.bus.release(message)
+                stage_messages.inc(stage.name, "released")
+            except Exception as e:
+                logger.error("Handing back job %s at %s failed; it resumes when its lease expires: %s",
+                             job_id, stage.name, e)
+            raise
+        except Exception as e:
+            retryable = getattr(e, "retryable", True)
+            if not retryable or message.attempts >= self.max_attempts:
+                logger.error("Job %s failed at %s after %d attempts: %s",
+                             job_id, stage.name, message.attempts, e)
+                await self.bus.nack(message, dead=True)
+                stage_messages.inc(stage.name, "dead")
+                await self._finish(message)
+            else:
+                delay = getattr(e, "retry_after", None) or random.uniform(
+                    0, self.retry_base * 2 ** (message.attempts - 1))
+                logger.warning("Job %s failed at %s (attempt %d), retrying in %.1fs: %s",
+                               job_id, stage.name, message.attempts, delay, e)
+                await self.bus.nack(message, delay=delay)
+                stage_messages.inc(stage.name, "retry")
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+            trace_id_var.reset(token)
+
+    async def _keep_claimed(self, message: Message):
+        """Renew the message's lease while its stage runs, so a slow stage is not redelivered"""
+        while True:
+            await asyncio.sleep(self.bus.lease_seconds / 3)
+            try:
+                await self.bus.extend(message)
+            except Exception as e:
+                logger.warning("Renewing the lease on job %s failed: %s", message.payload.get("job_id"), e)
+
+    async def _finish(self, message: Message):
+        """The job left the pipeline; free its scheduler slot and charge its tokens"""
+        if self.scheduler is None:
+            return
+        try:
+            await self.scheduler.finish(message.payload.get("job_id"), message.payload.get("tokens", 0))
+        except Exception as e:
+            # The slot frees itself after SCHEDULER_IN_FLIGHT_TTL_SECONDS
+            logger.error("Recording the end of job %s failed: %s", message.payload.get("job_id"), e)
+
+
+def slim_pull_request_event(payload: Dict) -> Dict:
+    """Keep only the pull_request event fields the review flow reads"""
+    pull_request = payload.get('pull_request') or {}
+    return {
+        "action": payload.get('action'),
+        "number": payload.get('number'),
+        "pull_request": {
+            "url": pull_request.get('url', ''),
+            "title": pull_request.get('title', ''),
+            "user": {"login": (pull_request.get('user') or {}).get('login', '')},
+            "base": {"ref": (pull_request.get('base') or {}).get('ref', '')},
+            "head": {"ref": (pull_request.get('head') or {}).get('ref', ''),
+                     "sha": (pull_request.get('head') or {}).get('sha', '')},
+        },
+    }
+
+
+def pr_info_from_event(event: Dict) -> Dict:
+    pull_request = event.get("pull_request", {})
+    return {
+        "number": event.get("number"),
+        "title": pull_request.get('title', ''),
+        "author": pull_request.get('user', {}).get('login', ''),
+        "base_branch": pull_request.get('base', {}).get('ref', ''),
+        "head_branch": pull_request.get('head', {}).get('ref', ''),
+        "head_sha": pull_request.get('head', {}).get('sha', '')
+    }
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, in either its seconds or HTTP-date form.
+
+    None if the header is missing or unreadable, so the default backoff applies.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logger.warning("Ignoring unreadable Retry-After header: %r", value)
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _raise_for_status(response: httpx.Response, service: str):
+    if response.status_code < 400:
+        return
+    # Client errors other than timeouts and throttling will not succeed on retry
+    retryable = response.status_code >= 500 or response.status_code in (408, 429)
+    raise StageError(
+        f"{service} returned {response.status_code}: {response.text[:200]}",
+        retryable=retryable,
+        retry_after=parse_retry_after(response.headers.get("Retry-After")),
+    )
+
+
+class ReviewStages:
+    """Stage handlers for the review flow, sharing one HTTP client"""
+
+    def __init__(self):
+        self.client: Optional[httpx.AsyncClient] = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=PIPELINE_HTTP_TIMEOUT)
+        return self.client
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def ingest(self, payload: Dict) -> Optional[Dict]:
+        """Turn a pull_request event into a review job, dropping irrelevant actions"""
+        event = payload["event"]
+        if event.get("action") not in REVIEW_ACTIONS:
+            return None
+        pull_request = event.get("pull_request", {})
+        pr_info = pr_info_from_event(event)
+        logger.info(
+            "PR #%s was %s", pr_info["number"], event["action"],
+            extra={"pr_title": pr_info["title"], "pr_author": pr_info["author"]}
+        )
+        return {"event": None, "pr_url": pull_request.get('url', ''), "pr_info": pr_info}
+
+    async def fetch(self, payload: Dict) -> Dict:
+        response = await self.get_client().post(
+            REMOTE_REPO_SERVER_URL + "/pr/changes",
+            json={"pr_url": payload["pr_url"], "pr_info": payload["pr_info"], "forward": False},
+            headers=trace_headers()
+        )
+        _raise_for_status(response, "remote-repo-server")
+        return {"changes": response.json()}
+
+    async def review(self, payload: Dict) -> Dict:
+        response = await self.get_client().post(
+            f"{LLM_SERVER_URL}/process-prompt/{LLM_PROVIDER}",
+            json={"content": payload["changes"], "pr_url": payload["pr_url"],
+                  "pr_info": payload["pr_info"], "forward": False},
+            headers=trace_headers()
+        )
+        _raise_for_status(response, "llm-server")
+        # The changes are not needed past this point; keep the checkpoint small
+        review = response.json()
+        # Prompt plus completion, charged to the repo's daily budget: as the provider
+        # reported them, or estimated from sizes for stored and batched reviews
+        usage = review.get("usage") or {}
+        if usage.get("prompt_tokens") is not None and usage.get("completion_tokens") is not None:
+            tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+        else:
+            tokens = (len(response.request.content) + len(review["generated_text"])) // CHARS_PER_TOKEN
+        return {"changes": None, "generated_text": review["generated_text"], "prompt_hash": review.get("prompt_hash"),
+                "tokens": tokens}
+
+    async def post(self, payload: Dict) -> Dict:
+        response = await self.get_client().post(
+            REMOTE_REPO_SERVER_URL + "/reviews/create",
+            json={"pr_url": payload["pr_url"], "generated_text": payload["generated_text"],
+                  "head_sha": payload["pr_info"].get("head_sha"), "prompt_hash": payload.get("prompt_hash")},
+            headers=trace_headers()
+        )
+        _raise_for_status(response, "remote-repo-server")
+        return {}
+
+
+def build_review_pipeline(bus: MessageBus, stages: ReviewStages,
+                          scheduler: Optional[FairScheduler] = None) -> Pipeline:
+    pipeline = Pipeline(bus)
+    if scheduler is not None:
+        # Ingested jobs wait on the "schedule" topic for their fair turn
+        pipeline.add_stage(Stage("ingest", stages.ingest, "schedule", stage_workers("ingest")))
+        pipeline.add_scheduler("schedule", "fetch", scheduler)
+    else:
+        pipeline.add_stage(Stage("ingest", stages.ingest, "fetch", stage_workers("ingest")))
+    pipeline.add_stage(Stage("fetch", stages.fetch, "review", stage_workers("fetch")))
+    pipeline.add_stage(Stage("review", stages.review, "post", stage_workers("review")))
+    pipeline.add_stage(Stage("post", stages.post, None, stage_workers("post")))
+    return pipeline
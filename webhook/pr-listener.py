@@ -1,51 +1,113 @@
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, Response
 import hmac
 import hashlib
-import json
-from pydantic import BaseModel
+import logging
+import orjson
 import httpx
 import os
+import re
+import uuid
+from contextlib import asynccontextmanager
+from typing import Optional
 from dotenv import load_dotenv
 
-app = FastAPI()
-
-# Load environment variables
+# Load environment variables before pipeline reads its settings
 load_dotenv()
 
+from health import ReadinessCheck, add_health_routes, probe_url
+from log import SAMPLED, setup_logging
+from pipeline import (LLM_SERVER_URL, REVIEW_ACTIONS, ReviewStages, build_review_pipeline, create_bus,
+                      create_scheduler, pr_info_from_event, slim_pull_request_event)
+from scheduler import SCHEDULER_ENABLED
+from tracing import current_trace_id, instrument_app, span, trace_headers
+
+setup_logging("webhook")
+logger = logging.getLogger(__name__)
+
 # Add GitHub token for API access
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 
 # Service URLs
 REMOTE_REPO_SERVER_URL = os.getenv("REMOTE_REPO_SERVER_URL")
 
+# "event" queues deliveries on the staged pipeline; "http" keeps the old
+# synchronous webhook -> remote-repo-server -> llm-server chain
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "event")
+
 # Your webhook secret (set this in your environment variables in production)
 WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
 
-class PullRequestPayload(BaseModel):
-    action: str
-    number: int
-    pull_request: dict
-    repository: dict
-    sender: dict
+# Events we act on. Anything else is acknowledged without reading the body.
+HANDLED_EVENTS = ("pull_request",)
+
+# GitHub serializes "action" first, so irrelevant actions are dropped
+# after scanning the head of the body instead of parsing all of it
+ACTION_PATTERN = re.compile(rb'"action"\s*:\s*"([a-z_]+)"')
+ACTION_SCAN_BYTES = 256
 
-def verify_signature(payload_body: bytes, signature_header: str) -> bool:
-    """Verify that the webhook payload was sent from GitHub"""
-    if not signature_header:
-        return False
+async def read_verified_body(request: Request, signature_header: str) -> Optional[bytes]:
+    """Read the body while hashing it; returns None if the signature does not match"""
+    if not signature_header or '=' not in signature_header:
+        return None
 
     # Get the signature from the header
-    sha_name, signature = signature_header.split('=')
+    sha_name, signature = signature_header.split('=', 1)
     if sha_name != 'sha256':
-        return False
+        return None
+
+    # Hash chunks as they arrive rather than after buffering the whole body
+    digest = hmac.new(WEBHOOK_SECRET.encode('utf-8'), digestmod=hashlib.sha256)
+    chunks = []
+    async for chunk in request.stream():
+        digest.update(chunk)
+        chunks.append(chunk)
+
+    if not hmac.compare_digest(signature, digest.hexdigest()):
+        return None
+    return b"".join(chunks)
+
+def scan_action(body: bytes) -> Optional[str]:
+    match = ACTION_PATTERN.search(body, 0, ACTION_SCAN_BYTES)
+    return match.group(1).decode() if match else None
+
+review_stages = ReviewStages()
+pipeline = None
+if PIPELINE_MODE == "event":
+    pipeline = build_review_pipeline(create_bus(), review_stages,
+                                     create_scheduler() if SCHEDULER_ENABLED else None)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if pipeline is not None:
+        await pipeline.start()
+    yield
+    # Uvicorn has stopped accepting deliveries by now; in-flight stages drain or are handed back
+    if pipeline is not None:
+        await pipeline.stop()
+    await review_stages.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+# Every delivery starts a new trace; the ID is forwarded to downstream services
+instrument_app(app, "webhook")
+
+async def check_pipeline_bus():
+    return {"ingest_depth": await pipeline.bus.depth("ingest")}
+
+readiness = ReadinessCheck()
+if pipeline is not None:
+    readiness.add("pipeline_bus", check_pipeline_bus)
+# Downstream liveness rather than readiness, so one slow dependency does not
+# cascade through every service. In event mode deliveries keep queuing while
+# a downstream service is away, so only http mode depends on them to be ready.
+if REMOTE_REPO_SERVER_URL:
+    readiness.add("remote_repo_server", lambda: probe_url(f"{REMOTE_REPO_SERVER_URL}/health/live"),
+                  critical=pipeline is None)
+if LLM_SERVER_URL and pipeline is not None:
+    readiness.add("llm_server", lambda: probe_url(f"{LLM_SERVER_URL}/health/live"), critical=False)
+add_health_routes(app, readiness)
 
-    # Create our own signature
-    expected_signature = hmac.new(
-        WEBHOOK_SECRET.encode('utf-8'),
-        payload_body,
-        hashlib.sha256
-    ).hexdigest()
-
-    return hmac.compare_digest(signature, expected_signature)
 
 @app.get("/")
 async def root():
@@ -53,56 +115,67 @@ async def root():
 
 @app.post("/webhook")
 async def github_webhook(request: Request):
+    event_type = request.headers.get('x-github-event')
+    if event_type not in HANDLED_EVENTS:
+        return Response(status_code=204)
+
     # Get the signature from headers
     signature_header = request.headers.get('x-hub-signature-256')
-    event_type = request.headers.get('x-github-event')
-    
-    # Get the raw request body
-    body = await request.body()
-    
-    # Verify webhook signature
-    if not verify_signature(body, signature_header):
+
+    # Read the raw body, verifying the webhook signature on the way
+    body = await read_verified_body(request, signature_header)
+    if body is None:
         raise HTTPException(status_code=401, detail="Invalid signature")
 
-    # Parse the payload
-    payload = json.loads(body)
-
-    # Handle pull request events
-    if event_type == 'pull_request':
-        pr_data = PullRequestPayload(**payload)
-        
-        # Handle different PR actions
-        if pr_data.action == 'opened' or pr_data.action == 'reopened':
-            # Get basic PR info
-            pr_info = {
-                "number": pr_data.number,
-                "title": pr_data.pull_request.get('title', ''),
-                "author": pr_data.pull_request.get('user', {}).get('login', ''),
-                "base_branch": pr_data.pull_request.get('base', {}).get('ref', ''),
-                "head_branch": pr_data.pull_request.get('head', {}).get('ref', '')
-            }
-            print(f"PR #{pr_data.number} was opened")
-            print(pr_info)
-            
-            try:
-                # Call remote-repo-server to get PR changes
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        REMOTE_REPO_SERVER_URL + "/pr/changes",
-                        json={
-                            "pr_url": pr_data.pull_request.get('url', ''),
-                            "pr_info": pr_info
-                        }
-                    )
-                
-            except Exception as e:
-                print(f"Error processing PR: {str(e)}")
-                import traceback
-                print(traceback.format_exc())
+    # Most pull_request deliveries (synchronize, labeled, ...) are not reviewed
+    action = scan_action(body)
+    if action is not None and action not in REVIEW_ACTIONS:
+        return Response(status_code=204)
+
+    # Parse the payload, keeping only the fields the review flow reads
+    event = slim_pull_request_event(orjson.loads(body))
+    if event["action"] not in REVIEW_ACTIONS:
+        return Response(status_code=204)
+
+    if pipeline is not None:
+        # The ingest stage does the rest; GitHub's delivery ID makes redeliveries no-ops
+        job_id = request.headers.get('x-github-delivery') or uuid.uuid4().hex
+        queued = await pipeline.submit(job_id, {"event": event, "trace_id": current_trace_id()})
+        return JSONResponse(status_code=202, content={"job_id": job_id, "queued": queued})
+
+    # Get basic PR info
+    pr_info = pr_info_from_event(event)
+    logger.info(
+        "PR #%s was %s", event["number"], event["action"],
+        extra={"pr_title": pr_info["title"], "pr_author": pr_info["author"], **SAMPLED}
+    )
+
+    try:
+        # Call remote-repo-server to get PR changes
+        async with httpx.AsyncClient() as client:
+            with span("dispatch"):
+                await client.post(
+                    REMOTE_REPO_SERVER_URL + "/pr/changes",
+                    json={
+                        "pr_url": event["pull_request"]["url"],
+                        "pr_info": pr_info
+                    },
+                    headers=trace_headers()
+                )
+
+    except Exception as e:
+        logger.error("Error processing PR: %s", e, exc_info=True)
+
+@app.get("/pipeline")
+async def pipeline_status():
+    """Queue depth and worker count per pipeline stage"""
+    if pipeline is None:
+        raise HTTPException(status_code=404, detail="Pipeline is disabled")
+    return await pipeline.status()
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
+    """Liveness check; /health/ready also checks the pipeline and downstream services"""
     return {"status": "healthy"}
 
 if __name__ == "__main__":
@@ -0,0 +1,381 @@
+"""Fair scheduling of review jobs between tenants.
+
+A tenant is a repository, or a repository and PR author with
+SCHEDULER_FAIRNESS_KEY=repo_author. Ingested jobs wait in per-tenant queues
+and are released into the pipeline by weighted fair queuing, so a repository
+that opens hundreds of PRs at once cannot starve the others:
+
+- each job gets a virtual finish tag, max(V, tenant's last tag) + 1 / weight,
+  and the smallest tag among eligible tenants is released next (V is the tag
+  of the last released job, so idle tenants do not bank credit);
+- at most SCHEDULER_MAX_IN_FLIGHT jobs are between release and the end of the
+  pipeline, so the downstream FIFO queues stay short;
+- a tenant is skipped while it has max_concurrency jobs in flight or has used
+  its daily token budget (UTC day).
+
+In-flight jobs and token use are kept in a ledger. With the SQLite bus the
+ledger lives in the same database, so caps and budgets hold across worker
+processes; the queues themselves are per process, which keeps fairness
+approximate when several processes share the bus.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from bus import Message, MessageBus
+from tracing import registry
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+# "repo" or "repo_author"
+SCHEDULER_FAIRNESS_KEY = os.getenv("SCHEDULER_FAIRNESS_KEY", "repo")
+SCHEDULER_MAX_IN_FLIGHT = int(os.getenv("SCHEDULER_MAX_IN_FLIGHT", "8"))
+# Jobs one process holds in its queues before it stops claiming more
+SCHEDULER_MAX_PENDING = int(os.getenv("SCHEDULER_MAX_PENDING", "1000"))
+SCHEDULER_DEFAULT_WEIGHT = float(os.getenv("SCHEDULER_DEFAULT_WEIGHT", "1"))
+# 0 means no per-tenant limit
+SCHEDULER_DEFAULT_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_DEFAULT_MAX_CONCURRENCY", "0"))
+SCHEDULER_DEFAULT_DAILY_TOKENS = int(os.getenv("SCHEDULER_DEFAULT_DAILY_TOKENS", "0"))
+# Per-tenant overrides, e.g.
+# {"octo/monorepo": {"weight": 0.25, "max_concurrency": 2, "daily_tokens": 2000000}}
+SCHEDULER_TENANTS = os.getenv("SCHEDULER_TENANTS", "{}")
+# A job that never reports back stops counting as in flight after this long
+SCHEDULER_IN_FLIGHT_TTL_SECONDS = float(os.getenv("SCHEDULER_IN_FLIGHT_TTL_SECONDS", "3600"))
+
+queue_depth = registry.gauge(
+    "scheduler_queue_depth", "Review jobs waiting for release per tenant", ("tenant",)
+)
+in_flight = registry.gauge(
+    "scheduler_in_flight", "Review jobs released and not yet finished per tenant", ("tenant",)
+)
+tokens_today = registry.gauge(
+    "scheduler_tokens_today", "Tokens used today per tenant", ("tenant",)
+)
+queue_wait = registry.histogram(
+    "scheduler_wait_seconds", "Time review jobs wait for release per tenant", ("tenant",)
+)
+jobs_released = registry.counter(
+    "scheduler_jobs_released_total", "Review jobs released into the pipeline per tenant", ("tenant",)
+)
+
+
+class TenantPolicy:
+    def __init__(self, weight: float = SCHEDULER_DEFAULT_WEIGHT,
+                 max_concurrency: int = SCHEDULER_DEFAULT_MAX_CONCURRENCY,
+                 daily_tokens: int = SCHEDULER_DEFAULT_DAILY_TOKENS):
+        if weight <= 0:
+            raise ValueError("Tenant weight must be positive")
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.daily_tokens = daily_tokens
+
+
+def load_policies(raw: str = SCHEDULER_TENANTS) -> Dict[str, TenantPolicy]:
+    return {tenant: TenantPolicy(**config) for tenant, config in json.loads(raw).items()}
+
+
+def tenant_key(payload: Dict, by_author: bool = SCHEDULER_FAIRNESS_KEY == "repo_author") -> str:
+    """'owner/repo' from the PR URL, with ':author' appended when scheduling by author"""
+    parts = payload.get("pr_url", "").split("/")
+    repo = f"{parts[-4]}/{parts[-3]}" if len(parts) >= 4 else "unknown"
+    if by_author:
+        return f"{repo}:{(payload.get('pr_info') or {}).get('author', '')}"
+    return repo
+
+
+def day_start(now: Optional[float] = None) -> float:
+    now = time.time() if now is None else now
+    return now - now % 86400
+
+
+class InMemoryLedger:
+    """Ledger for a single process, paired with InMemoryBus"""
+
+    def __init__(self, in_flight_ttl: float = SCHEDULER_IN_FLIGHT_TTL_SECONDS):
+        self.in_flight_ttl = in_flight_ttl
+        # job_id -> [tenant, released_at, finished_at, tokens]
+        self._jobs: Dict[str, list] = {}
+
+    async def release(self, job_id: str, tenant: str):
+        self._jobs.setdefault(job_id, [tenant, time.time(), None, 0])
+
+    async def finish(self, job_id: str, tokens: int):
+        job = self._jobs.get(job_id)
+        if job is not None and job[2] is None:
+            job[2], job[3] = time.time(), tokens
+
+    async def usage(self) -> Dict[str, Tuple[int, int]]:
+        """tenant -> (jobs in flight, tokens used today)"""
+        now, today = time.time(), day_start()
+        usage: Dict[str, Tuple[int, int]] = {}
+        for job_id, (tenant, released_at, finished_at, tokens) in list(self._jobs.items()):
+            running, used = usage.get(tenant, (0, 0))
+            if finished_at is None and now - released_at < self.in_flight_ttl:
+                running += 1
+            elif finished_at is not None and finished_at >= today:
+                used += tokens
+            elif finished_at is not None:
+                # Finished before today; no longer needed
+                del self._jobs[job_id]
+                continue
+            usage[tenant] = (running, used)
+        return usage
+
+    async def close(self):
+        pass
+
+
+class SQLiteLedger(InMemoryLedger):
+    """Ledger shared by every process using the same pipeline database"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS scheduled_jobs (
+        job_id TEXT PRIMARY KEY,
+        tenant TEXT NOT NULL,
+        released_at REAL NOT NULL,
+        finished_at REAL,
+        tokens INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS scheduled_jobs_open ON scheduled_jobs (finished_at, tenant);
+    """
+
+    def __init__(self, path: str, in_flight_ttl: float = SCHEDULER_IN_FLIGHT_TTL_SECONDS):
+        super().__init__(in_flight_ttl)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(self.SCHEMA)
+        self._lock = asyncio.Lock()
+
+    async def _run(self, fn, *args):
+        async with self._lock:
+            return await asyncio.to_thread(fn, *args)
+
+    def _release(self, job_id: str, tenant: str):
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR IGNORE INTO scheduled_jobs (job_id, tenant, released_at) VALUES (?, ?, ?)",
+            (job_id, tenant, now)
+        )
+        # Rows from before today no longer count towards anything
+        self._conn.execute(
+            "DELETE FROM scheduled_jobs WHERE finished_at < ? OR (finished_at IS NULL AND released_at < ?)",
+            (day_start(now), min(day_start(now), now - self.in_flight_ttl))
+        )
+
+    async def release(self, job_id: str, tenant: str):
+        await self._run(self._release, job_id, tenant)
+
+    def _finish(self, job_id: str, tokens: int):
+        self._conn.execute(
+            "UPDATE scheduled_jobs SET finished_at = ?, tokens = ? WHERE job_id = ? AND finished_at IS NULL",
+            (time.time(), tokens, job_id)
+        )
+
+    async def finish(self, job_id: str, tokens: int):
+        await self._run(self._finish, job_id, tokens)
+
+    def _usage(self) -> Dict[str, Tuple[int, int]]:
+        now = time.time()
+        rows = self._conn.execute(
+            "SELECT tenant, "
+            "SUM(CASE WHEN finished_at IS NULL AND released_at > ? THEN 1 ELSE 0 END), "
+            "SUM(CASE WHEN finished_at >= ? THEN tokens ELSE 0 END) "
+            "FROM scheduled_jobs WHERE finished_at IS NULL OR finished_at >= ? GROUP BY tenant",
+            (now - self.in_flight_ttl, day_start(now), day_start(now))
+        ).fetchall()
+        return {tenant: (running, used) for tenant, running, used in rows}
+
+    async def usage(self) -> Dict[str, Tuple[int, int]]:
+        return await self._run(self._usage)
+
+    async def close(self):
+        await self._run(self._conn.close)
+
+
+class _Job:
+    __slots__ = ("message", "tenant", "tag", "queued_at")
+
+    def __init__(self, message: Message, tenant: str, tag: float):
+        self.message = message
+        self.tenant = tenant
+        self.tag = tag
+        self.queued_at = time.monotonic()
+
+
+class FairScheduler:
+    """Weighted fair queuing between tenants in front of a pipeline stage"""
+
+    def __init__(self, ledger: InMemoryLedger, policies: Optional[Dict[str, TenantPolicy]] = None,
+                 default_policy: Optional[TenantPolicy] = None,
+                 max_in_flight: int = SCHEDULER_MAX_IN_FLIGHT, max_pending: int = SCHEDULER_MAX_PENDING,
+                 by_author: bool = SCHEDULER_FAIRNESS_KEY == "repo_author"):
+        self.ledger = ledger
+        self.policies = policies if policies is not None else load_policies()
+        self.default_policy = default_policy or TenantPolicy()
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.by_author = by_author
+        self._queues: Dict[str, Deque[_Job]] = {}
+        self._waiting: Dict[str, _Job] = {}
+        self._last_tag: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._usage: Dict[str, Tuple[int, int]] = {}
+        self._changed = asyncio.Event()
+
+    def policy(self, tenant: str) -> TenantPolicy:
+        # "owner/repo:author" falls back to the repository's policy
+        return self.policies.get(tenant) or self.policies.get(tenant.split(":")[0]) or self.default_policy
+
+    @property
+    def pending(self) -> int:
+        return len(self._waiting)
+
+    def enqueue(self, message: Message):
+        job_id = message.payload.get("job_id")
+        if job_id in self._waiting:
+            # Redelivered after its lease ran out; it already holds a place
+            return
+        tenant = tenant_key(message.payload, self.by_author)
+        start = max(self._virtual_time, self._last_tag.get(tenant, 0.0))
+        tag = start + 1.0 / self.policy(tenant).weight
+        self._last_tag[tenant] = tag
+        job = _Job(message, tenant, tag)
+        self._waiting[job_id] = job
+        self._queues.setdefault(tenant, deque()).append(job)
+        queue_depth.set(len(self._queues[tenant]), tenant)
+        self._changed.set()
+
+    def _eligible(self, tenant: str, total_in_flight: int) -> bool:
+        if total_in_flight >= self.max_in_flight:
+            return False
+        policy = self.policy(tenant)
+        running, used = self._usage.get(tenant, (0, 0))
+        if policy.max_concurrency and running >= policy.max_concurrency:
+            return False
+        if policy.daily_tokens and used >= policy.daily_tokens:
+            return False
+        return True
+
+    def next_job(self) -> Optional[_Job]:
+        """Pop the eligible job with the smallest finish tag, given the last usage snapshot"""
+        total = sum(running for running, _ in self._usage.values())
+        best = None
+        for tenant, queue in self._queues.items():
+            if queue and (best is None or queue[0].tag < best.tag) and self._eligible(tenant, total):
+                best = queue[0]
+        if best is None:
+            return None
+        self._queues[best.tenant].popleft()
+        del self._waiting[best.message.payload.get("job_id")]
+        queue_depth.set(len(self._queues[best.tenant]), best.tenant)
+        self._virtual_time = best.tag
+        running, used = self._usage.get(best.tenant, (0, 0))
+        self._usage[best.tenant] = (running + 1, used)
+        return best
+
+    def drain(self) -> List[Message]:
+        """Empty the queues, returning the claimed messages of every job still waiting"""
+        messages = [job.message for job in self._waiting.values()]
+        for tenant in self._queues:
+            queue_depth.set(0, tenant)
+        self._queues.clear()
+        self._waiting.clear()
+        return messages
+
+    async def refresh_usage(self):
+        self._usage = await self.ledger.usage()
+        for tenant, (running, used) in self._usage.items():
+            in_flight.set(running, tenant)
+            tokens_today.set(used, tenant)
+
+    async def finish(self, job_id: str, tokens: int = 0):
+        """A released job left the pipeline (done, dropped or dead-lettered)"""
+        await self.ledger.finish(job_id, tokens)
+        self._changed.set()
+
+    async def intake(self, bus: MessageBus, topic: str):
+        """Claim waiting jobs from `topic` into the per-tenant queues"""
+        while True:
+            if self.pending >= self.max_pending:
+                await asyncio.sleep(0.5)
+                continue
+            try:
+                message = await bus.consume(topic)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Consuming %s failed: %s", topic, e, exc_info=True)
+                await asyncio.sleep(1)
+                continue
+            if message is not None:
+                self.enqueue(message)
+
+    async def keep_claimed(self, bus: MessageBus):
+        """Renew the leases of queued jobs, so one waiting its turn longer than a
+        lease is not redelivered and queued again by another process"""
+        while True:
+            await asyncio.sleep(bus.lease_seconds / 3)
+            for job in list(self._waiting.values()):
+                try:
+                    await bus.extend(job.message)
+                except Exception as e:
+                    logger.warning("Renewing the lease on queued job %s failed: %s",
+                                   job.message.payload.get("job_id"), e)
+
+    async def dispatch(self, bus: MessageBus, next_topic: str):
+        """Release jobs to `next_topic` in fair order as capacity frees up"""
+        while True:
+            try:
+                await self.refresh_usage()
+                job = self.next_job()
+                while job is not None:
+                    await self._release(bus, job, next_topic)
+                    job = self.next_job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Scheduler dispatch failed: %s", e, exc_info=True)
+            self._changed.clear()
+            try:
+                # Finishes in other processes and the budget day rolling over
+                # are only seen by polling the ledger
+                await asyncio.wait_for(self._changed.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _release(self, bus: MessageBus, job: _Job, next_topic: str):
+        payload = job.message.payload
+        job_id = payload.get("job_id")
+        # Recorded before the handoff so the job's finish always finds it;
+        # releasing the same job twice is a no-op in the ledger
+        await self.ledger.release(job_id, job.tenant)
+        # Publish before ack, as in Pipeline: a keyed publish that returns
+        # False means an earlier claim of this job was already released
+        if await bus.publish(next_topic, payload, key=f"{job_id}:{next_topic}"):
+            queue_wait.observe(time.monotonic() - job.queued_at, job.tenant)
+            jobs_released.inc(job.tenant)
+        await bus.ack(job.message)
+
+    def status(self) -> Dict:
+        tenants = set(self._queues) | set(self._usage)
+        return {
+            "max_in_flight": self.max_in_flight,
+            "tenants": {
+                tenant: {
+                    "queued": len(self._queues.get(tenant, ())),
+                    "in_flight": self._usage.get(tenant, (0, 0))[0],
+                    "tokens_today": self._usage.get(tenant, (0, 0))[1],
+                    "weight": self.policy(tenant).weight,
+                    "max_concurrency": self.policy(tenant).max_concurrency or None,
+                    "daily_tokens": self.policy(tenant).daily_tokens or None,
+                }
+                for tenant in sorted(tenants)
+            },
+        }
@@ -0,0 +1,71 @@
+import hashlib
+import hmac
+import importlib.util
+import json
+import os
+
+os.environ.setdefault("GITHUB_WEBHOOK_SECRET", "test-secret")
+os.environ["PIPELINE_BUS"] = "memory"
+
+from fastapi.testclient import TestClient
+
+spec = importlib.util.spec_from_file_location(
+    "pr_listener", os.path.join(os.path.dirname(os.path.abspath(__file__)), "pr-listener.py")
+)
+listener = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(listener)
+
+# Not used as a context manager, so no pipeline workers consume the queue
+client = TestClient(listener.app)
+
+
+def deliver(event: str, action: str, delivery: str, secret: str = "test-secret"):
+    body = json.dumps({
+        "action": action,
+        "number": 5,
+        "pull_request": {
+            "url": "https://api.github.com/repos/o/r/pulls/5",
+            "title": "Add cache",
+            "user": {"login": "dev"},
+            "base": {"ref": "main"},
+            "head": {"ref": "feature", "sha": "f" * 40},
+            "body": "long description " * 100,
+        },
+        "repository": {"full_name": "o/r"},
+        "sender": {"login": "dev"},
+    }).encode()
+    signature = "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return client.post("/webhook", content=body, headers={
+        "X-GitHub-Event": event, "X-GitHub-Delivery": delivery, "X-Hub-Signature-256": signature,
+    })
+
+
+def test_ignored_events_are_acknowledged_without_verification():
+    assert deliver("push", "", "d1", secret="wrong").status_code == 204
+    assert deliver("pull_request", "synchronize", "d2").status_code == 204
+
+
+def test_pull_request_requires_valid_signature():
+    assert deliver("pull_request", "opened", "d3", secret="wrong").status_code == 401
+
+
+def test_opened_pull_request_is_queued_with_only_needed_fields():
+    response = deliver("pull_request", "opened", "d4")
+    assert response.status_code == 202, response.text
+    assert response.json() == {"job_id": "d4", "queued": True}
+    assert deliver("pull_request", "opened", "d4").json()["queued"] is False
+
+    message = listener.pipeline.bus._queue("ingest").get_nowait()
+    event = message.payload["event"]
+    assert event["pull_request"]["head"]["sha"] == "f" * 40
+    assert "body" not in event["pull_request"] and "repository" not in event
+
+
+def test_readiness_reports_pipeline_bus():
+    listener.readiness._checked_at = None
+    response = client.get("/health/ready")
+    assert response.status_code == 200, response.text
+    check = response.json()["checks"]["pipeline_bus"]
+    assert check["status"] == "ok" and check["critical"] is True
+    assert isinstance(check["ingest_depth"], int)
+    assert client.get("/health/live").json() == {"status": "alive"}
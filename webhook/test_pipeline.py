@@ -0,0 +1,341 @@
+import asyncio
+import sqlite3
+
+from bus import InMemoryBus, Message, SQLiteBus
+from pipeline import Pipeline, Stage, StageError, parse_retry_after
+from scheduler import FairScheduler, InMemoryLedger, SQLiteLedger, TenantPolicy
+
+
+def build(bus, calls, fail_post_times=0, permanent=False):
+    failures = {"post": fail_post_times}
+
+    async def fetch(payload):
+        calls.append(("fetch", payload["job_id"]))
+        return {"changes": {"additions": 1}}
+
+    async def post(payload):
+        calls.append(("post", payload["job_id"]))
+        if failures["post"]:
+            failures["post"] -= 1
+            raise StageError("GitHub unavailable", retryable=not permanent, retry_after=0.01)
+        assert payload["changes"] == {"additions": 1}
+        return {}
+
+    pipeline = Pipeline(bus, max_attempts=3, retry_base=0.01)
+    pipeline.add_stage(Stage("fetch", fetch, "post", workers=2))
+    pipeline.add_stage(Stage("post", post, None, workers=1))
+    return pipeline
+
+
+async def run_until(pipeline, condition, timeout=5.0):
+    await pipeline.start()
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition() and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.01)
+    await pipeline.stop()
+
+
+def test_pipeline_runs_stages_and_ignores_duplicate_jobs():
+    async def scenario():
+        calls = []
+        pipeline = build(InMemoryBus(), calls)
+        assert await pipeline.submit("delivery-1", {"trace_id": "t1"})
+        assert not await pipeline.submit("delivery-1", {"trace_id": "t1"})
+        await run_until(pipeline, lambda: ("post", "delivery-1") in calls)
+        return calls
+
+    assert asyncio.run(scenario()) == [("fetch", "delivery-1"), ("post", "delivery-1")]
+
+
+def test_pipeline_retries_then_dead_letters():
+    async def scenario():
+        calls, bus = [], InMemoryBus()
+        pipeline = build(bus, calls, fail_post_times=10)
+        await pipeline.submit("delivery-1", {})
+        await run_until(pipeline, lambda: bus.dead_letters)
+        return calls, bus.dead_letters
+
+    calls, dead = asyncio.run(scenario())
+    assert calls.count(("post", "delivery-1")) == 3
+    assert calls.count(("fetch", "delivery-1")) == 1
+    assert len(dead) == 1
+
+
+def test_sqlite_bus_resumes_from_checkpoint(tmp_path):
+    path = str(tmp_path / "pipeline.db")
+
+    async def first_run():
+        # Post fails permanently, so the job stops after the fetch checkpoint
+        calls = []
+        pipeline = build(SQLiteBus(path), calls, fail_post_times=1, permanent=True)
+        await pipeline.submit("delivery-1", {})
+        await run_until(pipeline, lambda: ("post", "delivery-1") in calls)
+        return calls
+
+    async def redelivery():
+        # The same delivery arriving after a restart is not processed again
+        calls = []
+        pipeline = build(SQLiteBus(path), calls)
+        queued = await pipeline.submit("delivery-1", {})
+        await run_until(pipeline, lambda: False, timeout=0.3)
+        return queued, calls
+
+    assert asyncio.run(first_run()) == [("fetch", "delivery-1"), ("post", "delivery-1")]
+    assert asyncio.run(redelivery()) == (False, [])
+
+
+def test_sqlite_bus_redelivers_expired_leases(tmp_path):
+    async def scenario():
+        bus = SQLiteBus(str(tmp_path / "pipeline.db"), lease_seconds=0.05)
+        await bus.publish("fetch", {"job_id": "1"}, key="1:fetch")
+        first = await bus.consume("fetch", timeout=0.1)
+        # The worker holding the message died without acking it
+        await asyncio.sleep(0.1)
+        second = await bus.consume("fetch", timeout=0.1)
+        await bus.ack(second)
+        remaining = await bus.depth("fetch")
+        await bus.close()
+        return first, second, remaining
+
+    first, second, remaining = asyncio.run(scenario())
+    assert first.id == second.id and second.attempts == 2
+    assert remaining == 0
+
+
+def test_slow_stage_keeps_its_lease_and_done_messages_are_pruned(tmp_path):
+    async def scenario():
+        bus = SQLiteBus(str(tmp_path / "pipeline.db"), lease_seconds=0.1, retention_seconds=0, prune_interval=0)
+        calls = []
+        pipeline = build(bus, calls)
+
+        async def slow_post(payload):
+            calls.append(("post", payload["job_id"]))
+            # Three leases long; the worker renews its claim meanwhile
+            await asyncio.sleep(0.3)
+            return {}
+
+        pipeline.stages["post"].handler = slow_post
+        # An idle second worker would pick the message up if the lease lapsed
+        pipeline.stages["post"].workers = 2
+        await pipeline.submit("delivery-1", {})
+        await pipeline.start()
+        while await bus.depth("post") or ("post", "delivery-1") not in calls:
+            await asyncio.sleep(0.01)
+        rows = await bus._run(lambda: bus._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0])
+        await pipeline.stop()
+        return calls, rows
+
+    calls, rows = asyncio.run(scenario())
+    assert calls == [("fetch", "delivery-1"), ("post", "delivery-1")]
+    # The fetch message was deleted when the post was acked
+    assert rows == 1
+
+
+def test_shutdown_hands_back_unfinished_stages_for_the_next_start(tmp_path):
+    path = str(tmp_path / "pipeline.db")
+
+    async def interrupted():
+        calls = []
+        pipeline = build(SQLiteBus(path), calls)
+
+        async def slow_post(payload):
+            calls.append(("post", payload["job_id"]))
+            await asyncio.sleep(60)
+
+        pipeline.stages["post"].handler = slow_post
+        await pipeline.submit("delivery-1", {})
+        await pipeline.start()
+        while ("post", "delivery-1") not in calls:
+            await asyncio.sleep(0.01)
+        started = asyncio.get_running_loop().time()
+        await pipeline.stop(drain_seconds=0.05)
+        return calls, asyncio.get_running_loop().time() - started
+
+    async def restarted():
+        # Default lease is 300 s: only a handed-back message is picked up right away
+        calls = []
+        pipeline = build(SQLiteBus(path), calls)
+        await run_until(pipeline, lambda: ("post", "delivery-1") in calls, timeout=2)
+        return calls
+
+    calls, stop_seconds = asyncio.run(interrupted())
+    assert calls == [("fetch", "delivery-1"), ("post", "delivery-1")]
+    assert stop_seconds < 1
+    # Resumes at post with the fetch result, without fetching again
+    assert asyncio.run(restarted()) == [("post", "delivery-1")]
+
+
+def test_retry_after_accepts_seconds_and_http_dates():
+    from datetime import datetime, timedelta, timezone
+    from email.utils import format_datetime
+
+    assert parse_retry_after("7") == 7.0
+    in_a_minute = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+    assert 55 < parse_retry_after(in_a_minute) <= 60
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("soon") is None and parse_retry_after(None) is None
+
+
+def job(job_id, repo):
+    return Message(job_id, "schedule", {"job_id": job_id, "pr_url": f"https://api.github.com/repos/{repo}/pulls/1"})
+
+
+def release_order(scheduler):
+    async def drain():
+        order = []
+        await scheduler.refresh_usage()
+        released = scheduler.next_job()
+        while released is not None:
+            order.append(released.message.id)
+            released = scheduler.next_job()
+        return order
+    return asyncio.run(drain())
+
+
+def test_scheduler_interleaves_tenants_by_weight():
+    scheduler = FairScheduler(InMemoryLedger(), policies={"octo/mono": TenantPolicy(weight=0.5)},
+                              max_in_flight=100)
+    for n in range(6):
+        scheduler.enqueue(job(f"mono-{n}", "octo/mono"))
+    scheduler.enqueue(job("small-0", "team/app"))
+    scheduler.enqueue(job("small-1", "team/app"))
+    scheduler.enqueue(job("mono-0", "octo/mono"))  # redelivery keeps its place
+
+    order = release_order(scheduler)
+    # Arriving behind a burst, the small repo still goes first at twice the weight
+    assert order[:4] == ["small-0", "mono-0", "small-1", "mono-1"]
+    assert len(order) == 8
+
+
+def test_scheduler_enforces_concurrency_caps_and_token_budgets(tmp_path):
+    ledger = SQLiteLedger(str(tmp_path / "pipeline.db"))
+    scheduler = FairScheduler(ledger, policies={
+        "octo/mono": TenantPolicy(max_concurrency=1),
+        "team/app": TenantPolicy(daily_tokens=1000),
+    }, max_in_flight=10)
+    for n in range(3):
+        scheduler.enqueue(job(f"mono-{n}", "octo/mono"))
+        scheduler.enqueue(job(f"small-{n}", "team/app"))
+
+    async def scenario():
+        bus = InMemoryBus()
+        rounds = []
+        for _ in range(3):
+            await scheduler.refresh_usage()
+            released = []
+            while (next_job := scheduler.next_job()) is not None:
+                await scheduler._release(bus, next_job, "fetch")
+                released.append(next_job.message.id)
+            rounds.append(released)
+            for job_id in released:
+                await scheduler.finish(job_id, tokens=600)
+        return rounds, scheduler.status()["tenants"], await bus.depth("fetch")
+
+    rounds, tenants, released = asyncio.run(scenario())
+    # One mono job at a time; the small repo runs freely until its budget is spent
+    assert rounds == [["mono-0", "small-0", "small-1", "small-2"], ["mono-1"], ["mono-2"]]
+    assert tenants["team/app"]["tokens_today"] == 1800
+    assert released == 6
+
+
+def test_pipeline_releases_jobs_through_scheduler():
+    async def scenario():
+        calls, bus = [], InMemoryBus()
+        scheduler = FairScheduler(InMemoryLedger(), policies={"team/app": TenantPolicy(weight=2)},
+                                  max_in_flight=1)
+
+        async def ingest(payload):
+            return {"pr_url": f"https://api.github.com/repos/{payload['repo']}/pulls/1"}
+
+        async def fetch(payload):
+            # Long enough for every job to be queued before the slot frees
+            await asyncio.sleep(0.05)
+            return {"tokens": 10}
+
+        async def post(payload):
+            calls.append(payload["job_id"])
+            return {}
+
+        pipeline = Pipeline(bus, max_attempts=3, retry_base=0.01)
+        pipeline.add_stage(Stage("ingest", ingest, "schedule"))
+        pipeline.add_scheduler("schedule", "fetch", scheduler)
+        pipeline.add_stage(Stage("fetch", fetch, "post"))
+        pipeline.add_stage(Stage("post", post, None))
+        for n, repo in enumerate(["octo/mono", "octo/mono", "team/app"]):
+            await pipeline.submit(f"job-{n}", {"repo": repo})
+        await run_until(pipeline, lambda: len(calls) == 3)
+        return calls, await scheduler.ledger.usage()
+
+    calls, usage = asyncio.run(scenario())
+    # One job in flight at a time; the heavier-weighted repo overtakes the backlog
+    assert calls == ["job-0", "job-2", "job-1"]
+    assert usage == {"octo/mono": (0, 20), "team/app": (0, 10)}
+
+
+def test_shutdown_hands_back_jobs_waiting_in_the_scheduler(tmp_path):
+    path = str(tmp_path / "pipeline.db")
+
+    def build_scheduled(fetched):
+        async def ingest(payload):
+            return {"pr_url": "https://api.github.com/repos/octo/mono/pulls/1"}
+
+        async def fetch(payload):
+            fetched.append(payload["job_id"])
+            await asyncio.sleep(60)
+
+        scheduler = FairScheduler(SQLiteLedger(path), max_in_flight=1)
+        pipeline = Pipeline(SQLiteBus(path), max_attempts=3, retry_base=0.01)
+        pipeline.add_stage(Stage("ingest", ingest, "schedule"))
+        pipeline.add_scheduler("schedule", "fetch", scheduler)
+        pipeline.add_stage(Stage("fetch", fetch, None))
+        return pipeline, scheduler
+
+    async def interrupted():
+        pipeline, scheduler = build_scheduled([])
+        for n in range(3):
+            await pipeline.submit(f"job-{n}", {})
+        await pipeline.start()
+        while scheduler.pending < 2:
+            await asyncio.sleep(0.01)
+        await pipeline.stop(drain_seconds=0.05)
+
+    async def restarted():
+        # Default lease is 300 s: only handed-back messages are picked up right away
+        pipeline, scheduler = build_scheduled([])
+        await pipeline.start()
+        while scheduler.pending < 2:
+            await asyncio.sleep(0.01)
+        await pipeline.stop(drain_seconds=0.05)
+
+    asyncio.run(interrupted())
+    conn = sqlite3.connect(path)
+    waiting = conn.execute("SELECT status, attempts FROM messages WHERE topic = 'schedule' AND status != 'done'").fetchall()
+    conn.close()
+    assert waiting == [("ready", 0), ("ready", 0)]
+    asyncio.run(asyncio.wait_for(restarted(), 2))
+
+
+def test_jobs_queued_in_the_scheduler_keep_their_leases(tmp_path):
+    path = str(tmp_path / "pipeline.db")
+
+    async def scenario():
+        async def fetch(payload):
+            await asyncio.sleep(60)
+
+        scheduler = FairScheduler(SQLiteLedger(path), max_in_flight=1)
+        pipeline = Pipeline(SQLiteBus(path, lease_seconds=0.3, poll_interval=0.01), max_attempts=3)
+        pipeline.add_scheduler("schedule", "fetch", scheduler)
+        pipeline.add_stage(Stage("fetch", fetch, None))
+        for n in range(3):
+            await pipeline.bus.publish("schedule", {"job_id": f"job-{n}"}, key=f"job-{n}:schedule")
+        await pipeline.start()
+        # Several leases pass while two jobs wait behind the one in flight
+        await asyncio.sleep(1.2)
+        conn = sqlite3.connect(path)
+        queued = conn.execute("SELECT status, attempts FROM messages WHERE topic = 'schedule' "
+                              "AND status != 'done'").fetchall()
+        conn.close()
+        await pipeline.stop(drain_seconds=0.05)
+        return queued
+
+    assert asyncio.run(scenario()) == [("claimed", 1), ("claimed", 1)]
@@ -0,0 +1,311 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Response
+
+TRACE_HEADER = "X-Trace-Id"
+# An incoming trace ID is adopted only in this form; anything else gets a new one
+TRACE_ID_PATTERN = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+# Seconds; the top buckets cover slow LLM calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# How often the event-loop lag monitor wakes up
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+
+trace_id_var: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+
+
+def escape_label_value(value) -> str:
+    """A label value as the Prometheus text format quotes it"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    return ",".join(f'{k}="{escape_label_value(v)}"' for k, v in zip(names, values))
+
+
+class Histogram:
+    """Cumulative Prometheus-style histogram keyed by label values"""
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...],
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # [per-bucket counts, sum, count]
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {key: (list(c), s, n) for key, (c, s, n) in self._series.items()}
+        for label_values, (counts, total, count) in sorted(snapshot.items()):
+            base = format_labels(self.labels, label_values)
+            sep = "," if base else ""
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{base}{sep}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base}{sep}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{base}}} {total}")
+            lines.append(f"{self.name}_count{{{base}}} {count}")
+        return lines
+
+
+class Counter:
+    """Monotonic Prometheus-style counter keyed by label values"""
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = dict(self._values)
+        for label_values, value in sorted(snapshot.items()):
+            base = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}{{{base}}} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """Settable Prometheus-style gauge keyed by label values"""
+
+    def set(self, value: float, *label_values: str):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def histogram(self, name: str, description: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, description, labels, buckets))
+
+    def counter(self, name: str, description: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, description, labels))
+
+    def gauge(self, name: str, description: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._metrics.setdefault(name, Gauge(name, description, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class InMemorySpanExporter:
+    """Keeps the most recent finished spans so traces can be inspected offline"""
+
+    def __init__(self, max_spans: int = 2000):
+        self._spans = deque(maxlen=max_spans)
+
+    def export(self, span: Dict):
+        self._spans.append(span)
+
+    def get_trace(self, trace_id: str) -> List[Dict]:
+        return [span for span in list(self._spans) if span["trace_id"] == trace_id]
+
+
+# Both are per process: under several uvicorn workers, /metrics and /traces only
+# report the worker that answers, which is why the images run a single worker
+registry = MetricsRegistry()
+exporter = InMemorySpanExporter()
+SERVICE_NAME = "unknown"
+
+request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("service", "method", "path", "status")
+)
+stage_duration = registry.histogram(
+    "pipeline_stage_duration_seconds", "Review pipeline stage latency", ("service", "stage", "outcome")
+)
+loop_lag = registry.histogram(
+    "event_loop_lag_seconds", "How late the event loop woke a sleeping task", ("service",),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+loop_lag_last = registry.gauge(
+    "event_loop_lag_last_seconds", "Most recent event-loop lag sample", ("service",)
+)
+
+logger = logging.getLogger(__name__)
+
+
+def current_trace_id() -> Optional[str]:
+    return trace_id_var.get()
+
+
+def trace_headers() -> Dict[str, str]:
+    """Headers that propagate the current trace to a downstream service"""
+    trace_id = trace_id_var.get()
+    return {TRACE_HEADER: trace_id} if trace_id else {}
+
+
+@contextmanager
+def span(stage: str, **attributes):
+    """Time a pipeline stage, recording it in the stage histogram and the exporter"""
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield attributes
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stage_duration.observe(duration, SERVICE_NAME, stage, outcome)
+        exporter.export({
+            "trace_id": trace_id_var.get(),
+            "service": SERVICE_NAME,
+            "stage": stage,
+            "outcome": outcome,
+            "start": time.time() - duration,
+            "duration": duration,
+            "attributes": attributes,
+        })
+        logger.debug("Stage %s finished in %.3fs", stage, duration,
+                     extra={"stage": stage, "duration": duration, "outcome": outcome})
+
+
+async def monitor_event_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """Sleep in a loop and record how late each wakeup is.
+
+    Anything that blocks the loop (CPU-bound parsing, sync I/O) shows up
+    here as lag, even when no request happens to be timed across it.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        loop_lag.observe(lag, SERVICE_NAME)
+        loop_lag_last.set(lag, SERVICE_NAME)
+        if lag > 0.25:
+            logger.warning("Event loop blocked for %.3fs", lag, extra={"loop_lag": lag})
+
+
+class TraceContextFilter(logging.Filter):
+    """Stamp records with the active trace ID in the logging thread"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace_id = trace_id_var.get()
+        if trace_id:
+            record.trace_id = trace_id
+        return True
+
+
+class TraceMiddleware:
+    """Trace ID propagation and request timing as plain ASGI middleware.
+
+    Avoids BaseHTTPMiddleware, which costs an extra task and body stream
+    per request.
+    """
+
+    def __init__(self, app, service: str):
+        self.app = app
+        self.service = service
+        self.header = TRACE_HEADER.lower().encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        trace_id = None
+        for name, value in scope["headers"]:
+            if name == self.header:
+                trace_id = value.decode("latin-1")
+                break
+        if trace_id is None or not TRACE_ID_PATTERN.fullmatch(trace_id):
+            trace_id = uuid.uuid4().hex
+        token = trace_id_var.set(trace_id)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_trace(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (self.header, trace_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            request_duration.observe(time.perf_counter() - start, self.service, scope["method"], path, str(status))
+            trace_id_var.reset(token)
+
+
+def instrument_app(app: FastAPI, service: str):
+    """Add trace propagation, request timing, loop-lag sampling and /metrics to a FastAPI app"""
+    global SERVICE_NAME
+    SERVICE_NAME = service
+
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceContextFilter())
+
+    # Wraps the app's own lifespan, so the monitor outlives the app's startup and shutdown work
+    app_lifespan = app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan(app):
+        lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+        try:
+            async with app_lifespan(app) as state:
+                yield state
+        finally:
+            lag_monitor.cancel()
+
+    app.router.lifespan_context = lifespan
+
+    app.add_middleware(TraceMiddleware, service=service)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        """Prometheus text exposition of this service's metrics"""
+        return Response(content=registry.render(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/traces/{trace_id}", include_in_schema=False)
+    async def get_trace(trace_id: str):
+        """Spans recorded by this service for a trace (in-process exporter)"""
+        return {"service": service, "trace_id": trace_id, "spans": exporter.get_trace(trace_id)}